@@ -177,6 +177,8 @@ export default function AgentTestPage() {
             if (line.startsWith('data: ')) {
               try {
                 const eventData = JSON.parse(line.substring(6));
+                // 追蹤 span 只供效能分析，不顯示在執行過程中
+                if (eventData.type === 'trace_span') continue;
                 events.push(eventData);
                 setCurrentEvents([...events]);
 
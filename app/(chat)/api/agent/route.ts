@@ -7,6 +7,8 @@ import { join } from 'path';
 export const maxDuration = 600; // 秒
 
 export async function POST(request: NextRequest) {
+  // 請求抵達的時間；期限從這裡起算，Python 程序啟動與載入的時間也計入
+  const receivedAt = Date.now();
   try {
     // 檢查身份驗證
     const session = await auth();
@@ -14,7 +16,7 @@ export async function POST(request: NextRequest) {
       return NextResponse.json({ error: 'Unauthorized' }, { status: 401 });
     }
 
-    const { input, history } = await request.json();
+    const { input, history, profile, deadline } = await request.json();
     
     if (!input || typeof input !== 'string') {
       return NextResponse.json({ error: 'Invalid input' }, { status: 400 });
@@ -30,6 +32,8 @@ export async function POST(request: NextRequest) {
 
     // 創建串流響應
     const encoder = new TextEncoder();
+    // 用戶離開時停止 Python 程序（在 start 中設定）
+    let cancelPython: (() => void) | undefined;
     const stream = new ReadableStream({
       start(controller) {
         // 準備 Python 命令參數
@@ -40,6 +44,15 @@ export async function POST(request: NextRequest) {
           '--history',
           JSON.stringify(chatHistory)
         ];
+        if (profile === true) {
+          // 輸出此次執行的 CPU 與記憶體分析檔案
+          pythonArgs.push('--profile');
+        }
+        if (typeof deadline === 'number' && deadline > 0) {
+          // 本次請求的時限（秒）與到期的絕對時間（epoch 秒），時間不足時 Agent 逐步降級而不是逾時
+          pythonArgs.push('--deadline', String(deadline));
+          pythonArgs.push('--deadline-at', String((receivedAt + deadline * 1000) / 1000));
+        }
 
         // 調用 Python 後端
         const pythonProcess = spawn(pythonPath, pythonArgs, {
@@ -50,6 +63,29 @@ export async function POST(request: NextRequest) {
         let buffer = '';
         let hasStarted = false;
         let isClosed = false;
+        let hasExited = false;
+
+        pythonProcess.on('exit', () => {
+          hasExited = true;
+        });
+
+        // 用戶關閉頁面或中斷請求：送出 SIGTERM 讓 Python 取消進行中的 Agent、
+        // LLM、檢索與 OCR 呼叫；逾時仍未結束才強制終止
+        cancelPython = () => {
+          if (hasExited || isClosed) return;
+          isClosed = true;
+          pythonProcess.kill('SIGTERM');
+          const forceKill = setTimeout(() => {
+            if (!hasExited) pythonProcess.kill('SIGKILL');
+          }, 5000);
+          pythonProcess.once('exit', () => clearTimeout(forceKill));
+          try {
+            controller.close();
+          } catch {
+            // 串流已被取消
+          }
+        };
+        request.signal.addEventListener('abort', () => cancelPython?.());
 
         // 發送開始事件
         controller.enqueue(
@@ -70,7 +106,14 @@ export async function POST(request: NextRequest) {
           
           for (const line of lines) {
             const trimmedLine = line.trim();
-            if (trimmedLine && !isClosed) {
+            if (trimmedLine && isClosed) {
+              // 用戶已離開，只記錄取消時省下的工作
+              if (trimmedLine.includes('"type": "cancelled"')) {
+                console.info('Agent request cancelled:', trimmedLine);
+              }
+              continue;
+            }
+            if (trimmedLine) {
               try {
                 const event = JSON.parse(trimmedLine);
                 // 發送事件到前端
@@ -167,6 +210,9 @@ export async function POST(request: NextRequest) {
           clearTimeout(timeout);
         });
       },
+      cancel() {
+        cancelPython?.();
+      },
     });
 
     return new NextResponse(stream, {
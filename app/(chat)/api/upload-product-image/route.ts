@@ -1,5 +1,6 @@
 import { NextRequest, NextResponse } from 'next/server';
 import { writeFile, mkdir } from 'fs/promises';
+import { spawn } from 'child_process';
 import { join } from 'path';
 import { auth } from '@/app/(auth)/auth';
 import { ChatSDKError } from '@/lib/errors';
@@ -57,6 +58,9 @@ export async function POST(request: NextRequest) {
     const bytes = await file.arrayBuffer();
     await writeFile(filePath, new Uint8Array(bytes));
 
+    // 接下來很可能會進行 OCR，趁用戶輸入時先預熱視覺模型
+    warmUpVisionModel();
+
     // 回傳檔案路徑
     return NextResponse.json({
       success: true,
@@ -73,4 +77,23 @@ export async function POST(request: NextRequest) {
       { status: 500 }
     );
   }
-}
\ No newline at end of file
+}
+function warmUpVisionModel() {
+  const pythonPath = process.env.PYTHON_PATH || '/Users/chenyongjia/.pyenv/versions/agent_test/bin/python';
+  const workingDir = join(process.cwd(), 'python-backend');
+
+  try {
+    const warmupProcess = spawn(pythonPath, [join(workingDir, 'vision_warmup.py')], {
+      cwd: workingDir,
+      detached: true,
+      stdio: 'ignore'
+    });
+    warmupProcess.on('error', (error) => {
+      console.error('Vision model warm-up failed:', error);
+    });
+    warmupProcess.unref();
+  } catch (error) {
+    // 預熱失敗不影響上傳
+    console.error('Vision model warm-up failed:', error);
+  }
+}
@@ -5,5 +5,17 @@ set -e
 # 如果目錄已經存在（由 volume 掛載），不會報錯
 mkdir -p /app/uploads/products 2>/dev/null || true
 
+# 預熱 Ollama 視覺模型，並視設定在營業時間內持續保溫
+if [ "$OLLAMA_KEEP_WARM" = "true" ]; then
+  python3 /app/python-backend/vision_warmup.py --keep-warm &
+else
+  python3 /app/python-backend/vision_warmup.py >/dev/null 2>&1 &
+fi
+
+# 預熱檢索、關鍵字與翻譯快取，每 PREWARM_INTERVAL 秒重新預熱（0 表示只預熱一次）
+if [ "$AGENT_PREWARM" = "true" ]; then
+  (cd /app/python-backend && python3 prewarm.py) &
+fi
+
 # 啟動應用程式
 exec node server.js
@@ -3,45 +3,70 @@ import asyncio
 import os
 import json
 import base64
+import hashlib
 import re
-import requests
+import signal
+import httpx
 from dotenv import load_dotenv
 import argparse
 import sys
 import time
-from functools import wraps
+import uuid
+from contextlib import ExitStack
+from functools import partial, wraps
 from openai import AsyncOpenAI
-from litellm import completion
+from litellm import acompletion
 from agents import (
     Agent,
     Model,
     ModelProvider,
+    ModelSettings,
     OpenAIChatCompletionsModel,
     RunConfig,
     Runner,
     function_tool,
     set_tracing_disabled,
 )
+from answer_cache import (
+    ANSWER_CACHE_EMBEDDING_MODEL,
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_PATH,
+    LOCAL_EMBEDDER,
+    AnswerCache,
+)
+from batch_runner import batch_main
+from deadline import (
+    AGENT_DEADLINE_SECONDS,
+    DEGRADE_AGENT_TURNS_BELOW,
+    DEGRADE_LANGUAGE_DETECTION_BELOW,
+    DEGRADE_TOP_K_BELOW,
+    DEGRADE_TRANSLATION_BELOW,
+    DEGRADED_TOP_K,
+    call_timeout,
+    current_deadline,
+    degrade_if_below,
+    start_deadline,
+)
+from llm_scheduler import LLMScheduler, ScheduledAsyncOpenAI
+from profiling import profile_request
+from token_accounting import AGENT_TOKEN_BUDGET, TOKEN_USAGE_LOG, start_ledger
+from tool_cache import AGENT_CACHE_PATH, AGENT_CACHE_TTL, AGENT_LLM_CACHE_TTL, ToolCache
+from tracing import span, start_span, start_trace, traced, use_span
+from model_resolver import ModelCatalogMatcher, ModelMatch
+from vision_warmup import OLLAMA_KEEP_ALIVE, OLLAMA_VISION_MODEL, ensure_vision_model_loaded
 # 全域變數控制事件輸出
 _stream_events = False
 
-# Simple in-memory caches to avoid repeated slow network calls during a single
-# Python process lifetime. Keys are strings, values are tuples (timestamp, result).
-_CACHE: dict = {}
-_CACHE_TTL = 300  # seconds
+# Caches to avoid repeated slow network calls. The in-process layer is backed by
+# sqlite (AGENT_CACHE_PATH) so entries survive across the per-request processes
+# and can be filled ahead of time by prewarm.py.
+_CACHE = ToolCache(AGENT_CACHE_PATH, ttl=AGENT_CACHE_TTL)
 
 def _get_cached(key: str):
-    entry = _CACHE.get(key)
-    if not entry:
-        return None
-    ts, value = entry
-    if time.time() - ts > _CACHE_TTL:
-        del _CACHE[key]
-        return None
-    return value
+    return _CACHE.get(key)
 
-def _set_cache(key: str, value):
-    _CACHE[key] = (time.time(), value)
+def _set_cache(key: str, value, ttl: float | None = None):
+    _CACHE.set(key, value, ttl)
 
 def emit_event(event_type: str, **kwargs):
     """發送事件到前端，只在串流模式下輸出"""
@@ -65,6 +90,8 @@ RAGFLOW_BASE_URL = os.getenv("RAGFLOW_BASE_URL")
 RAGFLOW_API_KEY = os.getenv("RAGFLOW_API_KEY")
 RAGFLOW_KB_ID = os.getenv("RAGFLOW_KB_ID")
 OLLAMA_HOST = os.getenv("OLLAMA_HOST")
+# 追蹤 span 以 OTLP JSON 格式附加到此檔案（選填）
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
 
 # 檢查必要的環境變數
 if not all([BASE_URL, API_KEY, MODEL_NAME]):
@@ -77,7 +104,18 @@ if not OLLAMA_HOST:
     raise ValueError("請在 .env.local 中設置 OLLAMA_HOST")
 
 # 建立自訂 OpenAI client 與 provider
-client = AsyncOpenAI(base_url=BASE_URL, api_key=API_KEY)
+# 重試交給 LLM_SCHEDULER 統一處理，client 本身不重試，避免重試風暴
+LLM_SCHEDULER = LLMScheduler(
+    initial_limit=float(os.getenv("LLM_CONCURRENCY_INITIAL", "8")),
+    max_limit=int(os.getenv("LLM_CONCURRENCY_MAX", "32")),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "4")),
+    state_path=os.getenv("LLM_SCHEDULER_STATE_PATH", "cache/llm_scheduler.sqlite3"),
+    on_backoff=lambda **kwargs: emit_event("llm_backoff", message="LLM 服務過載，退避重試中", **kwargs),
+)
+client = ScheduledAsyncOpenAI(
+    AsyncOpenAI(base_url=BASE_URL, api_key=API_KEY, max_retries=0),
+    LLM_SCHEDULER,
+)
 set_tracing_disabled(disabled=True)
 
 class CustomModelProvider(ModelProvider):
@@ -86,6 +124,16 @@ class CustomModelProvider(ModelProvider):
 
 CUSTOM_MODEL_PROVIDER = CustomModelProvider()
 
+# Agent 每次請求最多執行的輪數
+AGENT_MAX_TURNS = 10
+
+# Agent 因 token 預算停止、且最後一輪沒有文字回答時的回覆
+TOKEN_BUDGET_MESSAGE = "抱歉，這個問題需要查詢的資料量超過單次回答的上限。請提供更具體的產品型號或需求，我再為您查詢。"
+# Agent 因請求期限將至而停止時的回覆
+DEADLINE_MESSAGE = "抱歉，這次查詢在時限內未能完成完整分析。請提供更具體的產品型號或需求，我再為您查詢。"
+# 時間不足、略過輸出翻譯時加在回答前（用戶使用的不是中文）
+UNTRANSLATED_NOTICE = "(Translation skipped to meet the response time limit; the answer below is in Chinese.)"
+
 # 型號映射表
 MODEL_MAPPING = {
     "GFM22": "GF-22M",
@@ -97,11 +145,94 @@ MODEL_MAPPING = {
     "QWFM45": "QW-45F"
 }
 
+# 產品類型詞彙（與 Agent 指示中的類型一致）與情境 C 的產品概覽查詢，預熱時逐一檢索
+PRODUCT_TYPES = [
+    "單段減速機",
+    "雙段減速機",
+    "法蘭式減速機",
+    "中空型減速機",
+    "雙段蝸輪齒輪減速機",
+    "單段立式蝸輪減速機",
+]
+OVERVIEW_QUERY = "減速機"
+
+# 知識庫型號清單（選填），每行一個型號，用於擴充 OCR 模糊比對的目錄
+PRODUCT_MODELS_FILE = os.getenv("PRODUCT_MODELS_FILE")
+MODEL_MATCH_MIN_CONFIDENCE = float(os.getenv("MODEL_MATCH_MIN_CONFIDENCE", "0.6"))
+
+def load_known_models() -> list:
+    """彙整型號映射表與知識庫型號清單"""
+    models = list(MODEL_MAPPING.keys()) + list(MODEL_MAPPING.values())
+    if PRODUCT_MODELS_FILE and os.path.exists(PRODUCT_MODELS_FILE):
+        with open(PRODUCT_MODELS_FILE, encoding="utf-8") as f:
+            models.extend(line.strip() for line in f if line.strip())
+    return models
+
+MODEL_MATCHER = ModelCatalogMatcher(load_known_models())
+
 # RAGFlow 配置
 RAGFLOW_HEADERS = {
     'Content-Type': 'application/json',
     'Authorization': f'Bearer {RAGFLOW_API_KEY}'
 }
+# 非同步 client：請求取消時會直接中斷連線，不會留在執行緒裡跑完
+RAGFLOW_CLIENT = httpx.AsyncClient(base_url=RAGFLOW_BASE_URL, headers=RAGFLOW_HEADERS, timeout=20)
+
+# ============ 答案快取 ============
+
+async def fetch_kb_snapshot() -> str | None:
+    """知識庫目前的版本（更新時間與文件、chunk 數）；取不到時為 None"""
+    try:
+        response = await RAGFLOW_CLIENT.get("/api/v1/datasets", params={"id": RAGFLOW_KB_ID},
+                                            timeout=call_timeout(5))
+        response.raise_for_status()
+        payload = response.json()
+    except (httpx.HTTPError, ValueError):
+        return None
+    datasets = payload.get("data") or []
+    if payload.get("code") != 0 or not datasets:
+        return None
+    dataset = datasets[0]
+    return f"{dataset.get('update_time')}:{dataset.get('document_count')}:{dataset.get('chunk_count')}"
+
+async def embed_question(text: str) -> list:
+    # 經過 LLM_SCHEDULER，與其他 LLM 呼叫共用並行上限與退避，用量記在 answer_cache 階段
+    with span("answer_cache"):
+        response = await client.embeddings.create(model=ANSWER_CACHE_EMBEDDING_MODEL, input=text,
+                                                  timeout=call_timeout(10))
+    return response.data[0].embedding
+
+ANSWER_CACHE = AnswerCache(
+    ANSWER_CACHE_PATH,
+    kb_snapshot_fn=fetch_kb_snapshot,
+    model_aliases=MODEL_MAPPING,
+    guard_terms=PRODUCT_TYPES,
+    embed_fn=embed_question if ANSWER_CACHE_EMBEDDING_MODEL else None,
+    embedder=ANSWER_CACHE_EMBEDDING_MODEL or LOCAL_EMBEDDER,
+) if ANSWER_CACHE_ENABLED else None
+
+# 含圖片路徑的查詢需要 OCR，答案取決於圖片內容，不使用答案快取
+IMAGE_PATH_PATTERN = re.compile(r'\.(?:jpe?g|png|gif|bmp|webp)\b', re.IGNORECASE)
+
+async def lookup_cached_answer(question: str, language: str | None = None) -> dict | None:
+    """查詢答案快取；快取或知識庫無法使用時視為沒有命中"""
+    try:
+        with span("answer_cache.lookup"):
+            return await ANSWER_CACHE.lookup(question, language)
+    except Exception as e:
+        emit_event("warning", message=f"答案快取查詢失敗: {str(e)}")
+        return None
+
+async def store_cached_answer(question: str, answer: str, language: str | None = None,
+                              translation: str | None = None, entry_id: int | None = None):
+    """儲存完整的中文回答與（選填）某個語言的翻譯；指定 entry_id 時只補上翻譯"""
+    try:
+        if entry_id is None:
+            entry_id = await ANSWER_CACHE.store(question, answer)
+        if entry_id is not None and translation:
+            ANSWER_CACHE.store_translation(entry_id, language, translation)
+    except Exception as e:
+        emit_event("warning", message=f"答案快取儲存失敗: {str(e)}")
 
 # ============ 翻譯功能 ============
 
@@ -157,6 +288,27 @@ async def detect_language(text: str) -> dict:
         }
 
 
+_HEURISTIC_LANGUAGES = [
+    # (字元範圍, 語言代碼, 語言名稱)；依序比對，日文的漢字與中文重疊，需先比對假名
+    (re.compile(r'[\u3040-\u30ff]'), "ja", "Japanese"),
+    (re.compile(r'[\uac00-\ud7af]'), "ko", "Korean"),
+    (re.compile(r'[\u0e00-\u0e7f]'), "th", "Thai"),
+    (re.compile(r'[\u4e00-\u9fff]'), "zh-TW", "Traditional Chinese"),
+    (re.compile(r'[ăâđêôơưạảấầẩẫậắằẳẵặẹẻẽếềểễệỉịọỏốồổỗộớờởỡợụủứừửữựỳỵỷỹ]', re.IGNORECASE), "vi", "Vietnamese"),
+]
+
+def detect_language_heuristic(text: str) -> dict:
+    """依字元範圍推測語言，不呼叫 LLM（時間不足時使用）；無法判斷時視為英文"""
+    for pattern, code, name in _HEURISTIC_LANGUAGES:
+        if pattern.search(text):
+            return {"language_code": code, "language_name": name, "is_chinese": code == "zh-TW"}
+    return {"language_code": "en", "language_name": "English", "is_chinese": False}
+
+
+def translation_cache_key(text: str, source_language: str, target_language: str) -> str:
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    return f"translate:{source_language}:{target_language}:{digest}"
+
 async def translate_text(text: str, target_language: str, source_language: str = "zh-TW") -> str:
     """
     翻譯文本
@@ -174,6 +326,11 @@ async def translate_text(text: str, target_language: str, source_language: str =
         if source_language == target_language:
             return text
         
+        cache_key = translation_cache_key(text, source_language, target_language)
+        cached = _get_cached(cache_key)
+        if cached is not None:
+            return cached
+        
         # 語言名稱映射
         language_names = {
             "en": "English",
@@ -212,7 +369,9 @@ async def translate_text(text: str, target_language: str, source_language: str =
             temperature=0.3  # 降低溫度以獲得更一致的翻譯
         )
         
-        return response.choices[0].message.content
+        translated = response.choices[0].message.content
+        _set_cache(cache_key, translated, ttl=AGENT_LLM_CACHE_TTL)
+        return translated
         
     except Exception as e:
         emit_event("error", message=f"翻譯失敗: {str(e)}")
@@ -220,29 +379,61 @@ async def translate_text(text: str, target_language: str, source_language: str =
 
 # ============ 產品分析工具 ============
 
+_TYPE_MODEL_PATTERNS = [
+    re.compile(r'TYPE[:\s]*([A-Z0-9-]+)', re.IGNORECASE),
+    re.compile(r'型號[:\s]*([A-Z0-9-]+)', re.IGNORECASE),
+    re.compile(r'([A-Z]{2,}[0-9]+[A-Z]*)', re.IGNORECASE),
+    re.compile(r'([A-Z]+-[0-9]+[A-Z]*)', re.IGNORECASE),
+]
+# OCR 可能把開頭字母讀成數字（6LM40），模糊比對時另外收集完整的英數字串
+_MODEL_TOKEN_PATTERN = re.compile(r'\b([A-Z0-9][A-Z0-9-]{2,})\b', re.IGNORECASE)
+
 def extract_type_model(text: str) -> str:
     """從OCR結果中提取TYPE型號"""
-    patterns = [
-        r'TYPE[:\s]*([A-Z0-9-]+)',
-        r'型號[:\s]*([A-Z0-9-]+)',
-        r'([A-Z]{2,}[0-9]+[A-Z]*)',
-        r'([A-Z]+-[0-9]+[A-Z]*)'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in _TYPE_MODEL_PATTERNS:
+        match = pattern.search(text)
         if match:
             return match.group(1).upper()
     
     cleaned_text = text.strip().replace("未找到型號", "").strip().upper()
     return cleaned_text if cleaned_text else "未知型號"
 
+def resolve_model_number(text: str) -> ModelMatch | None:
+    """
+    從OCR結果中找出最可能的已知型號
+    
+    收集所有樣式的候選字串，以 OCR 混淆感知的編輯距離與型號目錄比對，
+    取信心分數最高者。
+    
+    Args:
+        text: 視覺模型輸出的文字
+    
+    Returns:
+        最佳比對結果，找不到足夠接近的型號時為 None
+    """
+    candidates = []
+    for pattern in [*_TYPE_MODEL_PATTERNS, _MODEL_TOKEN_PATTERN]:
+        for match in pattern.finditer(text):
+            candidate = match.group(1).upper()
+            if candidate not in candidates:
+                candidates.append(candidate)
+    
+    best = None
+    for candidate in candidates:
+        match = MODEL_MATCHER.best_match(candidate, MODEL_MATCH_MIN_CONFIDENCE)
+        if match and (best is None or match.confidence > best.confidence):
+            best = match
+            if best.confidence == 1.0:
+                break
+    return best
+
 def map_model_number(model_number: str) -> str:
     """型號映射表轉換"""
     model_upper = model_number.upper()
     return MODEL_MAPPING.get(model_upper, model_number)
 
 @function_tool
+@traced("tool.extract_product_model")
 async def extract_product_model(image_path: str) -> str:
     """
     從產品標籤圖片中提取型號信息
@@ -278,32 +469,50 @@ async def extract_product_model(image_path: str) -> str:
 請只回傳TYPE對應的型號，例如：如果看到TYPE GLM40，請回傳：GLM40
 如果找不到TYPE欄位，請回傳：未找到型號"""
         
-        # 調用 Ollama 視覺模型
-        response = completion(
-            model="ollama/qwen2.5vl:7b",
-            messages=[{
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": image_url}}
-                ]
-            }],
-            api_base=f"http://{OLLAMA_HOST}",
-            stream=False
-        )
+        # 確認視覺模型已載入，冷啟動時間與推論時間分開計算
+        with span("ocr_model_load"):
+            warmup = await asyncio.to_thread(ensure_vision_model_loaded)
+        
+        # 調用 Ollama 視覺模型（非同步呼叫，請求取消時會中斷推論）
+        inference_start = time.time()
+        with span("ocr_inference", model=OLLAMA_VISION_MODEL):
+            response = await acompletion(
+                model=f"ollama/{OLLAMA_VISION_MODEL}",
+                messages=[{
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {"type": "image_url", "image_url": {"url": image_url}}
+                    ]
+                }],
+                api_base=f"http://{OLLAMA_HOST}",
+                keep_alive=OLLAMA_KEEP_ALIVE,
+                timeout=call_timeout(600),
+                stream=False
+            )
+        inference_seconds = time.time() - inference_start
         
         extracted_text = response.choices[0].message.content
         detected_model = extract_type_model(extracted_text)
-        mapped_model = map_model_number(detected_model)
+        model_match = resolve_model_number(extracted_text)
+        resolved_model = model_match.model if model_match else detected_model
+        mapped_model = map_model_number(resolved_model)
         
         if mapped_model != detected_model:
             result = f"識別型號：{detected_model} → 映射型號：{mapped_model}"
         else:
             result = f"識別型號：{detected_model}"
+        if model_match and model_match.confidence < 1.0:
+            result += f"（模糊比對信心 {model_match.confidence:.2f}）"
         
         emit_event("tool_call_end", 
                   tool_name="extract_product_model", 
-                  message="extract_product_model 調用完成")
+                  message="extract_product_model 調用完成",
+                  resolved_model=mapped_model,
+                  match_confidence=model_match.confidence if model_match else None,
+                  cold_load=warmup["cold_load"],
+                  cold_load_seconds=warmup["load_seconds"],
+                  inference_seconds=inference_seconds)
         return result
             
     except Exception as e:
@@ -314,6 +523,7 @@ async def extract_product_model(image_path: str) -> str:
         return result
 
 @function_tool
+@traced("tool.retrieve_product_knowledge")
 async def retrieve_product_knowledge(query: str) -> str:
     """
     從知識庫檢索產品相關信息
@@ -324,13 +534,17 @@ async def retrieve_product_knowledge(query: str) -> str:
     Returns:
         檢索到的產品資料摘要
     """
+    return await retrieve_knowledge(query)
+
+async def retrieve_knowledge(query: str, use_cache: bool = True) -> str:
+    """retrieve_product_knowledge 的實作；use_cache 為 False 時不讀快取、一律重新檢索（預熱時更新快取）"""
     emit_event("tool_call_start",
               tool_name="retrieve_product_knowledge",
               message="正在調用 retrieve_product_knowledge...")
     start_ts = time.time()
 
     # Check cache first
-    cached = _get_cached(f"retrieve:{query}")
+    cached = _get_cached(f"retrieve:{query}") if use_cache else None
     if cached is not None:
         emit_event("tool_call_end",
                   tool_name="retrieve_product_knowledge",
@@ -340,25 +554,23 @@ async def retrieve_product_knowledge(query: str) -> str:
     
     try:
         # 直接使用查詢內容檢索
-        # Reduce top_k and results to improve latency. Use threadpool to avoid
-        # blocking the event loop since requests is synchronous.
+        # Reduce top_k and results to improve latency.
+        # 請求期限將至時縮小候選範圍以加快檢索
+        degraded = degrade_if_below(DEGRADE_TOP_K_BELOW, "reduce_top_k", top_k=DEGRADED_TOP_K,
+                                    message=f"剩餘時間不足，檢索 top_k 降為 {DEGRADED_TOP_K}")
         search_data = {
             "question": query,
             "dataset_ids": [RAGFLOW_KB_ID],
-            "top_k": 128,
+            "top_k": DEGRADED_TOP_K if degraded else 128,
             "similarity_threshold": 0.25,
             "vector_similarity_weight": 0.6,
             "keyword": True,
             "highlight": True
         }
 
-        response = await asyncio.to_thread(
-            requests.post,
-            f"{RAGFLOW_BASE_URL}/api/v1/retrieval",
-            headers=RAGFLOW_HEADERS,
-            json=search_data,
-            timeout=20,
-        )
+        with span("ragflow_retrieval", top_k=search_data["top_k"]):
+            response = await RAGFLOW_CLIENT.post("/api/v1/retrieval", json=search_data,
+                                                 timeout=call_timeout(20))
         
         if response.status_code == 200:
             data = response.json()
@@ -389,7 +601,9 @@ async def retrieve_product_knowledge(query: str) -> str:
                     
                     final_result = "\n".join(results)
                     # Cache the result for short period to speed up repeated queries
-                    _set_cache(f"retrieve:{query}", final_result)
+                    # 降級的結果不快取，避免之後時間充裕的請求也拿到較少的候選
+                    if not degraded:
+                        _set_cache(f"retrieve:{query}", final_result)
                     emit_event("tool_call_end",
                               tool_name="retrieve_product_knowledge",
                               message="retrieve_product_knowledge 調用完成",
@@ -442,6 +656,7 @@ def extract_model_from_query(query: str) -> str:
     return None
 
 @function_tool
+@traced("tool.extract_query_keywords")
 async def extract_query_keywords(user_query: str) -> str:
     """
     從用戶查詢中提取關鍵詞用於 RAGFlow 檢索
@@ -452,6 +667,10 @@ async def extract_query_keywords(user_query: str) -> str:
     Returns:
         提取的關鍵詞和搜索建議
     """
+    return await extract_keywords(user_query)
+
+async def extract_keywords(user_query: str) -> str:
+    """extract_query_keywords 的實作，預熱時直接呼叫"""
     emit_event("tool_call_start",
               tool_name="extract_query_keywords",
               message="正在調用 extract_query_keywords...")
@@ -516,7 +735,7 @@ async def extract_query_keywords(user_query: str) -> str:
                   duration=time.time()-start_ts)
 
         out = json.dumps(result, ensure_ascii=False)
-        _set_cache(f"keywords:{user_query}", out)
+        _set_cache(f"keywords:{user_query}", out, ttl=AGENT_LLM_CACHE_TTL)
         return out
 
     except Exception as e:
@@ -650,15 +869,113 @@ async def create_product_analysis_agent():
     )
     return agent
 
-async def process_user_input(user_input: str, chat_history: list = None):
+async def _events_within_deadline(stream_result):
+    """依序產生 Agent 串流事件；請求期限已過時，呼叫逾時造成的錯誤視為正常結束"""
+    try:
+        async for event in stream_result.stream_events():
+            yield event
+    except Exception:
+        deadline = current_deadline()
+        if deadline is None or not deadline.expired:
+            raise
+        deadline.degrade("partial_answer", message="已達請求時限，以目前取得的結果回答")
+
+def _partial_answer(stream_result, turn_text: str, notice: str) -> str:
+    """Agent 提前停止時的回答：最後一輪的文字，否則為最近一次檢索到的資料"""
+    text = re.sub(r'<think>.*?(</think>|$)', '', turn_text, flags=re.DOTALL).strip()
+    if text:
+        return text
+    for item in reversed(stream_result.new_items):
+        output = getattr(item, "output", None)
+        if isinstance(output, str) and output.startswith("檢索查詢："):
+            return f"{notice}\n\n以下為目前檢索到的資料（尚未整理）：\n\n{output}"
+    return notice
+
+async def _translate_output(text: str, language_code: str, language_name: str) -> tuple:
+    """把中文回答翻譯回用戶的語言；時間不足時直接回傳中文。第二個值為是否已翻譯"""
+    if degrade_if_below(DEGRADE_TRANSLATION_BELOW, "skip_output_translation",
+                        message="剩餘時間不足，直接回傳未翻譯的回答"):
+        return f"{UNTRANSLATED_NOTICE}\n\n{text}", False
+    emit_event("translating_output",
+              message=f"正在將結果翻譯回 {language_name}...")
+    
+    with span("translate_output", target_language=language_code):
+        translated = await translate_text(
+            text,
+            target_language=language_code,
+            source_language="zh-TW"
+        )
+    
+    emit_event("translation_complete",
+              message="輸出翻譯完成")
+    # translate_text 失敗時回傳原文
+    return translated, translated != text
+
+def _final_result(final_output: str, user_input: str, original_language: str | None, tracer, ledger,
+                  request_deadline, agent_usage=None, answer_cache: dict | None = None) -> dict:
+    """送出最終結果事件並回傳結果"""
+    result = {
+        "type": "final_result",
+        "final_output": final_output,
+        "user_input": user_input,
+        "original_language": original_language,
+        "status": "success",
+        "latency_breakdown": tracer.breakdown(),
+        "token_usage": ledger.summary(),
+        "degradations": request_deadline.degradations if request_deadline else [],
+        "answer_cache": answer_cache,
+    }
+    emit_event("final_result", **{key: value for key, value in result.items() if key != "type"})
+    result["usage"] = {
+        "requests": agent_usage.requests if agent_usage else 0,
+        "input_tokens": agent_usage.input_tokens if agent_usage else 0,
+        "output_tokens": agent_usage.output_tokens if agent_usage else 0,
+        "total_tokens": agent_usage.total_tokens if agent_usage else 0,
+    }
+    return result
+
+def _cancellation_report(tracer, ledger, stage: str, is_chinese: bool | None, elapsed: float) -> dict:
+    """取消時已完成與省下的工作；需在停止 Agent 之前呼叫，才能取得進行中的呼叫"""
+    aborted = [s.name for s in tracer.active.values() if s is not tracer.root]
+    agent_turns = tracer.breakdown()["agent"]["turns"]
+    pipeline = ["language_detection", "translate_input", "agent_run", "translate_output"]
+    skipped = pipeline[pipeline.index(stage) + 1:]
+    if is_chinese is not False:
+        # 中文輸入（或尚未偵測出語言）不會翻譯
+        skipped = [name for name in skipped if not name.startswith("translate_")]
+    return {
+        "stage": stage,
+        "elapsed_seconds": round(elapsed, 3),
+        "tokens_used": ledger.totals["total_tokens"],
+        "agent_turns_completed": agent_turns,
+        # 上限值：Agent 最多還能再跑的輪數
+        "agent_turns_skipped": AGENT_MAX_TURNS - agent_turns,
+        "aborted_calls": aborted,
+        "skipped_stages": skipped,
+    }
+
+async def process_user_input(user_input: str, chat_history: list = None, stream_events: bool = True,
+                             profile: bool | None = None, request_id: str | None = None,
+                             token_budget: int | None = None, deadline: float | None = None,
+                             deadline_at: float | None = None):
     """處理用戶輸入，整合串流事件、翻譯和完整結果
     
     Args:
         user_input: 用戶當前輸入
         chat_history: 對話歷史，格式為 [{"role": "user"/"assistant", "content": "..."}, ...]
+        stream_events: 是否輸出串流事件；批次模式下多筆查詢並行，需關閉
+        profile: 是否分析 CPU 與記憶體；None 時依 AGENT_PROFILE 環境變數
+        request_id: 請求 ID，用於追蹤與分析檔名；未提供時自動產生
+        token_budget: 本次請求的 token 上限，超過後 Agent 不再開始下一輪；
+            None 時依 AGENT_TOKEN_BUDGET 環境變數，0 表示不限制
+        deadline: 本次請求的時限（秒），時間不足時逐步降級；
+            None 時依 AGENT_DEADLINE_SECONDS 環境變數，0 表示不設期限
+        deadline_at: 期限的絕對時間（epoch 秒），由請求抵達的時間加上 deadline；
+            程序啟動與載入的時間也算在期限內。None 時從現在起算
     """
     global _stream_events
-    _stream_events = True
+    if stream_events:
+        _stream_events = True
     
     # 如果沒有提供歷史記錄，初始化為空列表
     if chat_history is None:
@@ -668,11 +985,66 @@ async def process_user_input(user_input: str, chat_history: list = None):
     original_language = None
     translated_input = user_input
     
+    # 整個請求包在一個追蹤裡，各階段的耗時以 trace_span 事件送出
+    request_id = request_id or uuid.uuid4().hex
+    trace_stack = ExitStack()
+    # 設定到一半失敗時，已進入的追蹤、分析與期限都要還原
+    with ExitStack() as setup_stack:
+        setup_stack.push(trace_stack)
+        trace_stack.enter_context(profile_request(
+            request_id,
+            enabled=profile,
+            on_saved=lambda summary: emit_event("profile_saved", message="效能分析檔案已輸出", **summary),
+        ))
+        tracer = trace_stack.enter_context(start_trace(
+            trace_id=request_id,
+            on_span_end=lambda span_data: emit_event("trace_span", span=span_data),
+            export_path=TRACE_EXPORT_PATH,
+        ))
+        trace_stack.enter_context(span("request", history_length=len(chat_history)))
+        ledger = trace_stack.enter_context(start_ledger(
+            request_id,
+            budget=AGENT_TOKEN_BUDGET if token_budget is None else token_budget,
+        ))
+        request_deadline = trace_stack.enter_context(start_deadline(
+            AGENT_DEADLINE_SECONDS if deadline is None else deadline,
+            on_degrade=lambda degradation: emit_event("degradation", **degradation),
+            expires_at=deadline_at,
+        ))
+        setup_stack.pop_all()
+    status = "error"
+    # 目前所在的階段與 Agent 串流，取消時用來停止 Agent 並統計省下的工作
+    request_start = time.time()
+    stage = "language_detection"
+    is_chinese = None
+    stream_result = None
+    agent_span = None
+    cache_hit = None
+    cache_question = None
+    
     try:
+        # 追問依賴對話歷史、圖片查詢依賴圖片內容，都不使用答案快取
+        use_answer_cache = (ANSWER_CACHE is not None and not chat_history
+                            and not IMAGE_PATH_PATTERN.search(user_input))
+        
+        # ============ 步驟 0: 答案快取 ============
+        # 中文問題不需翻譯，直接以原文查詢；命中時連語言偵測都不必呼叫 LLM
+        heuristic_language = detect_language_heuristic(user_input)
+        if use_answer_cache and heuristic_language["is_chinese"]:
+            cache_question = user_input
+            cache_hit = await lookup_cached_answer(cache_question)
+        
         # ============ 步驟 1: 語言偵測與翻譯輸入 ============
         emit_event("language_detection", message="正在偵測語言...")
         
-        language_info = await detect_language(user_input)
+        if cache_hit:
+            language_info = heuristic_language
+        elif degrade_if_below(DEGRADE_LANGUAGE_DETECTION_BELOW, "heuristic_language_detection",
+                              message="剩餘時間不足，改以字元判斷語言"):
+            language_info = heuristic_language
+        else:
+            with span("language_detection"):
+                language_info = await detect_language(user_input)
         original_language = language_info.get("language_code", "zh-TW")
         language_name = language_info.get("language_name", "Unknown")
         is_chinese = language_info.get("is_chinese", True)
@@ -685,21 +1057,48 @@ async def process_user_input(user_input: str, chat_history: list = None):
         
         # 如果不是中文，翻譯成繁體中文
         if not is_chinese:
+            stage = "translate_input"
             emit_event("translating_input", 
                       message=f"正在將 {language_name} 翻譯成繁體中文...")
             
-            translated_input = await translate_text(
-                user_input, 
-                target_language="zh-TW",
-                source_language=original_language
-            )
+            with span("translate_input", source_language=original_language):
+                translated_input = await translate_text(
+                    user_input, 
+                    target_language="zh-TW",
+                    source_language=original_language
+                )
             
             emit_event("translation_complete",
                       original_text=user_input,
                       translated_text=translated_input,
                       message="輸入翻譯完成")
         
+        needs_translation = original_language and original_language != "zh-TW" and not is_chinese
+        
+        # 翻譯後的問題與先前查詢的不同時（非中文輸入），再查一次答案快取
+        if use_answer_cache and cache_hit is None and translated_input != cache_question:
+            cache_question = translated_input
+            cache_hit = await lookup_cached_answer(cache_question, original_language)
+        
+        if cache_hit:
+            emit_event("answer_cache_hit",
+                      similarity=cache_hit["similarity"],
+                      cached_question=cache_hit["cached_question"],
+                      age_seconds=cache_hit["age_seconds"],
+                      message="找到相同問題的回答，略過 Agent 分析")
+            final_output = cache_hit["translation"] or cache_hit["answer"]
+            if needs_translation and not cache_hit["translation"]:
+                stage = "translate_output"
+                final_output, translated = await _translate_output(final_output, original_language, language_name)
+                if translated:
+                    await store_cached_answer(cache_question, cache_hit["answer"], original_language,
+                                              final_output, entry_id=cache_hit["id"])
+            status = "success"
+            return _final_result(final_output, user_input, original_language, tracer, ledger, request_deadline,
+                                 answer_cache={key: cache_hit[key] for key in ("similarity", "age_seconds")})
+        
         # ============ 步驟 2: Agent 處理（原有邏輯）============
+        stage = "agent_run"
         agent = await create_product_analysis_agent()
         
         # 構建包含歷史對話的完整 context
@@ -720,21 +1119,31 @@ async def process_user_input(user_input: str, chat_history: list = None):
                       history_length=len(chat_history),
                       message=f"已加入 {len(chat_history)} 條歷史對話作為上下文")
         
-        stream_result = Runner.run_streamed(
-            agent,
-            input=full_input,  # 使用包含歷史的完整輸入
-            run_config=RunConfig(model_provider=CUSTOM_MODEL_PROVIDER),
-            max_turns=10,
-        )
+        # Agent 在背景 task 中執行，建立時的 span 即為其中模型與工具呼叫的父節點
+        agent_span = start_span("agent_run", max_turns=AGENT_MAX_TURNS)
+        with use_span(agent_span):
+            stream_result = Runner.run_streamed(
+                agent,
+                input=full_input,  # 使用包含歷史的完整輸入
+                run_config=RunConfig(
+                    model_provider=CUSTOM_MODEL_PROVIDER,
+                    # 串流時要求回傳用量，才能統計 token
+                    model_settings=ModelSettings(include_usage=True),
+                ),
+                max_turns=AGENT_MAX_TURNS,
+            )
         
         thinking_buffer = ""
         inside_think_tag = False
         final_result = None
         all_thinking_content = []
         thinking_sent = False
+        turn_text = ""
+        # Agent 因 token 預算或請求期限提前停止時的說明
+        stop_notice = None
         
         # 串流處理
-        async for event in stream_result.stream_events():
+        async for event in _events_within_deadline(stream_result):
             event_type = event.type
             
             try:
@@ -775,6 +1184,13 @@ async def process_user_input(user_input: str, chat_history: list = None):
                 
                 # 處理其他事件類型
                 elif event_type in ["raw_response_event", "model_text_delta"]:
+                    # 保留目前這一輪的文字，token 預算用盡時作為部分回答
+                    data_type = getattr(getattr(event, 'data', None), 'type', None)
+                    if data_type == "response.created":
+                        turn_text = ""
+                    elif data_type == "response.output_text.delta":
+                        turn_text += str(event.data.delta)
+
                     content = ""
                     if hasattr(event, 'content'):
                         content = str(event.content)
@@ -806,6 +1222,27 @@ async def process_user_input(user_input: str, chat_history: list = None):
                 # 靜默處理錯誤，避免中斷流程
                 continue
             
+            # 超過 token 預算：讓目前這一輪完成後停止，不再開始下一輪
+            if ledger.exceeded and not stop_notice:
+                stop_notice = TOKEN_BUDGET_MESSAGE
+                stream_result.cancel(mode="after_turn")
+                emit_event("budget_exceeded",
+                          budget=ledger.budget,
+                          total_tokens=ledger.totals["total_tokens"],
+                          message="已達本次查詢的 token 上限，停止 Agent")
+            
+            # 請求期限將至：同樣在這一輪結束後停止；已過期限則立即停止
+            if request_deadline and not stream_result.is_complete:
+                if request_deadline.expired:
+                    stop_notice = stop_notice or DEADLINE_MESSAGE
+                    stream_result.cancel()
+                    request_deadline.degrade("partial_answer", message="已達請求時限，以目前取得的結果回答")
+                elif not stop_notice and degrade_if_below(
+                        DEGRADE_AGENT_TURNS_BELOW, "cap_agent_turns",
+                        message="剩餘時間不足，Agent 完成這一輪後停止"):
+                    stop_notice = DEADLINE_MESSAGE
+                    stream_result.cancel(mode="after_turn")
+            
             # 捕獲最終結果
             if event_type == "run_completed":
                 try:
@@ -814,51 +1251,68 @@ async def process_user_input(user_input: str, chat_history: list = None):
                     # 靜默處理錯誤
                     pass
         
+        if agent_span:
+            agent_span.end()
+        
         # 處理最終結果
         if final_result:
             complete_response = final_result.final_output
+        elif stream_result.is_complete and stream_result.final_output is not None:
+            # 串流結束後結果已在 stream_result 上，不需要再跑一次 Agent
+            complete_response = stream_result.final_output
+        elif stop_notice or (request_deadline and request_deadline.expired):
+            # 不要再以 Runner.run 重跑，直接以目前取得的內容回答
+            complete_response = _partial_answer(stream_result, turn_text, stop_notice or DEADLINE_MESSAGE)
         else:
             # 如果沒有捕獲到結果，使用標準方式獲取
             final_result_obj = await Runner.run(
                 starting_agent=agent,
                 input=translated_input,  # 使用翻譯後的輸入
-                run_config=RunConfig(model_provider=CUSTOM_MODEL_PROVIDER),
-                max_turns=10,
+                run_config=RunConfig(
+                    model_provider=CUSTOM_MODEL_PROVIDER,
+                    model_settings=ModelSettings(include_usage=True),
+                ),
+                max_turns=AGENT_MAX_TURNS,
             )
             complete_response = final_result_obj.final_output
         
         # 提取並清理最終輸出
         final_output = re.sub(r'<think>.*?</think>', '', complete_response, flags=re.DOTALL).strip()
+        answer = final_output
+        # 只快取完整的回答：提前停止或降級（翻譯以外）時的回答不快取
+        answer_complete = bool(answer) and not stop_notice and not (
+            request_deadline and request_deadline.degradations)
         
         # ============ 步驟 3: 翻譯結果回原語言 ============
-        if original_language and original_language != "zh-TW" and not is_chinese:
-            emit_event("translating_output",
-                      message=f"正在將結果翻譯回 {language_name}...")
-            
-            final_output = await translate_text(
-                final_output,
-                target_language=original_language,
-                source_language="zh-TW"
-            )
-            
-            emit_event("translation_complete",
-                      message="輸出翻譯完成")
+        translated = False
+        if needs_translation:
+            stage = "translate_output"
+            final_output, translated = await _translate_output(final_output, original_language, language_name)
         
-        # 發送最終結果
-        emit_event("final_result", 
-                  final_output=final_output,
-                  user_input=user_input,
-                  original_language=original_language,
-                  status="success")
+        if use_answer_cache and answer_complete:
+            await store_cached_answer(translated_input, answer, original_language,
+                                      final_output if translated else None)
         
-        return {
-            "type": "final_result",
-            "final_output": final_output,
-            "user_input": user_input,
-            "original_language": original_language,
-            "status": "success"
-        }
+        # 發送最終結果
+        status = "success"
+        return _final_result(final_output, user_input, original_language, tracer, ledger, request_deadline,
+                             agent_usage=stream_result.context_wrapper.usage)
         
+    except asyncio.CancelledError as e:
+        # 用戶離開或請求逾時：停止 Agent 背景執行，中斷進行中的 LLM、檢索與 OCR 呼叫
+        status = "cancelled"
+        report = _cancellation_report(tracer, ledger, stage, is_chinese, time.time() - request_start)
+        if stream_result is not None and not stream_result.is_complete:
+            stream_result.cancel()
+            if stream_result.run_loop_task is not None:
+                await asyncio.wait([stream_result.run_loop_task], timeout=2)
+        if agent_span:
+            agent_span.end(error=e)
+        emit_event("cancelled",
+                  message="請求已取消，停止後續處理",
+                  reason=e.args[0] if e.args else None,
+                  **report)
+        raise
     except Exception as e:
         emit_event("error", 
                   error=str(e),
@@ -868,19 +1322,79 @@ async def process_user_input(user_input: str, chat_history: list = None):
             "type": "error",
             "error": str(e),
             "user_input": user_input,
-            "status": "error"
+            "status": "error",
+            "token_usage": ledger.summary(),
         }
     finally:
-        _stream_events = False
+        try:
+            trace_stack.close()
+        finally:
+            if stream_events:
+                _stream_events = False
+        # 用量紀錄只是輔助，寫入失敗（磁碟已滿、目錄無權限 ...）不能取代請求結果
+        if TOKEN_USAGE_LOG:
+            try:
+                ledger.append_log(TOKEN_USAGE_LOG, status=status, user_input=user_input,
+                                  history_length=len(chat_history))
+            except OSError as e:
+                print(f"用量紀錄寫入失敗（{request_id}）：{e}", file=sys.stderr, flush=True)
+
+async def _run_cancellable(coro):
+    """
+    執行 coro，收到 SIGTERM / SIGINT 時取消它
+
+    Node 端在用戶關閉頁面或請求逾時時送出 SIGTERM；取消會傳遞到 Agent、LLM、
+    檢索與 OCR 呼叫，結束後以 128 + 訊號編號的結束碼離開。
+    """
+    task = asyncio.ensure_future(coro)
+    loop = asyncio.get_running_loop()
+    received = []
+
+    def on_signal(sig: signal.Signals):
+        received.append(sig)
+        task.cancel(sig.name)
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, on_signal, sig)
+        except (NotImplementedError, RuntimeError):
+            # Windows 的事件迴圈不支援訊號處理
+            pass
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if not received:
+            raise
+        sys.exit(128 + received[0])
 
 async def cli_main():
     """命令列介面主函數"""
     parser = argparse.ArgumentParser(description='產品分析 Agent CLI')
-    parser.add_argument('--input', required=True, help='用戶輸入內容')
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--input', help='用戶輸入內容')
+    mode.add_argument('--batch', help='批次模式：JSONL 輸入檔路徑，- 表示 stdin')
     parser.add_argument('--history', type=str, default='[]', help='對話歷史 (JSON 格式)')
+    parser.add_argument('--output', help='批次模式：結果輸出檔（預設 stdout）')
+    parser.add_argument('--concurrency', type=int, default=4, help='批次模式：同時處理的查詢數')
+    parser.add_argument('--order', choices=['input', 'completion'], default='input',
+                        help='批次模式：依輸入順序或完成順序輸出')
+    parser.add_argument('--checkpoint', help='批次模式：檢查點檔案，重跑時略過已完成的查詢')
+    parser.add_argument('--profile', action='store_true', default=None,
+                        help='輸出此次執行的 CPU 取樣與記憶體配置分析')
+    parser.add_argument('--token-budget', type=int, default=None,
+                        help='每次查詢的 token 上限（預設依 AGENT_TOKEN_BUDGET，0 表示不限制）')
+    parser.add_argument('--deadline', type=float, default=None,
+                        help='每次查詢的時限秒數，時間不足時逐步降級（預設依 AGENT_DEADLINE_SECONDS，0 表示不設期限）')
+    parser.add_argument('--deadline-at', type=float, default=None,
+                        help='單筆模式：期限的絕對時間（epoch 秒），由請求抵達時間加上 --deadline，程序啟動時間也計入')
     
     args = parser.parse_args()
     
+    if args.batch:
+        process_fn = partial(process_user_input, token_budget=args.token_budget, deadline=args.deadline)
+        await _run_cancellable(batch_main(process_fn, args, scheduler=LLM_SCHEDULER))
+        return
+    
     # 解析歷史記錄
     try:
         chat_history = json.loads(args.history) if args.history else []
@@ -893,7 +1407,9 @@ async def cli_main():
     
     try:
         # 使用統一的處理函數
-        await process_user_input(args.input, chat_history=chat_history)
+        await _run_cancellable(process_user_input(args.input, chat_history=chat_history, profile=args.profile,
+                                                  token_budget=args.token_budget, deadline=args.deadline,
+                                                  deadline_at=args.deadline_at))
         
     except Exception as e:
         error_result = {
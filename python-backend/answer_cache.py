@@ -0,0 +1,327 @@
+"""
+語意答案快取
+
+相同意思的問題（「B-50 規格」、「B50 的規格表是什麼」、「請給我 B-50 數據」）
+不必每次都重跑語言偵測、關鍵字、檢索與多輪 Agent。這裡以 sqlite 儲存
+完整的中文回答，鍵為正規化、翻譯成中文後的問題：
+
+- 正規化：全形轉半形、小寫、去除標點與客套詞，同義詞（數據、參數 ...）
+  統一為「規格」，型號另外取出
+- 型號守門：問題中的型號集合必須完全相同才可能命中，B-50 不會拿到 W-70
+  的答案；型號依 MODEL_MAPPING 統一寫法（GLM40 與 GL-40M 視為同一型號）
+- 用詞守門：產品類型與規格用詞（單段／雙段、輸入／輸出、現貨 ...）及是否
+  含否定詞也必須完全相同；字元 n-gram 分不出只差一個字的問題，
+  「單段蝸輪齒輪減速機」不會拿到「雙段蝸輪齒輪減速機」的答案
+- 數值守門：型號以外的數值與單位（30rpm、1HP、1:30）也必須完全相同，
+  只差轉速或減速比的問題不會拿到彼此的答案
+- 相似度：去除型號後的問題向量的餘弦相似度 ≥ ANSWER_CACHE_SIMILARITY；
+  預設以字元 n-gram 雜湊成向量，設定 ANSWER_CACHE_EMBEDDING_MODEL 時改用
+  embeddings API
+- 失效：知識庫快照（RAGFlow dataset 的更新時間與文件、chunk 數）改變時
+  清空全部答案；快照每 ANSWER_CACHE_KB_CHECK_INTERVAL 秒檢查一次，取不到
+  快照時不使用快取
+- 容量：最多 ANSWER_CACHE_MAX_ENTRIES 筆，超過時淘汰最久未使用的答案；
+  超過 ANSWER_CACHE_TTL 秒的答案不再使用
+
+Agent 每次請求都在獨立程序執行，因此快取與快照檢查時間都存在 sqlite，
+跨程序共用。
+"""
+from __future__ import annotations
+
+import json
+import math
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+import zlib
+from array import array
+from typing import Awaitable, Callable
+
+from dotenv import load_dotenv
+
+from model_resolver import normalize_model
+
+load_dotenv()
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "cache/answers.sqlite3")
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY") or 0.9)
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES") or 1000)
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL") or 7 * 86400)
+ANSWER_CACHE_KB_CHECK_INTERVAL = float(os.getenv("ANSWER_CACHE_KB_CHECK_INTERVAL") or 60)
+# 選填：以 embeddings API 計算問題向量；未設定時使用本機字元 n-gram
+ANSWER_CACHE_EMBEDDING_MODEL = os.getenv("ANSWER_CACHE_EMBEDDING_MODEL")
+
+NGRAM_DIMENSIONS = 256
+LOCAL_EMBEDDER = "char-ngram"
+
+# 型號：1-5 個英文字母、可有連字號、數字，後面可接英文字母（B-50、GLM40、GL-40M）
+_MODEL_PATTERN = re.compile(r'(?<![A-Z0-9])([A-Z]{1,5})-?(\d{1,4})([A-Z]*)(?![A-Z0-9])')
+# 同義詞統一寫法；較長的詞需排在前面
+_SYNONYMS = [
+    ("規格表", "規格"),
+    ("規格書", "規格"),
+    ("數據", "規格"),
+    ("資料", "規格"),
+    ("參數", "規格"),
+    ("規範", "規格"),
+]
+# 只差一個字就是不同問題的用詞，必須完全相同才可能命中（另可由呼叫端補充）
+GUARD_TERMS = [
+    "單段", "雙段", "三段", "法蘭", "中空", "立式", "臥式", "蝸輪", "齒輪", "斜齒", "行星", "馬達",
+    "輸入", "輸出", "馬力", "轉速", "扭矩", "減速比", "軸徑", "尺寸", "重量", "安裝",
+    "價格", "交期", "現貨", "保固", "型錄",
+]
+# 規格數值與單位（30rpm、1HP、1:30、1/2hp、0.75kw）；數值不同就是不同問題
+_SPEC_VALUE_PATTERN = re.compile(r'\d+(?:[.:/]\d+)*\s*[a-z%]*')
+# 否定詞：「有現貨」與「沒有現貨」意思相反
+_NEGATIONS = ["沒", "無", "不", "非", "未"]
+# 不影響問題意思的客套詞與虛詞；較長的詞需排在前面
+_FILLERS = [
+    "請問", "請幫我", "幫我", "幫忙", "麻煩", "請", "給我", "我想要", "我想", "我要", "我需要",
+    "查詢", "查一下", "一下", "提供", "相關", "是什麼", "有哪些", "的", "嗎", "呢", "吧",
+]
+
+# 結構變更時遞增，舊的快取檔會整個重建
+_SCHEMA_VERSION = 3
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    id INTEGER PRIMARY KEY,
+    guard TEXT NOT NULL,
+    question TEXT NOT NULL,
+    embedder TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    answer TEXT NOT NULL,
+    translations TEXT NOT NULL DEFAULT '{}',
+    kb_snapshot TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (guard, question, embedder)
+);
+CREATE INDEX IF NOT EXISTS answers_by_guard ON answers (guard, embedder, kb_snapshot);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+
+def extract_model_numbers(text: str, aliases: dict | None = None) -> list:
+    """取出問題中的型號，統一為不含分隔符號的大寫寫法並排序"""
+    models = set()
+    for match in _MODEL_PATTERN.finditer(unicodedata.normalize("NFKC", text).upper()):
+        model = "".join(match.groups())
+        if aliases:
+            model = aliases.get(model, model)
+        models.add(normalize_model(model))
+    return sorted(models)
+
+
+def extract_guard_terms(text: str, terms: list = GUARD_TERMS) -> list:
+    """取出問題中的產品類型與規格用詞；含否定詞時加上「!否定」"""
+    text = unicodedata.normalize("NFKC", text)
+    found = {term for term in terms if term in text}
+    if any(word in text for word in _NEGATIONS):
+        found.add("!否定")
+    return sorted(found)
+
+
+def extract_spec_values(text: str) -> list:
+    """取出問題中型號以外的數值與單位，去除空白、統一小寫並排序"""
+    text = _MODEL_PATTERN.sub(" ", unicodedata.normalize("NFKC", text).upper()).lower()
+    return sorted({re.sub(r'\s+', '', value) for value in _SPEC_VALUE_PATTERN.findall(text)})
+
+
+def normalize_question(text: str) -> str:
+    """去除型號、標點與客套詞，同義詞統一寫法"""
+    text = unicodedata.normalize("NFKC", text)
+    text = _MODEL_PATTERN.sub(" ", text.upper()).lower()
+    for word, canonical in _SYNONYMS:
+        text = text.replace(word, canonical)
+    for word in _FILLERS:
+        text = text.replace(word, "")
+    return re.sub(r'[\W_]+', '', text)
+
+
+def ngram_embedding(text: str) -> list:
+    """字元 unigram 與 bigram 雜湊成固定維度的單位向量"""
+    vector = [0.0] * NGRAM_DIMENSIONS
+    grams = list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+    for gram in grams:
+        vector[zlib.crc32(gram.encode("utf-8")) % NGRAM_DIMENSIONS] += 1.0
+    return _unit(vector)
+
+
+def _unit(vector: list) -> list:
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector] if norm else vector
+
+
+def _cosine(a: array, b: array) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+
+class AnswerCache:
+    """以 sqlite 儲存的語意答案快取"""
+
+    def __init__(self, path: str,
+                 kb_snapshot_fn: Callable[[], Awaitable[str | None]],
+                 model_aliases: dict | None = None,
+                 guard_terms: list | None = None,
+                 embed_fn: Callable[[str], Awaitable[list]] | None = None,
+                 embedder: str = LOCAL_EMBEDDER,
+                 similarity: float = ANSWER_CACHE_SIMILARITY,
+                 max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 ttl: float = ANSWER_CACHE_TTL,
+                 kb_check_interval: float = ANSWER_CACHE_KB_CHECK_INTERVAL):
+        self.path = path
+        self.kb_snapshot_fn = kb_snapshot_fn
+        self.model_aliases = {normalize_model(k): v for k, v in (model_aliases or {}).items()}
+        self.guard_terms = list(dict.fromkeys(GUARD_TERMS + list(guard_terms or [])))
+        self.embed_fn = embed_fn
+        self.embedder = embedder
+        self.similarity = similarity
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.kb_check_interval = kb_check_interval
+        self._db: sqlite3.Connection | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            if self._db.execute("PRAGMA user_version").fetchone()[0] != _SCHEMA_VERSION:
+                self._db.executescript("DROP TABLE IF EXISTS answers; DROP TABLE IF EXISTS meta;")
+                self._db.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+            self._db.executescript(_SCHEMA)
+        return self._db
+
+    def key(self, question: str) -> tuple:
+        """(守門鍵：型號、用詞與規格數值, 正規化問題)；守門鍵必須完全相同才比較相似度"""
+        models = extract_model_numbers(question, self.model_aliases)
+        terms = extract_guard_terms(question, self.guard_terms)
+        values = extract_spec_values(question)
+        return f"{','.join(models)}|{','.join(terms)}|{','.join(values)}", normalize_question(question)
+
+    async def _embed(self, text: str) -> array:
+        if self.embed_fn:
+            return array("f", _unit(list(await self.embed_fn(text))))
+        return array("f", ngram_embedding(text))
+
+    async def kb_snapshot(self) -> str | None:
+        """目前的知識庫快照；與上次不同時清空快取"""
+        db = self._connect()
+        meta = dict(db.execute("SELECT key, value FROM meta").fetchall())
+        now = time.time()
+        if now - float(meta.get("kb_checked_at", 0)) < self.kb_check_interval:
+            return meta.get("kb_snapshot")
+
+        snapshot = await self.kb_snapshot_fn()
+        if snapshot is None:
+            return None
+        with db:
+            if snapshot != meta.get("kb_snapshot"):
+                db.execute("DELETE FROM answers")
+            db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                           [("kb_snapshot", snapshot), ("kb_checked_at", str(now))])
+        return snapshot
+
+    async def lookup(self, question: str, language: str | None = None) -> dict | None:
+        """
+        找出意思相同、型號完全相同的已快取答案
+
+        Returns:
+            answer（中文回答）、translation（language 的已快取翻譯，沒有時為 None）、
+            similarity 等；沒有命中時為 None
+        """
+        snapshot = await self.kb_snapshot()
+        if snapshot is None:
+            return None
+        guard, normalized = self.key(question)
+        db = self._connect()
+        rows = db.execute(
+            "SELECT id, question, embedding, answer, translations, created_at FROM answers "
+            "WHERE guard = ? AND embedder = ? AND kb_snapshot = ? AND created_at >= ?",
+            (guard, self.embedder, snapshot, time.time() - self.ttl),
+        ).fetchall()
+        if not rows:
+            return None
+
+        embedding = None
+        best, best_similarity = None, 0.0
+        for row in rows:
+            if row[1] == normalized:
+                best, best_similarity = row, 1.0
+                break
+            if embedding is None:
+                embedding = await self._embed(normalized)
+            stored = array("f")
+            stored.frombytes(row[2])
+            similarity = _cosine(embedding, stored)
+            if similarity > best_similarity:
+                best, best_similarity = row, similarity
+        if best is None or best_similarity < self.similarity:
+            return None
+
+        entry_id, cached_question, _, answer, translations, created_at = best
+        now = time.time()
+        with db:
+            db.execute("UPDATE answers SET last_used_at = ?, hits = hits + 1 WHERE id = ?", (now, entry_id))
+        return {
+            "id": entry_id,
+            "answer": answer,
+            "translation": json.loads(translations).get(language) if language else None,
+            "similarity": round(best_similarity, 4),
+            "guard": guard,
+            "cached_question": cached_question,
+            "age_seconds": round(now - created_at, 1),
+        }
+
+    async def store(self, question: str, answer: str) -> int | None:
+        """儲存完整的中文回答，超過容量時淘汰最久未使用的答案；回傳答案 ID"""
+        snapshot = await self.kb_snapshot()
+        if snapshot is None:
+            return None
+        guard, normalized = self.key(question)
+        embedding = await self._embed(normalized)
+        now = time.time()
+        db = self._connect()
+        with db:
+            entry_id = db.execute(
+                "INSERT OR REPLACE INTO answers (guard, question, embedder, embedding, answer, "
+                "kb_snapshot, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (guard, normalized, self.embedder, embedding.tobytes(), answer, snapshot, now, now),
+            ).lastrowid
+            db.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl,))
+            db.execute(
+                "DELETE FROM answers WHERE id NOT IN "
+                "(SELECT id FROM answers ORDER BY last_used_at DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+        return entry_id
+
+    def store_translation(self, entry_id: int, language: str, text: str):
+        """附加某個語言的翻譯，下次同語言命中時不必再翻譯"""
+        db = self._connect()
+        with db:
+            row = db.execute("SELECT translations FROM answers WHERE id = ?", (entry_id,)).fetchone()
+            if row is None:
+                return
+            translations = json.loads(row[0])
+            translations[language] = text
+            db.execute("UPDATE answers SET translations = ? WHERE id = ?",
+                       (json.dumps(translations, ensure_ascii=False), entry_id))
+
+    def stats(self) -> dict:
+        db = self._connect()
+        entries, hits = db.execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM answers").fetchone()
+        return {"entries": entries, "hits": hits, "max_entries": self.max_entries}
+
+    def clear(self):
+        db = self._connect()
+        with db:
+            db.execute("DELETE FROM answers")
+            db.execute("DELETE FROM meta")
@@ -0,0 +1,232 @@
+"""
+批次 JSONL 處理
+
+一次讀入多筆查詢（回歸測試、預先產生 FAQ 回答、重跑一天的客戶問題），
+在同一個程序內以限定的並行數執行，省去每筆查詢啟動一個程序的成本。
+
+輸入每行一筆 JSON：{"id": 選填, "input": "...", "history": [...] 選填}
+輸出每行一筆 JSON：{"index", "id", "input", "latency", "result"}
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+from typing import Awaitable, Callable, TextIO
+
+from llm_scheduler import PRIORITY_BACKGROUND, LLMScheduler, llm_priority
+
+
+def read_batch_records(source: TextIO) -> list:
+    """讀取 JSONL 輸入，略過空行；無法解析的行以錯誤紀錄保留位置"""
+    records = []
+    for index, line in enumerate(source):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            record = {"input": None, "error": f"無法解析 JSON：{e}"}
+        else:
+            if isinstance(record, str):
+                record = {"input": record}
+            elif not isinstance(record, dict):
+                record = {"input": None, "error": f"每行應為 JSON 物件或字串，收到 {type(record).__name__}"}
+            elif record.get("input") is not None and not isinstance(record["input"], str):
+                record = {**record, "input": None,
+                          "error": f"input 應為字串，收到 {type(record['input']).__name__}"}
+            elif record.get("history") is not None and not isinstance(record["history"], list):
+                record = {**record, "input": None,
+                          "error": f"history 應為陣列，收到 {type(record['history']).__name__}"}
+        record["_index"] = index
+        records.append(record)
+    return records
+
+
+def load_checkpoint(path: str | None) -> dict:
+    """讀取已完成的紀錄，key 為輸入的行號"""
+    completed = {}
+    if not path or not os.path.exists(path):
+        return completed
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # 中斷時寫到一半的最後一行
+                continue
+            completed[entry["index"]] = entry
+    return completed
+
+
+def percentile(values: list, pct: float) -> float:
+    """nearest-rank 百分位數"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def _result_tokens(result: dict) -> int:
+    # token_usage 含語言偵測、翻譯等 Agent 以外的呼叫；usage 只有 Agent 本身
+    usage = result.get("token_usage") or result.get("usage") or {}
+    return usage.get("total_tokens", 0) or 0
+
+
+async def run_batch(process_fn: Callable[..., Awaitable[dict]],
+                    records: list,
+                    output: TextIO,
+                    concurrency: int = 4,
+                    order: str = "input",
+                    checkpoint_path: str | None = None) -> dict:
+    """
+    以限定並行數批次執行查詢
+
+    Args:
+        process_fn: 處理單筆查詢的協程函數，簽名同 process_user_input
+        records: read_batch_records 的結果
+        output: 結果寫入的檔案物件
+        concurrency: 同時執行的查詢數
+        order: "input" 依輸入順序輸出，"completion" 依完成順序輸出
+        checkpoint_path: 檢查點檔案，已完成的紀錄在重跑時會略過
+
+    Returns:
+        吞吐量摘要
+    """
+    completed = load_checkpoint(checkpoint_path)
+    pending_records = [r for r in records if r["_index"] not in completed]
+    order_indexes = [r["_index"] for r in records]
+
+    checkpoint_file = open(checkpoint_path, "a", encoding="utf-8") if checkpoint_path else None
+    queue: asyncio.Queue = asyncio.Queue()
+    for record in pending_records:
+        queue.put_nowait(record)
+
+    ready: dict = {}
+    next_position = 0
+    latencies = []
+    tokens = 0
+    errors = 0
+
+    def write_entry(entry: dict):
+        output.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def flush_in_order():
+        nonlocal next_position
+        while next_position < len(order_indexes) and order_indexes[next_position] in ready:
+            write_entry(ready.pop(order_indexes[next_position]))
+            next_position += 1
+        output.flush()
+
+    # 先輸出檢查點中已完成的紀錄
+    for index, entry in completed.items():
+        if order == "input":
+            ready[index] = entry
+        else:
+            write_entry(entry)
+    if order == "input":
+        flush_in_order()
+
+    async def worker():
+        nonlocal tokens, errors
+        while True:
+            try:
+                record = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            start_ts = time.perf_counter()
+            if record.get("input"):
+                result = await process_fn(record["input"],
+                                          chat_history=record.get("history") or [],
+                                          stream_events=False)
+            else:
+                result = {"type": "error", "status": "error",
+                          "error": record.get("error", "缺少 input 欄位")}
+            latency = time.perf_counter() - start_ts
+
+            latencies.append(latency)
+            tokens += _result_tokens(result)
+            if result.get("status") != "success":
+                errors += 1
+
+            entry = {
+                "index": record["_index"],
+                "id": record.get("id", record["_index"]),
+                "input": record.get("input"),
+                "latency": round(latency, 3),
+                "result": result,
+            }
+            if checkpoint_file:
+                checkpoint_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                checkpoint_file.flush()
+
+            if order == "input":
+                ready[record["_index"]] = entry
+                flush_in_order()
+            else:
+                write_entry(entry)
+                output.flush()
+
+    start_ts = time.perf_counter()
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    finally:
+        if checkpoint_file:
+            checkpoint_file.close()
+    elapsed = time.perf_counter() - start_ts
+
+    return {
+        "type": "batch_summary",
+        "total": len(records),
+        "processed": len(latencies),
+        "skipped_from_checkpoint": len(completed),
+        "errors": errors,
+        "concurrency": concurrency,
+        "elapsed_seconds": round(elapsed, 3),
+        "queries_per_second": round(len(latencies) / elapsed, 3) if elapsed > 0 else 0.0,
+        "latency_p50": round(percentile(latencies, 50), 3),
+        "latency_p95": round(percentile(latencies, 95), 3),
+        "total_tokens": tokens,
+        "tokens_per_query": round(tokens / len(latencies), 1) if latencies else 0.0,
+    }
+
+
+async def batch_main(process_fn: Callable[..., Awaitable[dict]], args,
+                     scheduler: LLMScheduler | None = None) -> dict:
+    """cli_main 的批次模式進入點；批次查詢以背景優先權排程 LLM 呼叫"""
+    if args.batch == "-":
+        records = read_batch_records(sys.stdin)
+    else:
+        with open(args.batch, encoding="utf-8") as f:
+            records = read_batch_records(f)
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        with llm_priority(PRIORITY_BACKGROUND):
+            summary = await run_batch(
+                process_fn,
+                records,
+                output,
+                concurrency=args.concurrency,
+                order=args.order,
+                checkpoint_path=args.checkpoint,
+            )
+    finally:
+        if args.output:
+            output.close()
+    if scheduler:
+        summary["llm_scheduler"] = scheduler.metrics()
+
+    # 結果輸出到 stdout 時，摘要改寫到 stderr 以免混在結果中
+    summary_stream = sys.stderr if not args.output else sys.stdout
+    print(json.dumps(summary, ensure_ascii=False), file=summary_stream, flush=True)
+    return summary
@@ -0,0 +1,420 @@
+"""
+Agent 併發壓力與長時間穩定性（soak）測試
+
+以 Poisson 到達過程（open loop）持續送出查詢，到達率依 --rates 逐段提高，
+查詢內容依 --mix 的權重從基準測試的情境中抽選。預設在同一個程序內直接呼叫
+process_user_input，並啟動本機模擬後端；也可以用 --endpoint 對 Next.js 的
+/api/agent 送出請求（此時需自行讓伺服器指向模擬後端）。
+
+每隔 --sample-interval 秒記錄一筆時間序列：
+- 區間內完成數、吞吐量、p50 / p99 延遲、錯誤數、進行中的請求數
+- 程序 RSS、開啟的檔案描述元與 socket 數、執行緒數、
+  asyncio.to_thread 使用的預設 executor 執行緒數、_CACHE 筆數
+
+結束時輸出每段到達率的摘要、飽和點（吞吐量跟不上實際到達的請求、p99
+超過 SLO 或錯誤率過高的第一段），以及 RSS、執行緒、socket 與快取筆數隨時間的成長率。
+程序資源只在程序內模式量測；--endpoint 模式只量測延遲與吞吐量。
+
+用法：
+    python benchmarks/load_test.py --rates 2 5 10 20 --stage-duration 60
+    python benchmarks/load_test.py --rates 5 --stage-duration 14400   # 4 小時 soak
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import stat
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import asdict
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARK_DIR)
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, BACKEND_DIR)
+
+from batch_runner import percentile  # noqa: E402
+from mock_servers import MockBackendProcess, MockConfig  # noqa: E402
+from scenarios import SCENARIOS, write_label_image  # noqa: E402
+
+DEFAULT_MIX = "specific_model=4,vague_query=3,dont_know=1,non_chinese=1,image_upload=1"
+
+
+def parse_mix(text: str) -> dict:
+    """解析 "情境=權重,..." 格式的查詢組合"""
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"未知的情境：{name}（可用：{', '.join(SCENARIOS)}）")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def _rss_bytes() -> int | None:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # 沒有 /proc 時（macOS）只能取得峰值；macOS 的單位是 bytes，Linux 是 KiB
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _open_descriptors() -> tuple[int | None, int | None]:
+    """回傳 (開啟的檔案描述元數, 其中的 socket 數)"""
+    fd_dir = "/proc/self/fd" if os.path.isdir("/proc/self/fd") else "/dev/fd"
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return None, None
+    total = sockets = 0
+    for fd in fds:
+        try:
+            mode = os.fstat(int(fd)).st_mode
+        except (OSError, ValueError):
+            continue
+        total += 1
+        if stat.S_ISSOCK(mode):
+            sockets += 1
+    return total, sockets
+
+
+def sample_resources(agent_test=None) -> dict:
+    fds, sockets = _open_descriptors()
+    rss = _rss_bytes()
+    executor = getattr(asyncio.get_running_loop(), "_default_executor", None)
+    return {
+        "rss_mb": round(rss / 2**20, 1) if rss is not None else None,
+        "open_fds": fds,
+        "open_sockets": sockets,
+        "threads": threading.active_count(),
+        # asyncio.to_thread 使用的執行緒池
+        "executor_threads": len(getattr(executor, "_threads", ())) if executor else 0,
+        "cache_entries": len(agent_test._CACHE) if agent_test is not None else None,
+        "asyncio_tasks": len(asyncio.all_tasks()),
+    }
+
+
+def slope_per_hour(points: list) -> float | None:
+    """最小平方法斜率（每小時的變化量）"""
+    points = [(t, v) for t, v in points if v is not None]
+    if len(points) < 3:
+        return None
+    n = len(points)
+    mean_t = sum(t for t, _ in points) / n
+    mean_v = sum(v for _, v in points) / n
+    var_t = sum((t - mean_t) ** 2 for t, _ in points)
+    if var_t == 0:
+        return None
+    cov = sum((t - mean_t) * (v - mean_v) for t, v in points)
+    return round(cov / var_t * 3600, 3)
+
+
+class LoadRunner:
+    """依到達率送出查詢並收集結果"""
+
+    def __init__(self, send_fn, mix: dict, image_path: str, max_in_flight: int,
+                 sample_interval: float, agent_test=None, seed: int = 0):
+        self.send_fn = send_fn
+        self.mix = mix
+        self.image_path = image_path
+        self.max_in_flight = max_in_flight
+        self.sample_interval = sample_interval
+        self.agent_test = agent_test
+        self.rng = random.Random(seed)
+        self.records: list = []
+        self.timeline: list = []
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.stage_windows: dict = {}
+        self.start_ts = time.perf_counter()
+        self._tasks: set = set()
+
+    async def _one(self, stage: int, scenario_name: str):
+        scenario = SCENARIOS[scenario_name]
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        start_ts = time.perf_counter()
+        try:
+            status = await self.send_fn(scenario.render_input(self.image_path), list(scenario.history))
+        except Exception as e:
+            status = f"error: {type(e).__name__}"
+        finally:
+            self.in_flight -= 1
+        end_ts = time.perf_counter()
+        self.records.append({
+            "stage": stage,
+            "scenario": scenario_name,
+            "start": start_ts - self.start_ts,
+            "end": end_ts - self.start_ts,
+            "latency": end_ts - start_ts,
+            "status": status,
+        })
+
+    async def run_stage(self, stage: int, rate: float, duration: float):
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        next_arrival = time.perf_counter()
+        stage_end = next_arrival + duration
+        self.stage_windows[stage] = (next_arrival - self.start_ts, stage_end - self.start_ts)
+        while True:
+            next_arrival += self.rng.expovariate(rate)
+            if next_arrival >= stage_end:
+                break
+            await asyncio.sleep(max(0.0, next_arrival - time.perf_counter()))
+            scenario_name = self.rng.choices(names, weights)[0]
+            if self.in_flight >= self.max_in_flight:
+                # 進行中的請求已達上限，視為拒絕服務
+                now = time.perf_counter() - self.start_ts
+                self.records.append({"stage": stage, "scenario": scenario_name, "start": now,
+                                     "end": now, "latency": 0.0, "status": "rejected"})
+                continue
+            task = asyncio.create_task(self._one(stage, scenario_name))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        await asyncio.sleep(max(0.0, stage_end - time.perf_counter()))
+
+    async def drain(self, timeout: float):
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=timeout)
+
+    async def sample_loop(self, stage_ref: list):
+        last_ts = 0.0
+        position = 0
+        while True:
+            await asyncio.sleep(self.sample_interval)
+            now = time.perf_counter() - self.start_ts
+            # records 依完成時間附加，只需看上次取樣之後的新紀錄
+            new_records, position = self.records[position:], len(self.records)
+            window = [r for r in new_records if r["status"] != "rejected"]
+            latencies = [r["latency"] for r in window]
+            self.timeline.append({
+                "t": round(now, 2),
+                "stage": stage_ref[0],
+                "completed": len(window),
+                "throughput": round(len(window) / (now - last_ts), 3),
+                "latency_p50": round(percentile(latencies, 50), 3),
+                "latency_p99": round(percentile(latencies, 99), 3),
+                "errors": sum(r["status"] != "success" for r in window),
+                "in_flight": self.in_flight,
+                **(sample_resources(self.agent_test) if self.agent_test is not None else {}),
+            })
+            last_ts = now
+
+
+def summarize_stage(records: list, stage: int, rate: float, window: tuple, slo: float) -> dict:
+    stage_records = [r for r in records if r["stage"] == stage]
+    window_start, window_end = window
+    duration = window_end - window_start
+    # 吞吐量以此段期間內完成的請求計算（含前一段遺留的請求），跟不上到達率時會低於 offered_rate
+    finished_in_window = sum(window_start <= r["end"] < window_end
+                             for r in records if r["status"] != "rejected")
+    served = [r for r in stage_records if r["status"] != "rejected"]
+    latencies = [r["latency"] for r in served]
+    errors = sum(r["status"] != "success" for r in stage_records)
+    # Poisson 到達數在短時間內與 offered_rate 差距可能很大，以實際到達數比較；
+    # 段末 p50 延遲內才到達的請求本來就來不及在此段完成，不計入應完成數。
+    # 嚴重飽和時 p50 是排隊時間，最多只扣半段，避免應完成數變成 0
+    allowance = min(percentile(latencies, 50), duration / 2)
+    due = sum(r["start"] < window_end - allowance for r in stage_records)
+    return {
+        "offered_rate": rate,
+        "duration": round(duration, 2),
+        "requests": len(stage_records),
+        "arrival_rate": round(len(stage_records) / duration, 3) if duration > 0 else 0.0,
+        "due_rate": round(due / duration, 3) if duration > 0 else 0.0,
+        "completed": len(served),
+        "rejected": len(stage_records) - len(served),
+        "errors": errors,
+        "error_rate": round(errors / len(stage_records), 4) if stage_records else 0.0,
+        "throughput": round(finished_in_window / duration, 3) if duration > 0 else 0.0,
+        "latency_p50": round(percentile(latencies, 50), 3),
+        "latency_p99": round(percentile(latencies, 99), 3),
+        "latency_max": round(max(latencies), 3) if latencies else 0.0,
+        "meets_slo": percentile(latencies, 99) <= slo if latencies else False,
+    }
+
+
+def find_saturation(stages: list, max_error_rate: float) -> dict | None:
+    """第一個無法承受的到達率，以及它之前最後一個可承受的到達率"""
+    sustainable = None
+    for stage in stages:
+        reasons = []
+        if stage["throughput"] < 0.9 * stage["due_rate"]:
+            reasons.append("throughput")
+        if not stage["meets_slo"]:
+            reasons.append("latency_p99")
+        if stage["error_rate"] > max_error_rate:
+            reasons.append("errors")
+        if reasons:
+            return {"saturated_at_rate": stage["offered_rate"],
+                    "max_sustainable_rate": sustainable,
+                    "reasons": reasons}
+        sustainable = stage["offered_rate"]
+    return None
+
+
+def resource_trends(timeline: list) -> dict:
+    """資源用量的成長率；略過前 10% 的暖身期"""
+    skip = len(timeline) // 10
+    points = timeline[skip:]
+    trends = {}
+    for key in ("rss_mb", "open_sockets", "threads", "executor_threads", "cache_entries"):
+        if not points or key not in points[0]:
+            continue
+        trends[key] = {
+            "start": points[0][key],
+            "end": points[-1][key],
+            "max": max((p[key] for p in points if p[key] is not None), default=None),
+            "per_hour": slope_per_hour([(p["t"], p[key]) for p in points]),
+        }
+    return trends
+
+
+def make_endpoint_sender(url: str, cookie: str | None, timeout: float):
+    import httpx
+
+    headers = {"Cookie": cookie} if cookie else {}
+    client = httpx.AsyncClient(headers=headers, timeout=timeout,
+                               limits=httpx.Limits(max_connections=None))
+
+    async def send(user_input: str, history: list) -> str:
+        status = "error: no final_result"
+        async with client.stream("POST", url, json={"input": user_input, "history": history}) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                try:
+                    event = json.loads(line[len("data: "):])
+                except json.JSONDecodeError:
+                    continue
+                if event.get("type") == "final_result":
+                    status = event.get("status", "success")
+                elif event.get("type") == "error":
+                    status = "error"
+        return status
+
+    return send, client
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Agent 併發壓力與 soak 測試")
+    parser.add_argument("--rates", type=float, nargs="+", default=[1, 2, 5, 10],
+                        help="各段的到達率（每秒請求數），依序執行")
+    parser.add_argument("--stage-duration", type=float, default=60, help="每段持續秒數")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"情境權重，預設 {DEFAULT_MIX}")
+    parser.add_argument("--sample-interval", type=float, default=5, help="時間序列取樣間隔（秒）")
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="進行中請求上限，超過時拒絕")
+    parser.add_argument("--slo", type=float, default=30, help="p99 延遲上限（秒），超過視為飽和")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="可接受的錯誤率")
+    parser.add_argument("--drain-timeout", type=float, default=120, help="最後一段結束後等待進行中請求的秒數")
+    parser.add_argument("--mock-config", default="{}", help="MockConfig 欄位（JSON）")
+    parser.add_argument("--endpoint", help="改為對此 URL（例如 http://localhost:3000/api/agent）送出請求")
+    parser.add_argument("--cookie", help="--endpoint 模式的登入 Cookie")
+    parser.add_argument("--answer-cache", action="store_true",
+                        help="啟用答案快取（使用暫存的快取檔），量測重複問題命中時的負載")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果檔路徑，預設 benchmarks/results/load-<時間>.json")
+    args = parser.parse_args()
+
+    mock = None
+    client = None
+    agent_test = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_path = write_label_image(tmp_dir)
+        if args.endpoint:
+            send_fn, client = make_endpoint_sender(args.endpoint, args.cookie, timeout=args.slo * 10)
+        else:
+            mock = MockBackendProcess(MockConfig(**json.loads(args.mock_config))).start()
+            os.environ.update(mock.env())
+            os.environ.pop("TRACE_EXPORT_PATH", None)
+            os.environ["AGENT_PROFILE"] = "0"
+            os.environ["ANSWER_CACHE_ENABLED"] = "true" if args.answer_cache else "false"
+            os.environ["ANSWER_CACHE_PATH"] = os.path.join(tmp_dir, "answers.sqlite3")
+            os.environ["AGENT_CACHE_PATH"] = os.path.join(tmp_dir, "tools.sqlite3")
+            os.environ["LLM_SCHEDULER_STATE_PATH"] = os.path.join(tmp_dir, "llm_scheduler.sqlite3")
+            os.chdir(BACKEND_DIR)
+            import agent_test
+
+            async def send_fn(user_input: str, history: list) -> str:
+                result = await agent_test.process_user_input(
+                    user_input, chat_history=history, stream_events=False)
+                return result.get("status", "error")
+
+        runner = LoadRunner(send_fn, args.mix, image_path, args.max_in_flight,
+                            args.sample_interval, agent_test=agent_test, seed=args.seed)
+        stage_ref = [0]
+        sampler = asyncio.create_task(runner.sample_loop(stage_ref))
+        try:
+            for stage, rate in enumerate(args.rates):
+                stage_ref[0] = stage
+                print(f"到達率 {rate}/s，持續 {args.stage_duration:.0f} 秒 ...", file=sys.stderr, flush=True)
+                await runner.run_stage(stage, rate, args.stage_duration)
+            await runner.drain(args.drain_timeout)
+        finally:
+            sampler.cancel()
+            if client is not None:
+                await client.aclose()
+            if mock is not None:
+                mock_stats = mock.stats()
+                mock.stop()
+
+    stages = [summarize_stage(runner.records, i, rate, runner.stage_windows[i], args.slo)
+              for i, rate in enumerate(args.rates)]
+    results = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "target": args.endpoint or "in-process",
+        "mix": args.mix,
+        "mock_config": asdict(mock.config) if mock else None,
+        "stages": stages,
+        "saturation": find_saturation(stages, args.max_error_rate),
+        "peak_in_flight": runner.peak_in_flight,
+        "unfinished": runner.in_flight,
+        "resource_trends": resource_trends(runner.timeline),
+        "timeline": runner.timeline,
+    }
+    if agent_test is not None:
+        results["llm_scheduler"] = agent_test.LLM_SCHEDULER.metrics()
+        results["mock_calls"] = mock_stats["calls"]
+
+    output_path = args.output or os.path.join(
+        RESULTS_DIR, "load-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    header = f"{'rate/s':>8}{'arr/s':>8}{'done':>7}{'err':>6}{'tput/s':>9}{'p50(s)':>9}{'p99(s)':>9}"
+    print(header)
+    print("-" * len(header))
+    for s in stages:
+        print(f"{s['offered_rate']:>8.1f}{s['arrival_rate']:>8.2f}{s['completed']:>7}{s['errors']:>6}{s['throughput']:>9.2f}"
+              f"{s['latency_p50']:>9.3f}{s['latency_p99']:>9.3f}")
+    saturation = results["saturation"]
+    if saturation:
+        print(f"\n飽和點：{saturation['saturated_at_rate']}/s（{', '.join(saturation['reasons'])}），"
+              f"可承受的最高到達率：{saturation['max_sustainable_rate']}")
+    else:
+        print("\n所有到達率皆未飽和")
+    for key, trend in results["resource_trends"].items():
+        print(f"  {key:<18}{trend['start']!s:>10} -> {trend['end']!s:<10} 每小時 {trend['per_hour']}")
+    print(f"\n結果已儲存：{os.path.relpath(output_path)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,570 @@
+"""
+本機模擬後端：OpenAI 相容 Chat API、RAGFlow 檢索與 Ollama 視覺模型
+
+回應完全由請求內容決定（沒有隨機性），延遲與回應大小可設定，讓基準測試
+與壓力測試可以重現。所有端點共用同一個 port，並記錄呼叫次數與 token 用量。
+
+控制端點：
+- GET  /__mock/stats   呼叫統計
+- POST /__mock/reset   清除統計
+- POST /__mock/unload  卸載 Ollama 模型（模擬冷啟動）
+- POST /__mock/touch_kb 更新知識庫時間戳記（模擬知識庫異動）
+
+可在程序內啟動（MockBackend），或以子程序啟動（MockBackendProcess），
+後者不會把模擬後端的 CPU 時間算進被測程序。
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class MockConfig:
+    """模擬後端的延遲與回應大小設定"""
+    llm_latency: float = 0.05  # 每次 chat completion 的首字延遲（秒）
+    llm_token_interval: float = 0.0  # 串流時每個片段間隔（秒）
+    answer_chars: int = 600  # 最終回答的長度
+    ragflow_latency: float = 0.05
+    ragflow_chunks: int = 8
+    ragflow_chunk_chars: int = 400
+    ollama_latency: float = 0.2
+    ollama_load_latency: float = 1.0  # 模型未載入時的冷啟動時間
+    ocr_text: str = "TYPE GLM4O"
+    llm_max_concurrent: int = 0  # 超過此並行數回傳 429（0 表示不限）
+    llm_retry_after: float = 0.2
+
+
+@dataclass
+class MockStats:
+    """呼叫統計（執行緒安全）"""
+    calls: dict = field(default_factory=dict)
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, endpoint: str, prompt_tokens: int = 0, completion_tokens: int = 0):
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+
+
+def _estimate_tokens(text: str) -> int:
+    # 粗估：中文約一字一 token，英文約四字元一 token
+    cjk = len(re.findall(r"[一-鿿]", text))
+    return cjk + max(1, (len(text) - cjk) // 4)
+
+
+_IMAGE_PATH_PATTERN = re.compile(r"(\S+\.(?:jpg|jpeg|png))", re.IGNORECASE)
+_MODEL_PATTERN = re.compile(r"\b([A-Z]{1,4}-?\d{1,4}[A-Z]*)\b")
+_UNCERTAIN_WORDS = ["不知道", "不清楚", "沒有特定", "隨便", "不確定"]
+
+
+def _message_text(message: dict) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return str(content)
+
+
+def _is_cjk(text: str) -> bool:
+    return bool(re.search(r"[一-鿿]", text))
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    server_version = "MockBackend/1.0"
+    protocol_version = "HTTP/1.1"
+
+    # 由 MockBackend 設定
+    config: MockConfig
+    stats: MockStats
+    state: dict
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        return json.loads(body or b"{}")
+
+    def _send_json(self, payload: dict, status: int = 200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/__mock/stats"):
+            self._send_json(self.stats.snapshot())
+        elif self.path.startswith("/api/ps"):
+            models = [{"name": name, "model": name} for name in self.state["loaded_models"]]
+            self._send_json({"models": models})
+        elif self.path.startswith("/api/v1/datasets"):
+            self.stats.record("ragflow_datasets")
+            self._send_json({"code": 0, "data": [{
+                "id": "mock-kb",
+                "document_count": 10,
+                "chunk_count": 100,
+                "update_time": self.state["kb_update_time"],
+            }]})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        try:
+            payload = self._read_json()
+        except ValueError:
+            self._send_json({"error": "invalid json"}, status=400)
+            return
+
+        if self.path.startswith("/__mock/"):
+            self._control(self.path[len("/__mock/"):])
+        elif self.path.endswith("/chat/completions"):
+            self._chat_completions(payload)
+        elif self.path.endswith("/embeddings"):
+            self._embeddings(payload)
+        elif self.path.startswith("/api/v1/retrieval"):
+            self._retrieval(payload)
+        elif self.path.startswith("/api/generate") or self.path.startswith("/api/chat"):
+            self._ollama(payload)
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def _control(self, action: str):
+        if action == "reset":
+            self.stats.reset()
+        elif action == "unload":
+            self.state["loaded_models"].clear()
+        elif action == "touch_kb":
+            self.state["kb_update_time"] += 1
+        else:
+            self._send_json({"error": f"unknown action {action}"}, status=404)
+            return
+        self._send_json({"ok": True})
+
+    # ---------- OpenAI 相容 Chat API ----------
+
+    def _chat_completions(self, payload: dict):
+        limit = self.config.llm_max_concurrent
+        with self.state["lock"]:
+            if limit and self.state["llm_in_flight"] >= limit:
+                throttled = True
+            else:
+                throttled = False
+                self.state["llm_in_flight"] += 1
+        if throttled:
+            self.stats.record("chat_completions_429")
+            body = json.dumps({"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}}).encode()
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("retry-after", str(self.config.llm_retry_after))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        try:
+            self._chat_completion_response(payload)
+        finally:
+            with self.state["lock"]:
+                self.state["llm_in_flight"] -= 1
+
+    def _chat_completion_response(self, payload: dict):
+        messages = payload.get("messages", [])
+        system = _message_text(messages[0]) if messages and messages[0].get("role") == "system" else ""
+        user_text = next((_message_text(m) for m in reversed(messages) if m.get("role") == "user"), "")
+        prompt_tokens = sum(_estimate_tokens(_message_text(m)) for m in messages)
+
+        time.sleep(self.config.llm_latency)
+
+        content, tool_call = None, None
+        if payload.get("tools"):
+            content, tool_call = self._agent_turn(messages, user_text)
+        elif "語言偵測" in system:
+            is_chinese = _is_cjk(user_text)
+            content = json.dumps({
+                "language_code": "zh-TW" if is_chinese else "en",
+                "language_name": "Traditional Chinese" if is_chinese else "English",
+                "is_chinese": is_chinese,
+            })
+        elif "翻譯" in system:
+            target = system.split("翻譯成")[-1].split("。")[0].strip()
+            content = f"請幫我查詢：{user_text}" if target == "Traditional Chinese" else f"[{target}] {user_text}"
+        elif "查詢分析" in system:
+            content = json.dumps(self._keywords(user_text), ensure_ascii=False)
+        else:
+            content = "OK"
+
+        completion_text = content or json.dumps(tool_call or {})
+        completion_tokens = _estimate_tokens(completion_text)
+        self.stats.record("chat_completions", prompt_tokens, completion_tokens)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+
+        if payload.get("stream"):
+            include_usage = (payload.get("stream_options") or {}).get("include_usage")
+            self._stream_chat(payload, content, tool_call, usage if include_usage else None)
+            return
+
+        message = {"role": "assistant", "content": content}
+        finish_reason = "stop"
+        if tool_call:
+            message["tool_calls"] = [tool_call]
+            finish_reason = "tool_calls"
+        self._send_json({
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "mock"),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": usage,
+        })
+
+    def _keywords(self, text: str) -> dict:
+        models = _MODEL_PATTERN.findall(text.upper())
+        uncertain = any(word in text for word in _UNCERTAIN_WORDS)
+        specific = bool(models) or ("減速機" in text and len(text) > 8)
+        return {
+            "has_specific_query": specific and not uncertain,
+            "needs_overview": uncertain,
+            "model_numbers": models,
+            "product_types": ["雙段"] if "雙段" in text else [],
+            "specifications": [],
+            "search_query": " ".join(models) if models else ("減速機" if uncertain else text[:40]),
+            "needs_guidance": not specific and not uncertain,
+            "user_uncertainty": "high" if uncertain else "low",
+        }
+
+    def _agent_turn(self, messages: list, user_text: str):
+        """依目前對話狀態決定下一步：呼叫工具或給出最終回答"""
+        tool_results = {}
+        for m in messages:
+            if m.get("role") == "assistant":
+                for call in m.get("tool_calls") or []:
+                    tool_results[call["id"]] = {"name": call["function"]["name"], "output": None}
+            elif m.get("role") == "tool" and m.get("tool_call_id") in tool_results:
+                tool_results[m["tool_call_id"]]["output"] = _message_text(m)
+        called = {v["name"]: v["output"] for v in tool_results.values()}
+
+        image = _IMAGE_PATH_PATTERN.search(user_text)
+        if image and "extract_product_model" not in called:
+            return None, self._tool_call("extract_product_model", {"image_path": image.group(1)})
+        if "extract_query_keywords" not in called:
+            return None, self._tool_call("extract_query_keywords", {"user_query": user_text})
+
+        try:
+            keywords = json.loads(called["extract_query_keywords"] or "{}")
+        except ValueError:
+            keywords = {}
+        needs_retrieval = keywords.get("has_specific_query") or keywords.get("needs_overview") or image
+        if needs_retrieval and "retrieve_product_knowledge" not in called:
+            query = keywords.get("search_query") or user_text[:40]
+            return None, self._tool_call("retrieve_product_knowledge", {"query": query})
+
+        body = "根據知識庫資料整理如下。" + "規格說明" * max(1, self.config.answer_chars // 4)
+        if needs_retrieval:
+            body = "<table><tr><th>型號</th><th>規格</th></tr><tr><td>B-50</td><td>1/2HP</td></tr></table>" + body
+        else:
+            body = "為了幫您找到合適的減速機，請提供以下資訊：" + body
+        return f"<think>分析用戶需求</think>{body[:self.config.answer_chars]}", None
+
+    def _tool_call(self, name: str, arguments: dict) -> dict:
+        return {
+            "id": f"call_{uuid.uuid4().hex[:12]}",
+            "type": "function",
+            "function": {"name": name, "arguments": json.dumps(arguments, ensure_ascii=False)},
+        }
+
+    def _stream_chat(self, payload: dict, content: str | None, tool_call: dict | None, usage: dict | None):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        base = {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": payload.get("model", "mock"),
+        }
+
+        def send(choices: list, extra: dict | None = None):
+            chunk = {**base, "choices": choices, **(extra or {})}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            if tool_call:
+                send([{"index": 0, "delta": {"role": "assistant", "tool_calls": [{
+                    "index": 0,
+                    "id": tool_call["id"],
+                    "type": "function",
+                    "function": {"name": tool_call["function"]["name"], "arguments": ""},
+                }]}, "finish_reason": None}])
+                send([{"index": 0, "delta": {"tool_calls": [{
+                    "index": 0,
+                    "function": {"arguments": tool_call["function"]["arguments"]},
+                }]}, "finish_reason": None}])
+                send([{"index": 0, "delta": {}, "finish_reason": "tool_calls"}])
+            else:
+                text = content or ""
+                step = 40
+                for i in range(0, len(text), step):
+                    send([{"index": 0, "delta": {"content": text[i:i + step]}, "finish_reason": None}])
+                    if self.config.llm_token_interval:
+                        time.sleep(self.config.llm_token_interval)
+                send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if usage:
+                send([], {"usage": usage})
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _embeddings(self, payload: dict):
+        inputs = payload.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        self.stats.record("embeddings", sum(_estimate_tokens(t) for t in inputs))
+        data = []
+        for i, text in enumerate(inputs):
+            vector = [0.0] * 64
+            for ch in text:
+                vector[ord(ch) % 64] += 1.0
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        self._send_json({"object": "list", "data": data, "model": payload.get("model", "mock"),
+                         "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+    # ---------- RAGFlow ----------
+
+    def _retrieval(self, payload: dict):
+        time.sleep(self.config.ragflow_latency)
+        self.stats.record("ragflow_retrieval")
+        question = payload.get("question", "")
+        top_k = int(payload.get("top_k", self.config.ragflow_chunks))
+        chunks = []
+        for i in range(min(self.config.ragflow_chunks, top_k)):
+            filler = f"{question} 規格資料 第{i + 1}段。"
+            content = (filler * (self.config.ragflow_chunk_chars // max(1, len(filler)) + 1))[:self.config.ragflow_chunk_chars]
+            chunks.append({
+                "content": content,
+                "document_keyword": f"catalog_{i + 1}.pdf",
+                "similarity": round(0.9 - i * 0.05, 3),
+            })
+        self._send_json({"code": 0, "data": {"chunks": chunks, "total": len(chunks)}})
+
+    # ---------- Ollama ----------
+
+    def _ollama(self, payload: dict):
+        model = payload.get("model", "")
+        cold = model not in self.state["loaded_models"]
+        load_seconds = self.config.ollama_load_latency if cold else 0.0
+        if cold:
+            time.sleep(load_seconds)
+            self.state["loaded_models"].add(model)
+
+        has_prompt = bool(payload.get("prompt") or payload.get("messages"))
+        if has_prompt:
+            time.sleep(self.config.ollama_latency)
+            self.stats.record("ollama_inference")
+        else:
+            self.stats.record("ollama_load")
+
+        text = self.config.ocr_text if has_prompt else ""
+        response = {
+            "model": model,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "done": True,
+            "done_reason": "stop" if has_prompt else "load",
+            "load_duration": int(load_seconds * 1_000_000_000),
+            "total_duration": int((load_seconds + (self.config.ollama_latency if has_prompt else 0)) * 1_000_000_000),
+            "prompt_eval_count": 10,
+            "eval_count": 5,
+        }
+        if self.path.startswith("/api/chat"):
+            response["message"] = {"role": "assistant", "content": text}
+        else:
+            response["response"] = text
+        self._send_json(response)
+
+
+class _MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客戶端取消請求（中斷連線）是預期中的情況，不輸出堆疊
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+class MockBackend:
+    """在背景執行緒啟動模擬後端，所有端點共用同一個 port"""
+
+    def __init__(self, config: MockConfig | None = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or MockConfig()
+        self.stats = MockStats()
+        self.state = {
+            "loaded_models": set(),
+            "kb_update_time": int(time.time()),
+            "llm_in_flight": 0,
+            "lock": threading.Lock(),
+        }
+        handler = type("Handler", (_MockHandler,), {
+            "config": self.config,
+            "stats": self.stats,
+            "state": self.state,
+        })
+        self._server = _MockServer((host, port), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"{host}:{port}"
+
+    def env(self) -> dict:
+        """指向此模擬後端的環境變數"""
+        return mock_env(self.address)
+
+    def unload_models(self):
+        self.state["loaded_models"].clear()
+
+    def touch_kb(self):
+        """模擬知識庫更新"""
+        self.state["kb_update_time"] += 1
+
+    def start(self) -> "MockBackend":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "MockBackend":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def mock_env(address: str) -> dict:
+    """指向模擬後端的環境變數"""
+    return {
+        "OPENAI_BASE_URL": f"http://{address}/v1",
+        "OPENAI_API_KEY": "mock-key",
+        "OPENAI_MODEL_NAME": "mock-model",
+        "RAGFLOW_BASE_URL": f"http://{address}",
+        "RAGFLOW_API_KEY": "mock-key",
+        "RAGFLOW_KB_ID": "mock-kb",
+        "OLLAMA_HOST": address,
+        # 不要在啟動時連網下載 litellm 的模型價格表
+        "LITELLM_LOCAL_MODEL_COST_MAP": "True",
+    }
+
+
+class MockBackendProcess:
+    """以子程序啟動模擬後端，透過控制端點讀取統計"""
+
+    def __init__(self, config: MockConfig | None = None, host: str = "127.0.0.1"):
+        self.config = config or MockConfig()
+        self.host = host
+        self.address: str | None = None
+        self._process: subprocess.Popen | None = None
+
+    def start(self) -> "MockBackendProcess":
+        self._process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--host", self.host, "--port", "0",
+             "--config", json.dumps(asdict(self.config))],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        # 子程序啟動後在第一行輸出實際的位址
+        ready = json.loads(self._process.stdout.readline())
+        self.address = ready["address"]
+        return self
+
+    def env(self) -> dict:
+        return mock_env(self.address)
+
+    def _request(self, method: str, path: str) -> dict:
+        request = urllib.request.Request(f"http://{self.address}{path}", method=method,
+                                         data=b"{}" if method == "POST" else None)
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.loads(response.read())
+
+    def stats(self) -> dict:
+        return self._request("GET", "/__mock/stats")
+
+    def reset(self):
+        self._request("POST", "/__mock/reset")
+
+    def unload_models(self):
+        self._request("POST", "/__mock/unload")
+
+    def touch_kb(self):
+        self._request("POST", "/__mock/touch_kb")
+
+    def stop(self):
+        if self._process:
+            self._process.terminate()
+            self._process.wait(timeout=10)
+
+    def __enter__(self) -> "MockBackendProcess":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本機模擬 OpenAI / RAGFlow / Ollama 後端")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--config", default="{}", help="MockConfig 欄位（JSON）")
+    args = parser.parse_args()
+
+    backend = MockBackend(MockConfig(**json.loads(args.config)), host=args.host, port=args.port)
+    print(json.dumps({"address": backend.address}), flush=True)
+    try:
+        backend._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
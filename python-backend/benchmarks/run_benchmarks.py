@@ -0,0 +1,271 @@
+"""
+Agent 基準測試
+
+以本機模擬後端（mock_servers.py）取代 OpenAI、RAGFlow 與 Ollama，對每個情境
+重複執行 process_user_input，量測：
+- 端到端延遲（p50 / p95 / 平均）
+- 每次請求的 LLM 呼叫數、token 數、檢索與 OCR 次數
+- 被測程序的 CPU 時間（模擬後端在子程序執行，不計入）
+
+結果存到 benchmarks/results/<時間>.json，並可與先前的結果比較，超過門檻時
+標示為退化（--fail-on-regression 時以非零結束碼結束，可放進 CI）。
+
+用法：
+    python benchmarks/run_benchmarks.py --iterations 5
+    python benchmarks/run_benchmarks.py --compare latest --fail-on-regression
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARK_DIR)
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, BACKEND_DIR)
+
+from batch_runner import percentile  # noqa: E402
+from mock_servers import MockBackendProcess, MockConfig  # noqa: E402
+from scenarios import SCENARIOS, write_label_image  # noqa: E402
+
+# 比較時檢查的指標；數值越大越差
+COMPARED_METRICS = [
+    "latency_p50",
+    "latency_p95",
+    "cpu_seconds_mean",
+    "llm_calls_mean",
+    "total_tokens_mean",
+]
+# 差距小於此值時不算退化，避免極短延遲的雜訊
+ABSOLUTE_TOLERANCE = {
+    "latency_p50": 0.05,
+    "latency_p95": 0.05,
+    "cpu_seconds_mean": 0.02,
+    "llm_calls_mean": 0.0,
+    "total_tokens_mean": 0.0,
+}
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BACKEND_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(samples: list) -> dict:
+    latencies = [s["latency"] for s in samples]
+
+    def mean(key: str) -> float:
+        return round(statistics.fmean(s[key] for s in samples), 4)
+
+    return {
+        "runs": len(samples),
+        "success_rate": round(sum(s["status"] == "success" for s in samples) / len(samples), 3),
+        "latency_p50": round(percentile(latencies, 50), 4),
+        "latency_p95": round(percentile(latencies, 95), 4),
+        "latency_mean": round(statistics.fmean(latencies), 4),
+        "cpu_seconds_mean": mean("cpu_seconds"),
+        "llm_calls_mean": mean("llm_calls"),
+        "agent_turns_mean": mean("agent_turns"),
+        "ragflow_calls_mean": mean("ragflow_calls"),
+        "ocr_calls_mean": mean("ocr_calls"),
+        "prompt_tokens_mean": mean("prompt_tokens"),
+        "completion_tokens_mean": mean("completion_tokens"),
+        "total_tokens_mean": mean("total_tokens"),
+    }
+
+
+async def run_scenario(agent_test, mock: MockBackendProcess, scenario, image_path: str,
+                       iterations: int, warmup: int, warm_cache: bool) -> dict:
+    user_input = scenario.render_input(image_path)
+    samples = []
+    for i in range(warmup + iterations):
+        if not warm_cache:
+            agent_test._CACHE.clear()
+        if scenario.needs_image:
+            # 每次都量測冷啟動，與實際「閒置後上傳圖片」的情況一致
+            mock.unload_models()
+        mock.reset()
+
+        cpu_start = time.process_time()
+        start_ts = time.perf_counter()
+        result = await agent_test.process_user_input(
+            user_input, chat_history=list(scenario.history), stream_events=False)
+        latency = time.perf_counter() - start_ts
+        cpu_seconds = time.process_time() - cpu_start
+
+        if i < warmup:
+            continue
+        stats = mock.stats()
+        calls = stats["calls"]
+        usage = result.get("usage") or {}
+        breakdown = result.get("latency_breakdown") or {}
+        samples.append({
+            "status": result.get("status", "error"),
+            "latency": latency,
+            "cpu_seconds": cpu_seconds,
+            "llm_calls": calls.get("chat_completions", 0),
+            "agent_turns": (breakdown.get("agent") or {}).get("turns", 0),
+            "ragflow_calls": calls.get("ragflow_retrieval", 0),
+            "ocr_calls": calls.get("ollama_inference", 0),
+            # 以模擬後端的計數為準，涵蓋 Agent 以外的語言偵測、翻譯與關鍵字呼叫
+            "prompt_tokens": stats["prompt_tokens"],
+            "completion_tokens": stats["completion_tokens"],
+            "total_tokens": stats["prompt_tokens"] + stats["completion_tokens"],
+            "agent_total_tokens": usage.get("total_tokens", 0),
+        })
+
+    return {
+        "description": scenario.description,
+        "input": user_input,
+        "summary": summarize(samples),
+        "samples": [{k: round(v, 4) if isinstance(v, float) else v for k, v in s.items()}
+                    for s in samples],
+    }
+
+
+def resolve_baseline(path: str | None) -> str | None:
+    if path != "latest":
+        return path
+    candidates = sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")))
+    return candidates[-1] if candidates else None
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """回傳每個情境、每個指標的比較結果"""
+    rows = []
+    for name, scenario in current["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        for metric in COMPARED_METRICS:
+            new = scenario["summary"].get(metric)
+            old = base["summary"].get(metric)
+            if new is None or old is None:
+                continue
+            delta = new - old
+            ratio = delta / old if old else (0.0 if delta == 0 else float("inf"))
+            rows.append({
+                "scenario": name,
+                "metric": metric,
+                "baseline": old,
+                "current": new,
+                "change": round(ratio, 4),
+                "regression": ratio > threshold and delta > ABSOLUTE_TOLERANCE[metric],
+            })
+    return rows
+
+
+def print_summary(results: dict):
+    header = f"{'scenario':<16}{'p50(s)':>9}{'p95(s)':>9}{'cpu(s)':>9}{'llm':>7}{'turns':>7}{'tokens':>9}{'ok':>7}"
+    print(header)
+    print("-" * len(header))
+    for name, scenario in results["scenarios"].items():
+        s = scenario["summary"]
+        print(f"{name:<16}{s['latency_p50']:>9.3f}{s['latency_p95']:>9.3f}{s['cpu_seconds_mean']:>9.3f}"
+              f"{s['llm_calls_mean']:>7.1f}{s['agent_turns_mean']:>7.1f}{s['total_tokens_mean']:>9.0f}"
+              f"{s['success_rate']:>7.0%}")
+
+
+def print_comparison(rows: list, baseline_path: str):
+    print(f"\n與 {os.path.relpath(baseline_path)} 比較：")
+    for row in rows:
+        mark = "  << 退化" if row["regression"] else ""
+        print(f"  {row['scenario']:<16}{row['metric']:<20}{row['baseline']:>10.3f} -> {row['current']:>10.3f}"
+              f"  ({row['change']:+.1%}){mark}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="以模擬後端執行 Agent 基準測試")
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--iterations", type=int, default=5, help="每個情境量測的次數")
+    parser.add_argument("--warmup", type=int, default=1, help="每個情境開始前不計入的暖身次數")
+    parser.add_argument("--warm-cache", action="store_true", help="不在每次執行前清除檢索快取，並啟用答案快取")
+    parser.add_argument("--mock-config", default="{}", help="MockConfig 欄位（JSON），例如延遲與回應大小")
+    parser.add_argument("--output", help="結果檔路徑，預設 benchmarks/results/<時間>.json")
+    parser.add_argument("--compare", help="比較的基準結果檔；latest 表示最近一次的結果")
+    parser.add_argument("--threshold", type=float, default=0.1, help="視為退化的相對增幅")
+    parser.add_argument("--fail-on-regression", action="store_true", help="有退化時以結束碼 1 結束")
+    args = parser.parse_args()
+
+    # 在建立新結果檔之前先找出基準，避免 latest 指到自己
+    baseline_path = resolve_baseline(args.compare)
+    mock_config = MockConfig(**json.loads(args.mock_config))
+
+    with MockBackendProcess(mock_config) as mock, tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ.update(mock.env())
+        # 追蹤與分析輸出會影響量測，基準測試時一律關閉
+        os.environ.pop("TRACE_EXPORT_PATH", None)
+        os.environ["AGENT_PROFILE"] = "0"
+        # 答案快取會讓暖身後的每次執行都直接命中，只在 --warm-cache 時啟用，並使用暫存的快取檔
+        os.environ["ANSWER_CACHE_ENABLED"] = "true" if args.warm_cache else "false"
+        os.environ["ANSWER_CACHE_PATH"] = os.path.join(tmp_dir, "answers.sqlite3")
+        os.environ["AGENT_CACHE_PATH"] = os.path.join(tmp_dir, "tools.sqlite3")
+        os.environ["LLM_SCHEDULER_STATE_PATH"] = os.path.join(tmp_dir, "llm_scheduler.sqlite3")
+        os.chdir(BACKEND_DIR)
+        import agent_test
+
+        image_path = write_label_image(tmp_dir)
+        results = {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "python": sys.version.split()[0],
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "warm_cache": args.warm_cache,
+            "mock_config": asdict(mock_config),
+            "scenarios": {},
+        }
+        for name in args.scenarios:
+            print(f"執行 {name} ...", file=sys.stderr, flush=True)
+            results["scenarios"][name] = await run_scenario(
+                agent_test, mock, SCENARIOS[name], image_path,
+                args.iterations, args.warmup, args.warm_cache)
+
+    output_path = args.output or os.path.join(
+        RESULTS_DIR, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+    regressions = []
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline, args.threshold)
+        results["comparison"] = {"baseline": os.path.basename(baseline_path),
+                                 "threshold": args.threshold, "rows": rows}
+        regressions = [row for row in rows if row["regression"]]
+    elif args.compare:
+        print(f"找不到基準結果：{args.compare}", file=sys.stderr)
+
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    print_summary(results)
+    if baseline_path:
+        print_comparison(results["comparison"]["rows"], baseline_path)
+    print(f"\n結果已儲存：{os.path.relpath(output_path)}")
+
+    if regressions and args.fail_on_regression:
+        print(f"{len(regressions)} 項指標退化超過 {args.threshold:.0%}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,78 @@
+"""
+基準測試與壓力測試共用的查詢情境，涵蓋 Agent 的每一條路徑
+"""
+from __future__ import annotations
+
+import base64
+import os
+from dataclasses import dataclass, field
+
+# 8x8 白色 JPEG，讓圖片情境不需要 Pillow 也能產生測試檔
+_LABEL_IMAGE_JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDABALDA4MChAODQ4SERATGCgaGBYWGDEjJR0oOjM9PDkzODdASFxOQERXRTc4UG1RV19i"
+    "Z2hnPk1xeXBkeFxlZ2P/2wBDARESEhgVGC8aGi9jQjhCY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2Nj"
+    "Y2NjY2NjY2P/wAARCAAIAAgDASIAAhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUF"
+    "BAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVW"
+    "V1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi"
+    "4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgECBAQDBAcFBAQAAQJ3AAEC"
+    "AxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVm"
+    "Z2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq"
+    "8vP09fb3+Pn6/9oADAMBAAIRAxEAPwD0CiiigD//2Q=="
+)
+
+
+@dataclass
+class Scenario:
+    name: str
+    description: str
+    input: str
+    history: list = field(default_factory=list)
+    needs_image: bool = False
+
+    def render_input(self, image_path: str | None = None) -> str:
+        return self.input.format(image_path=image_path or "")
+
+
+SCENARIOS = {
+    scenario.name: scenario for scenario in [
+        Scenario(
+            name="specific_model",
+            description="情境 A：指定型號查詢",
+            input="請幫我查詢 B-50 的相關數據",
+        ),
+        Scenario(
+            name="vague_query",
+            description="情境 B：第一次查詢不明確，需要引導",
+            input="我需要減速機",
+        ),
+        Scenario(
+            name="dont_know",
+            description="情境 C：用戶回答「不知道」，展示產品概覽",
+            input="不知道",
+            history=[
+                {"role": "user", "content": "我需要減速機"},
+                {"role": "assistant", "content": "為了幫您找到合適的減速機，請提供以下資訊：1. 您是否有特定的型號需求？"},
+            ],
+        ),
+        Scenario(
+            name="non_chinese",
+            description="非中文輸入：偵測語言、翻譯輸入與輸出",
+            input="Please show me the specifications of W-70",
+        ),
+        Scenario(
+            name="image_upload",
+            description="上傳產品標籤圖片：OCR 辨識型號後檢索",
+            input="請辨識這張產品標籤圖片並查詢規格：{image_path}",
+            needs_image=True,
+        ),
+    ]
+}
+
+
+def write_label_image(directory: str) -> str:
+    """寫出圖片情境使用的標籤圖片，回傳路徑"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "benchmark_label.jpg")
+    with open(path, "wb") as f:
+        f.write(_LABEL_IMAGE_JPEG)
+    return path
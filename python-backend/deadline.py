@@ -0,0 +1,119 @@
+"""
+請求期限與逐步降級
+
+每次請求可設定期限（AGENT_DEADLINE_SECONDS 或 --deadline），各階段從目前的
+Deadline 取得剩餘時間：LLM 呼叫與 RAGFlow 檢索的逾時不超過剩餘時間，排程器
+也不會在期限之後重試。剩餘時間不足時依序降級，每一步只觸發一次並送出
+degradation 事件。門檻是期限的比例，隨期限長短縮放（60 秒期限時依序為
+20、15、10、5 秒；8 秒期限時約為 2.6、2、1.3、0.7 秒）：
+
+- 剩餘 < DEGRADE_LANGUAGE_DETECTION_BELOW：以字元範圍推測語言，不呼叫 LLM
+- 剩餘 < DEGRADE_TOP_K_BELOW：檢索 top_k 降為 DEGRADED_TOP_K
+- 剩餘 < DEGRADE_AGENT_TURNS_BELOW：Agent 完成目前這一輪後停止，以部分結果回答
+- 剩餘 < DEGRADE_TRANSLATION_BELOW：不翻譯輸出，直接回傳中文回答
+
+Node 端每個請求都啟動新程序，載入 litellm、agents 要花上數秒；路由以請求
+抵達時的絕對時間（epoch 秒，--deadline-at）傳入期限，啟動時間也算在期限內。
+
+沒有設定期限時，所有函數都視為時間無限，不做任何降級。
+"""
+from __future__ import annotations
+
+import math
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+AGENT_DEADLINE_SECONDS = float(os.getenv("AGENT_DEADLINE_SECONDS") or 0)  # 0 表示不設期限
+
+# 各步降級的剩餘時間門檻，以期限的比例表示（0 ~ 1）
+DEGRADE_LANGUAGE_DETECTION_BELOW = float(os.getenv("DEADLINE_DEGRADE_LANGUAGE_DETECTION") or 1 / 3)
+DEGRADE_TOP_K_BELOW = float(os.getenv("DEADLINE_DEGRADE_TOP_K") or 1 / 4)
+DEGRADE_AGENT_TURNS_BELOW = float(os.getenv("DEADLINE_DEGRADE_AGENT_TURNS") or 1 / 6)
+DEGRADE_TRANSLATION_BELOW = float(os.getenv("DEADLINE_DEGRADE_TRANSLATION") or 1 / 12)
+DEGRADED_TOP_K = 32
+
+# 即使期限將至，單次呼叫仍至少給這麼多時間，避免立即逾時
+MIN_CALL_TIMEOUT = 1.0
+
+_current_deadline: ContextVar["Deadline | None"] = ContextVar("request_deadline", default=None)
+
+
+class Deadline:
+    """一次請求的期限與已採取的降級"""
+
+    def __init__(self, seconds: float, on_degrade: Callable[[dict], None] | None = None,
+                 expires_at: float | None = None):
+        """
+        Args:
+            seconds: 整個請求的期限秒數，降級門檻依此比例計算
+            expires_at: 期限的絕對時間（epoch 秒）；None 時從現在起算 seconds 秒
+        """
+        self.seconds = seconds
+        remaining = seconds if expires_at is None else expires_at - time.time()
+        self.expires_at = time.monotonic() + remaining
+        self.on_degrade = on_degrade
+        self.degradations: list = []
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def below(self, fraction: float) -> bool:
+        """剩餘時間是否低於期限的 fraction 比例"""
+        return self.remaining() < fraction * self.seconds
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def degrade(self, step: str, **details) -> bool:
+        """記錄一步降級；同一步只記錄一次，回傳是否為第一次"""
+        if any(d["step"] == step for d in self.degradations):
+            return False
+        degradation = {"step": step, "remaining_seconds": round(self.remaining(), 3), **details}
+        self.degradations.append(degradation)
+        if self.on_degrade:
+            self.on_degrade(degradation)
+        return True
+
+
+@contextmanager
+def start_deadline(seconds: float | None, on_degrade: Callable[[dict], None] | None = None,
+                   expires_at: float | None = None):
+    """設定請求期限；seconds 為 0 或 None 時不設期限，expires_at 為期限的絕對時間（epoch 秒）"""
+    deadline = Deadline(seconds, on_degrade, expires_at) if seconds else None
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def current_deadline() -> Deadline | None:
+    return _current_deadline.get()
+
+
+def remaining_time() -> float:
+    """剩餘秒數；沒有期限時為無限大"""
+    deadline = _current_deadline.get()
+    return deadline.remaining() if deadline else math.inf
+
+
+def call_timeout(default: float) -> float:
+    """單次呼叫的逾時：不超過 default，也不超過剩餘時間"""
+    return max(MIN_CALL_TIMEOUT, min(default, remaining_time()))
+
+
+def degrade_if_below(fraction: float, step: str, **details) -> bool:
+    """剩餘時間低於期限的 fraction 比例時記錄降級並回傳 True"""
+    deadline = _current_deadline.get()
+    if deadline is None or not deadline.below(fraction):
+        return False
+    deadline.degrade(step, **details)
+    return True
@@ -0,0 +1,618 @@
+"""
+LLM 呼叫排程器
+
+detect_language、translate_text、extract_query_keywords、Agent 各輪與答案快取的 embeddings 共用同一個
+AsyncOpenAI client。尖峰時段各自重試會形成重試風暴，持續收到 429 與逾時。
+這個模組在 client 外包一層：
+- AIMD 自適應並行上限：成功時緩慢加一，遇到 429 / 逾時 / 5xx 時減半
+- 解析 retry-after / retry-after-ms，整體退避而不是各自重試
+- 依優先權排隊：用戶即時回答優先於批次、快取預熱等背景工作
+- 提供排隊深度與等待時間指標
+- 記錄每次呼叫的 token 用量（token_accounting），以呼叫當下的 span 名稱分類
+- 有請求期限（deadline）時，逾時不超過剩餘時間，期限內來不及的重試直接放棄
+
+Node 端每個請求都是獨立的程序，因此並行上限、retry-after 退避與各程序
+執行中的呼叫數存放在 sqlite（LLMScheduler 的 state_path），所有請求程序、
+批次模式與預熱共用同一個上限，背景工作也會讓位給其他程序的即時請求。
+state_path 為空時只在單一程序內生效。
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable
+
+import openai
+
+from deadline import MIN_CALL_TIMEOUT, call_timeout, current_deadline
+from token_accounting import current_ledger
+from tracing import current_span, start_span
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+_current_priority: ContextVar[int] = ContextVar("llm_priority", default=PRIORITY_INTERACTIVE)
+
+# 視為供應端過載、需要整體退避的錯誤
+_OVERLOAD_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+_RETRYABLE_ERRORS = _OVERLOAD_ERRORS + (openai.APIConnectionError,)
+
+# 共用狀態時，其他程序歸還名額不會通知本程序，排隊中的請求每隔這麼久檢查一次
+SHARED_POLL_INTERVAL = 0.05
+# 共用狀態被其他程序鎖住時最多等待的秒數；交易在事件迴圈上同步執行，不能久等
+SHARED_BUSY_TIMEOUT = 0.05
+
+_SHARED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS limiter (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    concurrency_limit REAL NOT NULL,
+    blocked_until REAL NOT NULL,
+    last_decrease REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS processes (
+    owner TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    in_flight INTEGER NOT NULL,
+    interactive_waiting INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+@contextmanager
+def llm_priority(priority: int):
+    """在此區塊內發出的 LLM 呼叫使用指定優先權（數字越小越優先）"""
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def parse_retry_after(error: Exception) -> float | None:
+    """從錯誤回應的標頭取出建議等待秒數"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class SharedState:
+    """共用狀態的一份快照；limit、blocked_until、last_decrease 為所有程序共用"""
+    limit: float
+    blocked_until: float
+    last_decrease: float
+    other_in_flight: int = 0  # 其他程序執行中的呼叫數
+    other_interactive_waiting: int = 0  # 其他程序排隊中的即時呼叫數
+    in_flight: int = 0  # 本程序，寫回用
+    interactive_waiting: int = 0
+
+
+class SharedLimiterState:
+    """
+    以 sqlite 在程序之間共用並行上限與退避時間
+
+    Node 端每個請求都是獨立的 Python 程序，預熱也在自己的程序裡執行。
+    每個程序登記自己執行中與排隊中的即時呼叫數，所有程序合計受同一個上限
+    限制；背景呼叫在其他程序還有即時呼叫排隊時不會取得名額。已結束的程序
+    （pid 不存在，或太久沒有更新）不列入計算。
+    """
+
+    def __init__(self, path: str, initial_limit: float, stale_after: float = 900.0):
+        self.path = path
+        self.initial_limit = float(initial_limit)
+        self.stale_after = stale_after
+        self.pid = os.getpid()
+        self.owner = f"{self.pid}:{id(self)}"
+        self._db: sqlite3.Connection | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=SHARED_BUSY_TIMEOUT, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(_SHARED_SCHEMA)
+            self._db = db
+        return self._db
+
+    def _others(self, db: sqlite3.Connection, now: float) -> tuple:
+        in_flight = interactive_waiting = 0
+        rows = db.execute("SELECT owner, pid, in_flight, interactive_waiting, updated_at "
+                          "FROM processes WHERE owner != ?", (self.owner,)).fetchall()
+        for owner, pid, other_in_flight, other_waiting, updated_at in rows:
+            if updated_at < now - self.stale_after or not _pid_alive(pid):
+                db.execute("DELETE FROM processes WHERE owner = ?", (owner,))
+                continue
+            in_flight += other_in_flight
+            interactive_waiting += other_waiting
+        return in_flight, interactive_waiting
+
+    @contextmanager
+    def transaction(self):
+        """鎖定共用狀態並讀出快照；區塊正常結束時寫回快照的修改"""
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = db.execute("SELECT concurrency_limit, blocked_until, last_decrease "
+                             "FROM limiter WHERE id = 0").fetchone()
+            state = SharedState(*(row or (self.initial_limit, 0.0, 0.0)), *self._others(db, now))
+            yield state
+            db.execute("INSERT OR REPLACE INTO limiter (id, concurrency_limit, blocked_until, last_decrease) "
+                       "VALUES (0, ?, ?, ?)", (state.limit, state.blocked_until, state.last_decrease))
+            db.execute("INSERT OR REPLACE INTO processes "
+                       "(owner, pid, in_flight, interactive_waiting, updated_at) VALUES (?, ?, ?, ?, ?)",
+                       (self.owner, self.pid, state.in_flight, state.interactive_waiting, now))
+            db.execute("COMMIT")
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+
+
+def _is_busy(error: Exception) -> bool:
+    """鎖定逾時（database is locked / busy）是暫時的，不代表共用狀態無法使用"""
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+
+def _pid_alive(pid: int) -> bool:
+    if os.name != "posix":
+        # Windows 的 os.kill 會終止程序，只依 updated_at 判斷
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AdaptiveLimiter:
+    """AIMD 並行上限與優先權佇列；有 shared 時上限與退避由所有程序共用"""
+
+    def __init__(self, initial_limit: float = 8, min_limit: int = 1, max_limit: int = 32,
+                 decrease_factor: float = 0.5, decrease_cooldown: float = 1.0,
+                 shared: SharedLimiterState | None = None):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.shared = shared
+        self.in_flight = 0
+        self.other_in_flight = 0
+        self._other_interactive_waiting = 0
+        self._waiters: list = []
+        self._sequence = itertools.count()
+        # 以 time.time() 計時，才能跨程序比較
+        self._last_decrease = 0.0
+        self._blocked_until = 0.0
+        self._wakeup: asyncio.TimerHandle | None = None
+        self._unsynced = False
+        self.shared_busy = 0
+
+        self.total_acquired = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.max_queue_depth = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _capacity(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    def _with_state(self, apply: Callable[[], Any]) -> Any:
+        """在共用狀態的交易中執行 apply；sqlite 無法使用時改為只在程序內限制"""
+        if self.shared is None:
+            return apply()
+        applied = False
+        result = None
+        try:
+            with self.shared.transaction() as state:
+                if self._unsynced:
+                    # 先前鎖定逾時、只在程序內生效的減半與退避，保守地合併回共用狀態
+                    state.limit = min(state.limit, self.limit)
+                    state.blocked_until = max(state.blocked_until, self._blocked_until)
+                    state.last_decrease = max(state.last_decrease, self._last_decrease)
+                self.limit = min(float(self.max_limit), max(float(self.min_limit), state.limit))
+                self._blocked_until = state.blocked_until
+                self._last_decrease = state.last_decrease
+                self.other_in_flight = state.other_in_flight
+                self._other_interactive_waiting = state.other_interactive_waiting
+                result = apply()
+                applied = True
+                state.limit = self.limit
+                state.blocked_until = self._blocked_until
+                state.last_decrease = self._last_decrease
+                state.in_flight = self.in_flight
+                state.interactive_waiting = sum(1 for w in self._waiters if w[0] < PRIORITY_BACKGROUND)
+            self._unsynced = False
+            return result
+        except (sqlite3.Error, OSError) as e:
+            if _is_busy(e):
+                # 其他程序正持有鎖：這次以上次同步的狀態在程序內處理，下次交易再合併
+                self.shared_busy += 1
+                self._unsynced = True
+            else:
+                print(f"LLM 排程共用狀態無法使用，改為只在程序內限制: {e}", file=sys.stderr)
+                self.shared = None
+                self.other_in_flight = 0
+                self._other_interactive_waiting = 0
+        return result if applied else apply()
+
+    def _has_slot(self, priority: int) -> bool:
+        if time.time() < self._blocked_until:
+            return False
+        if priority >= PRIORITY_BACKGROUND and self._other_interactive_waiting:
+            return False
+        return self.in_flight + self.other_in_flight < self._capacity()
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE) -> float:
+        """取得一個執行名額，回傳排隊等待秒數"""
+        start_ts = time.monotonic()
+
+        def enter():
+            if not self._waiters and self._has_slot(priority):
+                self.in_flight += 1
+                return None
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+            self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+            return future
+
+        future = self._with_state(enter)
+        if future is not None:
+            self._schedule_wakeup()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # 名額已經分配給這個請求，歸還
+                    self.release()
+                else:
+                    self._waiters = [w for w in self._waiters if w[2] is not future]
+                    heapq.heapify(self._waiters)
+                    # 更新登記的排隊數
+                    self._with_state(lambda: None)
+                raise
+
+        waited = time.monotonic() - start_ts
+        self.total_acquired += 1
+        self.total_wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return waited
+
+    def release(self):
+        def leave():
+            self.in_flight = max(0, self.in_flight - 1)
+            self._dispatch()
+
+        self._with_state(leave)
+        self._schedule_wakeup()
+
+    def _wake_waiters(self):
+        self._wakeup = None
+        self._with_state(self._dispatch)
+        self._schedule_wakeup()
+
+    def _dispatch(self):
+        while self._waiters and self._has_slot(self._waiters[0][0]):
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _schedule_wakeup(self):
+        """仍有請求排隊時，等退避結束再派發；共用狀態時其他程序歸還名額不會通知這裡，定期檢查"""
+        if not self._waiters:
+            return
+        delay = self._blocked_until - time.time()
+        if delay <= 0:
+            if self.shared is None:
+                return
+            delay = SHARED_POLL_INTERVAL
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+        self._wakeup = asyncio.get_running_loop().call_later(delay, self._wake_waiters)
+
+    def on_success(self):
+        """
+        加法增加：接近上限時，每個成功請求讓上限增加 1/limit，約每輪加一
+
+        用量遠低於上限時不增加，否則閒置一段時間後上限會停在 max_limit，
+        下一波尖峰一開始就全部送出。
+        """
+        def increase():
+            if self.in_flight + self.other_in_flight >= self._capacity() - 1:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._dispatch()
+
+        self._with_state(increase)
+        self._schedule_wakeup()
+
+    def on_overload(self, retry_after: float | None = None):
+        """乘法減少：冷卻時間內只減一次，並依 retry-after 暫停派發"""
+        def decrease():
+            now = time.time()
+            if now - self._last_decrease >= self.decrease_cooldown:
+                self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+                self._last_decrease = now
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+
+        self._with_state(decrease)
+
+
+class LLMScheduler:
+    """將 LLM 呼叫納入自適應並行上限，並統一處理過載重試"""
+
+    def __init__(self, initial_limit: float = 8, max_limit: int = 32, max_retries: int = 4,
+                 base_delay: float = 0.5, max_delay: float = 30.0, call_timeout: float = 600.0,
+                 on_backoff: Callable[..., None] | None = None, state_path: str | None = None):
+        shared = SharedLimiterState(state_path, initial_limit) if state_path else None
+        self.limiter = AdaptiveLimiter(initial_limit=initial_limit, max_limit=max_limit, shared=shared)
+        self.max_retries = max_retries
+        self.call_timeout = call_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.on_backoff = on_backoff
+
+        self.total_calls = 0
+        self.throttled = 0
+        self.retries = 0
+        self.failures = 0
+
+    async def call(self, fn: Callable[..., Any], *args, span_name: str = "llm.chat", **kwargs) -> Any:
+        """
+        在排程器控制下執行一次 LLM 呼叫
+
+        串流回應會持有名額直到串流讀完，才算完成一次呼叫。用量以呼叫當下的
+        span 名稱分類，span_name 為這次呼叫本身的 span 名稱。
+        """
+        priority = _current_priority.get()
+        self.total_calls += 1
+        parent = current_span()
+        stage = parent.name if parent else "unknown"
+        call_span = start_span(span_name, model=kwargs.get("model"),
+                               stream=bool(kwargs.get("stream")), priority=priority)
+        usage_recorder = _UsageRecorder(current_ledger(), stage, kwargs.get("model"), call_span)
+        deadline = current_deadline()
+        bound_timeout = deadline is not None and "timeout" not in kwargs
+        queue_wait = 0.0
+        attempt = 0
+        while True:
+            try:
+                queue_wait += await self.limiter.acquire(priority)
+            except BaseException as e:
+                if call_span:
+                    call_span.end(error=e)
+                raise
+            if call_span:
+                call_span.set_attribute("queue_wait", round(queue_wait, 4))
+                call_span.set_attribute("attempts", attempt + 1)
+            if bound_timeout:
+                kwargs["timeout"] = call_timeout(self.call_timeout)
+            try:
+                result = await fn(*args, **kwargs)
+            except _RETRYABLE_ERRORS as e:
+                self.limiter.release()
+                retry_after = parse_retry_after(e)
+                if isinstance(e, _OVERLOAD_ERRORS):
+                    self.throttled += 1
+                    self.limiter.on_overload(retry_after)
+                delay = retry_after if retry_after is not None else self._backoff_delay(attempt)
+                out_of_time = deadline is not None and deadline.remaining() < delay + MIN_CALL_TIMEOUT
+                if attempt >= self.max_retries or out_of_time:
+                    self.failures += 1
+                    if call_span:
+                        call_span.end(error=e)
+                    raise
+                attempt += 1
+                self.retries += 1
+                if self.on_backoff:
+                    self.on_backoff(error=type(e).__name__, attempt=attempt, delay=round(delay, 3),
+                                    concurrency_limit=round(self.limiter.limit, 2))
+                await asyncio.sleep(delay)
+                continue
+            except BaseException as e:
+                self.limiter.release()
+                if call_span:
+                    call_span.end(error=e)
+                raise
+
+            if isinstance(result, openai.AsyncStream):
+                return _ScheduledStream(result, lambda error: self._finish_stream(error, call_span),
+                                        on_usage=usage_recorder)
+            usage_recorder(getattr(result, "usage", None))
+            self.limiter.on_success()
+            self.limiter.release()
+            if call_span:
+                call_span.end()
+            return result
+
+    def _finish_stream(self, error: BaseException | None, call_span=None):
+        if call_span:
+            call_span.end(error=error)
+        if error is None:
+            self.limiter.on_success()
+        elif isinstance(error, _OVERLOAD_ERRORS):
+            self.throttled += 1
+            self.limiter.on_overload(parse_retry_after(error))
+        self.limiter.release()
+
+    def _backoff_delay(self, attempt: int) -> float:
+        # 指數退避加 full jitter，避免所有請求同時重試
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def metrics(self) -> dict:
+        limiter = self.limiter
+        return {
+            "concurrency_limit": round(limiter.limit, 2),
+            "in_flight": limiter.in_flight,
+            "other_in_flight": limiter.other_in_flight,
+            "shared_state": limiter.shared is not None,
+            "shared_busy": limiter.shared_busy,
+            "queue_depth": limiter.queue_depth,
+            "max_queue_depth": limiter.max_queue_depth,
+            "total_calls": self.total_calls,
+            "throttled": self.throttled,
+            "retries": self.retries,
+            "failures": self.failures,
+            "avg_wait_seconds": round(limiter.total_wait_seconds / limiter.total_acquired, 4)
+            if limiter.total_acquired else 0.0,
+            "max_wait_seconds": round(limiter.max_wait_seconds, 4),
+        }
+
+
+class _UsageRecorder:
+    """把一次呼叫的 usage 記到請求的 TokenLedger 與 llm.chat span"""
+
+    def __init__(self, ledger, stage: str, model: str | None, call_span):
+        self.ledger = ledger
+        self.stage = stage
+        self.model = model
+        self.call_span = call_span
+
+    def __call__(self, usage: Any):
+        if usage is None or self.ledger is None:
+            return
+        call = self.ledger.record(self.stage, self.model, usage)
+        if call and self.call_span:
+            for key in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+                self.call_span.set_attribute(key, call[key])
+
+
+class _ScheduledStream:
+    """包裝 AsyncStream，串流結束（或中斷）時歸還名額"""
+
+    def __init__(self, stream: openai.AsyncStream, on_done: Callable[[BaseException | None], None],
+                 on_usage: Callable[[Any], None] | None = None):
+        self._stream = stream
+        self._on_done = on_done
+        self._on_usage = on_usage
+        self._done = False
+
+    def _finish(self, error: BaseException | None = None):
+        if not self._done:
+            self._done = True
+            self._on_done(error)
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                # stream_options.include_usage 時，最後一個片段帶有整次呼叫的用量
+                if self._on_usage and getattr(chunk, "usage", None) is not None:
+                    self._on_usage(chunk.usage)
+                yield chunk
+        except (Exception, asyncio.CancelledError) as e:
+            self._finish(e)
+            raise
+        finally:
+            self._finish()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        try:
+            await self._stream.close()
+        finally:
+            self._finish()
+
+    def __getattr__(self, name: str):
+        return getattr(self._stream, name)
+
+
+class ScheduledAsyncOpenAI:
+    """
+    AsyncOpenAI 的代理物件
+
+    chat.completions.create 與 embeddings.create 經過排程器，其餘屬性（base_url
+    等）直接轉交給原本的 client，因此可以直接交給 OpenAIChatCompletionsModel 使用。
+    """
+
+    def __init__(self, client: openai.AsyncOpenAI, scheduler: LLMScheduler):
+        self._client = client
+        self._scheduler = scheduler
+        self.chat = _ScheduledChat(client, scheduler)
+        self.embeddings = _ScheduledEmbeddings(client, scheduler)
+
+    def with_options(self, **kwargs) -> "ScheduledAsyncOpenAI":
+        return ScheduledAsyncOpenAI(self._client.with_options(**kwargs), self._scheduler)
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
+
+
+class _ScheduledChat:
+    def __init__(self, client: openai.AsyncOpenAI, scheduler: LLMScheduler):
+        self.completions = _ScheduledCompletions(client, scheduler)
+
+
+class _ScheduledCompletions:
+    def __init__(self, client: openai.AsyncOpenAI, scheduler: LLMScheduler):
+        self._client = client
+        self._scheduler = scheduler
+
+    async def create(self, **kwargs):
+        return await self._scheduler.call(self._client.chat.completions.create, **kwargs)
+
+    def __getattr__(self, name: str):
+        return getattr(self._client.chat.completions, name)
+
+
+class _ScheduledEmbeddings:
+    def __init__(self, client: openai.AsyncOpenAI, scheduler: LLMScheduler):
+        self._client = client
+        self._scheduler = scheduler
+
+    async def create(self, **kwargs):
+        return await self._scheduler.call(self._client.embeddings.create, span_name="llm.embeddings", **kwargs)
+
+    def __getattr__(self, name: str):
+        return getattr(self._client.embeddings, name)
@@ -0,0 +1,185 @@
+"""
+OCR 型號模糊比對
+
+視覺模型讀出的型號常有字形混淆（GLM4O、6LM40、GFM-22），直接查
+MODEL_MAPPING 會落空。這裡把所有已知型號預先建成 BK-tree，以考慮
+OCR 混淆字元（O/0、I/1、G/6、B/8 ...）的加權編輯距離找出最接近的型號，
+並回傳信心分數。
+
+非混淆字元的編輯（GLM41 與 GLM40、W70 與 WE70）多半是另一個真實存在的
+型號，而不是讀錯；每 CHARS_PER_EDIT 個字元才容許一個，短型號必須完全
+由混淆字元解釋。
+"""
+from __future__ import annotations
+
+import re
+from typing import Iterable, NamedTuple
+
+# OCR 常見混淆字元群組，同群組內替換只算部分成本
+OCR_CONFUSION_GROUPS = [
+    "O0DQ",
+    "I1L",
+    "G6",
+    "B8",
+    "S5",
+    "Z2",
+]
+CONFUSION_COST = 0.3
+EDIT_COST = 1.0
+CHARS_PER_EDIT = 8
+
+_CONFUSION_CLASS = {
+    ch: idx for idx, group in enumerate(OCR_CONFUSION_GROUPS) for ch in group
+}
+
+_NORMALIZE_PATTERN = re.compile(r"[^A-Z0-9]")
+
+
+class ModelMatch(NamedTuple):
+    """模糊比對結果"""
+    model: str  # 目錄中的型號（原始寫法）
+    confidence: float  # 0 ~ 1，1 代表完全相符
+    distance: float
+    edits: int = 0  # 非混淆字元的插入、刪除與替換次數
+
+
+def normalize_model(text: str) -> str:
+    """統一大小寫並去除連字號、空白等分隔符號"""
+    return _NORMALIZE_PATTERN.sub("", text.upper())
+
+
+def _substitution_cost(a: str, b: str) -> float:
+    if a == b:
+        return 0.0
+    group_a = _CONFUSION_CLASS.get(a)
+    if group_a is not None and group_a == _CONFUSION_CLASS.get(b):
+        return CONFUSION_COST
+    return EDIT_COST
+
+
+def ocr_alignment(a: str, b: str) -> tuple[float, int]:
+    """
+    考慮 OCR 混淆字元的加權 Levenshtein 距離（兩個已正規化的字串）
+
+    回傳 (距離, 非混淆字元的編輯次數)；距離相同的對齊方式取編輯次數較少者。
+    """
+    if a == b:
+        return 0.0, 0
+    if not a:
+        return len(b) * EDIT_COST, len(b)
+    if not b:
+        return len(a) * EDIT_COST, len(a)
+
+    previous = [(j * EDIT_COST, j) for j in range(len(b) + 1)]
+    for i, ca in enumerate(a, 1):
+        current = [(i * EDIT_COST, i)]
+        for j, cb in enumerate(b, 1):
+            cost = _substitution_cost(ca, cb)
+            diagonal = previous[j - 1]
+            current.append(min(
+                (previous[j][0] + EDIT_COST, previous[j][1] + 1),
+                (current[j - 1][0] + EDIT_COST, current[j - 1][1] + 1),
+                (diagonal[0] + cost, diagonal[1] + (cost == EDIT_COST)),
+            ))
+        previous = current
+    return previous[-1]
+
+
+def ocr_distance(a: str, b: str) -> float:
+    """考慮 OCR 混淆字元的加權 Levenshtein 距離（兩個已正規化的字串）"""
+    return ocr_alignment(a, b)[0]
+
+
+class _BKNode:
+    __slots__ = ("key", "model", "children")
+
+    def __init__(self, key: str, model: str):
+        self.key = key
+        self.model = model
+        self.children: dict[float, _BKNode] = {}
+
+
+class ModelCatalogMatcher:
+    """已知型號的 BK-tree，建構一次後可重複查詢"""
+
+    def __init__(self, models: Iterable[str] = ()):
+        self._root: _BKNode | None = None
+        self._exact: dict[str, str] = {}
+        for model in models:
+            self.add(model)
+
+    def __len__(self) -> int:
+        return len(self._exact)
+
+    def add(self, model: str) -> None:
+        key = normalize_model(model)
+        if not key or key in self._exact:
+            return
+        self._exact[key] = model
+
+        if self._root is None:
+            self._root = _BKNode(key, model)
+            return
+
+        node = self._root
+        while True:
+            dist = ocr_distance(key, node.key)
+            child = node.children.get(dist)
+            if child is None:
+                node.children[dist] = _BKNode(key, model)
+                return
+            node = child
+
+    def search(self, text: str, max_distance: float) -> list[ModelMatch]:
+        """找出距離在 max_distance 以內的所有型號，依信心分數排序"""
+        key = normalize_model(text)
+        if not key or self._root is None:
+            return []
+
+        matches = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            dist, edits = ocr_alignment(key, node.key)
+            if dist <= max_distance:
+                matches.append(ModelMatch(node.model, _confidence(key, node.key, dist), dist, edits))
+            for child_dist, child in node.children.items():
+                if dist - max_distance <= child_dist <= dist + max_distance:
+                    stack.append(child)
+
+        matches.sort(key=lambda m: (-m.confidence, m.distance))
+        return matches
+
+    def best_match(self, text: str, min_confidence: float = 0.6) -> ModelMatch | None:
+        """
+        回傳最接近的型號
+
+        信心分數低於 min_confidence，或非混淆字元的編輯超過長度容許的次數時
+        不採用，回傳 None。
+        """
+        key = normalize_model(text)
+        if not key:
+            return None
+
+        exact = self._exact.get(key)
+        if exact is not None:
+            return ModelMatch(exact, 1.0, 0.0)
+
+        # 信心分數 = 1 - 距離 / 最長長度，由此推回可接受的最大距離
+        max_len = max(len(key), max((len(k) for k in self._exact), default=0))
+        max_distance = (1.0 - min_confidence) * max_len
+        for match in self.search(key, max_distance):
+            if match.confidence < min_confidence:
+                break
+            if match.edits <= _allowed_edits(key, normalize_model(match.model)):
+                return match
+        return None
+
+
+def _allowed_edits(query_key: str, model_key: str) -> int:
+    return min(len(query_key), len(model_key)) // CHARS_PER_EDIT
+
+
+def _confidence(query_key: str, model_key: str, dist: float) -> float:
+    longest = max(len(query_key), len(model_key)) or 1
+    return round(max(0.0, 1.0 - dist / longest), 3)
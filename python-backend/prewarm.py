@@ -0,0 +1,211 @@
+"""
+快取預熱
+
+部署或重啟後檢索、關鍵字與翻譯快取都是空的，第一批用戶要承受完整的
+RAGFlow 與 LLM 延遲。這個命令預先填滿 agent_test 的快取（AGENT_CACHE_PATH，
+跨程序共用）：
+
+- 型號：MODEL_MAPPING 映射前後的寫法與 PRODUCT_MODELS_FILE 的型號，逐一檢索
+- 產品類型：PRODUCT_TYPES 的每個類型，逐一檢索
+- 產品概覽：情境 C 的「減速機」查詢
+- 歷史查詢：最常見的前 N 筆，非中文先翻譯，再提取關鍵詞並檢索其中的
+  search_query；來源為 TOKEN_USAGE_LOG 或 --queries（批次模式的 JSONL 格式）
+
+檢索一律重新查詢，以最新的知識庫內容更新快取；語言偵測、關鍵字與翻譯
+已在快取中時直接沿用，定期預熱時不會每輪重複呼叫 LLM。進度與涵蓋率以
+JSON 行輸出。
+
+預設每 PREWARM_INTERVAL（240）秒重新預熱一次，間隔要短於檢索結果的
+AGENT_CACHE_TTL，否則預熱的項目會在下一輪之前過期。
+
+用法：
+    python prewarm.py                       # 每 240 秒預熱一次
+    python prewarm.py --interval 0          # 只預熱一次
+    python prewarm.py --top-n 50 --queries queries.jsonl
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+from dotenv import load_dotenv
+
+from batch_runner import read_batch_records
+from llm_scheduler import PRIORITY_BACKGROUND, llm_priority
+from token_accounting import TOKEN_USAGE_LOG
+from tool_cache import AGENT_LLM_CACHE_TTL
+
+load_dotenv()
+
+PREWARM_CONCURRENCY = int(os.getenv("PREWARM_CONCURRENCY") or 4)
+PREWARM_TOP_N = int(os.getenv("PREWARM_TOP_N") or 20)
+PREWARM_INTERVAL = float(os.getenv("PREWARM_INTERVAL") or 240)  # 秒，0 表示只預熱一次
+
+
+@dataclass
+class WarmTarget:
+    kind: str  # model / product_type / overview / history
+    query: str
+    count: int = 0  # 歷史查詢出現的次數
+
+
+def _log(event_type: str, **kwargs):
+    print(json.dumps({"type": event_type, "timestamp": time.time(), **kwargs},
+                     ensure_ascii=False), flush=True)
+
+
+def historical_queries(usage_log: str | None, queries_path: str | None, top_n: int) -> list:
+    """從用量紀錄與查詢檔統計最常見的查詢，回傳 [(查詢, 次數), ...]"""
+    counts = Counter()
+    if usage_log and os.path.exists(usage_log):
+        with open(usage_log, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get("user_input"):
+                    counts[entry["user_input"].strip()] += 1
+    if queries_path:
+        with open(queries_path, encoding="utf-8") as f:
+            for record in read_batch_records(f):
+                if record.get("input"):
+                    counts[record["input"].strip()] += 1
+    return counts.most_common(top_n)
+
+
+def build_targets(agent_test, usage_log: str | None, queries_path: str | None, top_n: int) -> list:
+    targets = []
+    seen = set()
+    for kind, queries in [
+        ("model", agent_test.load_known_models()),
+        ("product_type", agent_test.PRODUCT_TYPES),
+        ("overview", [agent_test.OVERVIEW_QUERY]),
+    ]:
+        for query in queries:
+            if query not in seen:
+                seen.add(query)
+                targets.append(WarmTarget(kind, query))
+    for query, count in historical_queries(usage_log, queries_path, top_n):
+        # 圖片查詢的結果取決於圖片內容，無法預熱
+        if not agent_test.IMAGE_PATH_PATTERN.search(query):
+            targets.append(WarmTarget("history", query, count))
+    return targets
+
+
+async def detect_language_cached(agent_test, query: str) -> dict:
+    """LLM 偵測的語言，跨預熱週期沿用快取"""
+    key = f"language:{query}"
+    cached = agent_test._get_cached(key)
+    if cached is not None:
+        return json.loads(cached)
+    language = await agent_test.detect_language(query)
+    # 只有字元判斷為非中文的查詢才會呼叫 LLM；回傳中文是偵測失敗時的預設值，不快取
+    if not language.get("is_chinese", True):
+        agent_test._set_cache(key, json.dumps(language, ensure_ascii=False), ttl=AGENT_LLM_CACHE_TTL)
+    return language
+
+
+async def warm_target(agent_test, target: WarmTarget) -> list:
+    """預熱一個目標，回傳它應該填入的快取 key"""
+    if target.kind != "history":
+        await agent_test.retrieve_knowledge(target.query, use_cache=False)
+        return [f"retrieve:{target.query}"]
+
+    keys = []
+    question = target.query
+    if not agent_test.detect_language_heuristic(question)["is_chinese"]:
+        # 與實際請求相同，以 LLM 偵測的語言代碼作為翻譯快取的 key
+        language = await detect_language_cached(agent_test, question)
+        if not language.get("is_chinese", True):
+            source_language = language.get("language_code", "en")
+            question = await agent_test.translate_text(question, "zh-TW", source_language)
+            keys.append(agent_test.translation_cache_key(target.query, source_language, "zh-TW"))
+
+    keywords = json.loads(await agent_test.extract_keywords(question))
+    keys.append(f"keywords:{question}")
+    search_query = keywords.get("search_query")
+    if search_query:
+        await agent_test.retrieve_knowledge(search_query, use_cache=False)
+        keys.append(f"retrieve:{search_query}")
+    return keys
+
+
+async def prewarm(agent_test, targets: list, concurrency: int = PREWARM_CONCURRENCY) -> dict:
+    """以限定的並行數預熱所有目標，回傳各類別的涵蓋率"""
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+    start_ts = time.time()
+
+    async def run(target: WarmTarget):
+        async with semaphore:
+            target_start = time.time()
+            try:
+                keys = await warm_target(agent_test, target)
+                error = None
+            except Exception as e:
+                keys, error = [], str(e)
+            # 檢索失敗等情況不會寫入快取，以實際的快取內容計算涵蓋率
+            warmed = bool(keys) and all(agent_test._get_cached(key) is not None for key in keys)
+            results.append({"kind": target.kind, "warmed": warmed})
+            _log("prewarm_progress",
+                 done=len(results),
+                 total=len(targets),
+                 kind=target.kind,
+                 query=target.query,
+                 occurrences=target.count or None,
+                 warmed=warmed,
+                 error=error,
+                 seconds=round(time.time() - target_start, 3))
+
+    with llm_priority(PRIORITY_BACKGROUND):
+        await asyncio.gather(*(run(target) for target in targets))
+
+    by_kind = {}
+    for result in results:
+        kind = by_kind.setdefault(result["kind"], {"targets": 0, "warmed": 0})
+        kind["targets"] += 1
+        kind["warmed"] += result["warmed"]
+    for kind in by_kind.values():
+        kind["coverage"] = round(kind["warmed"] / kind["targets"], 3)
+    warmed = sum(kind["warmed"] for kind in by_kind.values())
+    return {
+        "targets": len(targets),
+        "warmed": warmed,
+        "coverage": round(warmed / len(targets), 3) if targets else 1.0,
+        "by_kind": by_kind,
+        "concurrency": concurrency,
+        "elapsed_seconds": round(time.time() - start_ts, 3),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="預熱檢索、關鍵字與翻譯快取")
+    parser.add_argument("--top-n", type=int, default=PREWARM_TOP_N, help="預熱的歷史查詢筆數")
+    parser.add_argument("--queries", help="歷史查詢 JSONL 檔（批次模式格式），與 TOKEN_USAGE_LOG 合併統計")
+    parser.add_argument("--concurrency", type=int, default=PREWARM_CONCURRENCY, help="同時預熱的目標數")
+    parser.add_argument("--interval", type=float, default=PREWARM_INTERVAL,
+                        help="每隔幾秒重新預熱（0 表示只預熱一次）")
+    args = parser.parse_args()
+
+    # agent_test 載入時會檢查必要的環境變數，放在解析參數之後（--help 不需要設定）
+    import agent_test
+
+    while True:
+        # 每次重新統計歷史查詢，排程執行時跟上最新的熱門問題
+        targets = build_targets(agent_test, TOKEN_USAGE_LOG, args.queries, args.top_n)
+        _log("prewarm_start", total=len(targets), message="開始預熱快取")
+        report = await prewarm(agent_test, targets, args.concurrency)
+        _log("prewarm_complete", **report)
+        if not args.interval:
+            break
+        await asyncio.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,202 @@
+"""
+單次 Agent 執行的 CPU 與記憶體分析
+
+Python 程序每次請求都重新啟動，執行時間短，不適合從外部掛 profiler。
+開啟 AGENT_PROFILE=1（或請求帶 profile 旗標）時，process_user_input 會：
+- 以背景執行緒定時取樣所有執行緒的呼叫堆疊，輸出 collapsed stack 格式
+  （<request_id>.cpu.folded，可直接給 flamegraph.pl 或 speedscope）
+- 以 tracemalloc 在開始與結束各取一次快照，輸出差異最大的配置位置
+  （<request_id>.alloc.txt）與結束時的完整快照（<request_id>.tracemalloc）
+
+tracemalloc 會讓大量配置記憶體的程式碼（例如首次 import）明顯變慢，也會
+扭曲 CPU 取樣結果；只需要 CPU 分析時可設 AGENT_PROFILE_MEMORY=0。
+關閉時 profile_request() 直接返回，不啟動任何取樣或追蹤。
+
+批次模式下多個請求同時分析時，tracemalloc 由所有進行中的分析共用，
+最後一個結束的才會關閉它。分析檔案的輸出失敗只會略過，不影響請求本身。
+"""
+from __future__ import annotations
+
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable
+
+PROFILE_ENABLED = os.getenv("AGENT_PROFILE", "").lower() in ("1", "true", "yes")
+PROFILE_DIR = os.getenv("AGENT_PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("AGENT_PROFILE_INTERVAL", "0.005"))  # seconds
+PROFILE_MEMORY = os.getenv("AGENT_PROFILE_MEMORY", "1").lower() in ("1", "true", "yes")
+# 每筆配置保留的堆疊深度；越深越慢
+TRACEMALLOC_FRAMES = int(os.getenv("AGENT_PROFILE_TRACEMALLOC_FRAMES", "1"))
+
+# tracemalloc 是全程序共用的：記錄有幾個進行中的分析在使用，以及是否由這裡開啟
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+
+
+def _acquire_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            _tracemalloc_owned = True
+        _tracemalloc_users += 1
+
+
+def _release_tracemalloc():
+    """最後一個使用者結束時才關閉；在外部開啟（python -X tracemalloc）時不關閉"""
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0 and _tracemalloc_owned:
+            tracemalloc.stop()
+            _tracemalloc_owned = False
+
+
+class SamplingProfiler:
+    """定時取樣所有執行緒的堆疊（取樣器本身除外）"""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="agent-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def write_folded(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def top_functions(self, limit: int = 20) -> list:
+        """依 self time（堆疊最上層）排序的函數"""
+        leaf_counts: Counter = Counter()
+        for stack, count in self.samples.items():
+            leaf_counts[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaf_counts.values()) or 1
+        return [
+            {"function": name, "samples": count, "ratio": round(count / total, 4)}
+            for name, count in leaf_counts.most_common(limit)
+        ]
+
+
+@contextmanager
+def profile_request(request_id: str, enabled: bool | None = None,
+                    on_saved: Callable[[dict], None] | None = None):
+    """
+    分析包在區塊內的執行
+
+    Args:
+        request_id: 檔名前綴，對應追蹤的 trace_id
+        enabled: 是否開啟；None 時依 AGENT_PROFILE 環境變數
+        on_saved: 輸出檔案後的回呼，參數為輸出摘要
+    """
+    if not (PROFILE_ENABLED if enabled is None else enabled):
+        yield
+        return
+
+    if PROFILE_MEMORY:
+        _acquire_tracemalloc()
+    start_snapshot = tracemalloc.take_snapshot() if PROFILE_MEMORY else None
+    profiler = SamplingProfiler()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        cpu_seconds = time.process_time() - cpu_start
+        wall_seconds = time.perf_counter() - wall_start
+        try:
+            end_snapshot = tracemalloc.take_snapshot() if start_snapshot is not None else None
+            current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        finally:
+            if PROFILE_MEMORY:
+                _release_tracemalloc()
+
+        # 分析只是輔助，輸出失敗（磁碟已滿、目錄無權限 ...）不能讓請求失敗
+        try:
+            summary = _write_artifacts(request_id, profiler, start_snapshot, end_snapshot, {
+                "request_id": request_id,
+                "cpu_seconds": round(cpu_seconds, 4),
+                "wall_seconds": round(wall_seconds, 4),
+                "samples": profiler.sample_count,
+                "sample_interval": profiler.interval,
+                "traced_memory_bytes": current_bytes,
+                "traced_memory_peak_bytes": peak_bytes,
+            })
+        except Exception as e:
+            print(f"效能分析檔案輸出失敗（{request_id}）：{e}", file=sys.stderr, flush=True)
+        else:
+            if on_saved:
+                on_saved(summary)
+
+
+def _write_artifacts(request_id: str, profiler: SamplingProfiler,
+                     start_snapshot: tracemalloc.Snapshot | None,
+                     end_snapshot: tracemalloc.Snapshot | None,
+                     summary: dict) -> dict:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    prefix = os.path.join(PROFILE_DIR, request_id)
+    artifacts = {"cpu_folded": f"{prefix}.cpu.folded"}
+
+    profiler.write_folded(artifacts["cpu_folded"])
+
+    if start_snapshot is not None and end_snapshot is not None:
+        artifacts["allocations"] = f"{prefix}.alloc.txt"
+        artifacts["tracemalloc_snapshot"] = f"{prefix}.tracemalloc"
+        end_snapshot.dump(artifacts["tracemalloc_snapshot"])
+
+        filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+        diff = end_snapshot.filter_traces(filters).compare_to(
+            start_snapshot.filter_traces(filters), "traceback")
+        with open(artifacts["allocations"], "w", encoding="utf-8") as f:
+            for stat in diff[:30]:
+                f.write(f"{stat.size_diff / 1024:+.1f} KiB, {stat.count_diff:+d} blocks\n")
+                for line in stat.traceback.format(limit=8):
+                    f.write(f"{line}\n")
+                f.write("\n")
+
+    summary = {
+        **summary,
+        "top_functions": profiler.top_functions(10),
+        "artifacts": artifacts,
+    }
+    with open(f"{prefix}.profile.json", "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+from answer_cache import (AnswerCache, extract_guard_terms, extract_model_numbers, extract_spec_values,
+                          normalize_question)
+
+MODEL_MAPPING = {"GLM40": "GL-40M"}
+PRODUCT_TYPES = ["雙段蝸輪齒輪減速機", "單段立式蝸輪減速機"]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    async def snapshot():
+        return "kb-1"
+
+    return AnswerCache(str(tmp_path / "answers.sqlite3"), kb_snapshot_fn=snapshot,
+                       model_aliases=MODEL_MAPPING, guard_terms=PRODUCT_TYPES, kb_check_interval=0)
+
+
+def ask(cache, stored: str, question: str):
+    async def run():
+        await cache.store(stored, f"answer for {stored}")
+        return await cache.lookup(question)
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("stored, question", [
+    ("請幫我查詢 B-50 的相關數據", "B-50 規格"),
+    ("B-50 規格", "B50 的規格表是什麼"),
+    ("B-50 規格", "請給我 Ｂ－５０ 數據"),
+    ("GLM40 規格", "GL-40M 規格"),
+])
+def test_same_question_hits(cache, stored, question):
+    hit = ask(cache, stored, question)
+    assert hit is not None
+    assert hit["answer"] == f"answer for {stored}"
+
+
+@pytest.mark.parametrize("stored, question", [
+    ("B-50 規格", "W-70 規格"),
+    ("B-50 規格", "B-50 W-70 規格"),
+    ("請幫我查詢雙段蝸輪齒輪減速機的型號有哪些", "請幫我查詢單段蝸輪齒輪減速機的型號有哪些"),
+    ("B-50 的輸入轉速", "B-50 的輸出轉速"),
+    ("B-50 有現貨嗎", "B-50 沒有現貨嗎"),
+    ("B-50 規格", "B-50 價格"),
+    ("請問輸出轉速 30rpm、輸入馬力 1HP 的雙段蝸輪齒輪減速機有哪些型號",
+     "請問輸出轉速 60rpm、輸入馬力 1HP 的雙段蝸輪齒輪減速機有哪些型號"),
+    ("減速比 1:30 的中空型減速機", "減速比 1:60 的中空型減速機"),
+    ("減速比 1:30 的中空型減速機", "減速比 13:0 的中空型減速機"),
+    ("輸入馬力 1HP 的單段減速機", "輸入馬力 2HP 的單段減速機"),
+    ("輸入馬力 1/2HP 的單段減速機", "輸入馬力 1HP 的單段減速機"),
+])
+def test_different_question_misses(cache, stored, question):
+    assert ask(cache, stored, question) is None
+
+
+def test_kb_change_clears_cache(tmp_path):
+    snapshots = ["kb-1"]
+
+    async def snapshot():
+        return snapshots[-1]
+
+    cache = AnswerCache(str(tmp_path / "answers.sqlite3"), kb_snapshot_fn=snapshot, kb_check_interval=0)
+
+    async def run():
+        await cache.store("B-50 規格", "old")
+        snapshots.append("kb-2")
+        return await cache.lookup("B-50 規格")
+
+    assert asyncio.run(run()) is None
+
+
+def test_unavailable_snapshot_disables_cache(tmp_path):
+    async def snapshot():
+        return None
+
+    cache = AnswerCache(str(tmp_path / "answers.sqlite3"), kb_snapshot_fn=snapshot, kb_check_interval=0)
+    assert ask(cache, "B-50 規格", "B-50 規格") is None
+
+
+def test_max_entries_evicts_least_recently_used(tmp_path):
+    async def snapshot():
+        return "kb-1"
+
+    cache = AnswerCache(str(tmp_path / "answers.sqlite3"), kb_snapshot_fn=snapshot,
+                        max_entries=2, kb_check_interval=0)
+
+    async def run():
+        for model in ["B-50", "W-70", "GF-22M"]:
+            await cache.store(f"{model} 規格", model)
+        return [await cache.lookup(f"{model} 規格") for model in ["B-50", "W-70", "GF-22M"]]
+
+    first, second, third = asyncio.run(run())
+    assert first is None and second and third
+    assert cache.stats()["entries"] == 2
+
+
+def test_key_parts():
+    assert extract_model_numbers("B-50 與 w70", MODEL_MAPPING) == ["B50", "W70"]
+    assert extract_model_numbers("GLM40", MODEL_MAPPING) == ["GL40M"]
+    assert normalize_question("請幫我查詢 B-50 的相關數據") == "規格"
+    assert set(extract_guard_terms("沒有現貨的雙段減速機")) == {"!否定", "雙段", "現貨"}
+    assert extract_spec_values("B-50 輸出 30 RPM、減速比 1：30、１/２HP") == ["1/2hp", "1:30", "30rpm"]
+
+
+def test_same_spec_values_still_hit(cache):
+    hit = ask(cache, "請問減速比 1:30 的中空型減速機", "減速比 1:30 中空型減速機")
+    assert hit is not None
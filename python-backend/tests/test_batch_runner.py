@@ -0,0 +1,28 @@
+import io
+
+from batch_runner import read_batch_records
+
+
+def test_read_batch_records_keeps_line_positions():
+    source = io.StringIO('{"id": "a", "input": "GLM-40"}\n\n"減速機"\n')
+    records = read_batch_records(source)
+    assert records == [
+        {"id": "a", "input": "GLM-40", "_index": 0},
+        {"input": "減速機", "_index": 2},
+    ]
+
+
+def test_read_batch_records_turns_bad_lines_into_errors():
+    source = io.StringIO('{"input": "GLM-40"\n[1, 2]\n42\nnull\n{"input": "WE-70"}\n')
+    records = read_batch_records(source)
+    assert [r["_index"] for r in records] == [0, 1, 2, 3, 4]
+    assert all(r["input"] is None and "error" in r for r in records[:4])
+    assert "list" in records[1]["error"]
+    assert records[4]["input"] == "WE-70"
+
+
+def test_read_batch_records_rejects_wrong_field_types():
+    source = io.StringIO('{"id": "a", "input": 42}\n{"input": "GLM-40", "history": "abc"}\n')
+    first, second = read_batch_records(source)
+    assert first["input"] is None and "int" in first["error"] and first["id"] == "a"
+    assert second["input"] is None and "history" in second["error"]
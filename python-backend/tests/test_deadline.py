@@ -0,0 +1,38 @@
+import time
+
+from deadline import (DEGRADE_AGENT_TURNS_BELOW, DEGRADE_LANGUAGE_DETECTION_BELOW, DEGRADE_TOP_K_BELOW,
+                      degrade_if_below, start_deadline)
+
+
+def test_short_deadline_does_not_degrade_at_start():
+    with start_deadline(8) as deadline:
+        assert not degrade_if_below(DEGRADE_AGENT_TURNS_BELOW, "cap_agent_turns")
+        assert not degrade_if_below(DEGRADE_TOP_K_BELOW, "reduce_top_k")
+        assert deadline.degradations == []
+
+
+def test_degrades_once_below_fraction():
+    with start_deadline(10) as deadline:
+        deadline.expires_at -= 9  # 剩約 1 秒，低於 1/6
+        assert degrade_if_below(DEGRADE_AGENT_TURNS_BELOW, "cap_agent_turns")
+        assert degrade_if_below(DEGRADE_AGENT_TURNS_BELOW, "cap_agent_turns")
+        assert [d["step"] for d in deadline.degradations] == ["cap_agent_turns"]
+
+
+def test_no_deadline_never_degrades():
+    with start_deadline(0) as deadline:
+        assert deadline is None
+        assert not degrade_if_below(1.0, "reduce_top_k")
+
+
+def test_absolute_deadline_counts_time_before_start():
+    # 請求 6 秒前抵達（程序啟動與載入），期限 8 秒，只剩約 2 秒
+    with start_deadline(8, expires_at=time.time() + 2) as deadline:
+        assert 1.5 < deadline.remaining() <= 2
+        assert deadline.seconds == 8
+        assert degrade_if_below(DEGRADE_LANGUAGE_DETECTION_BELOW, "heuristic_language_detection")
+
+
+def test_absolute_deadline_already_passed():
+    with start_deadline(8, expires_at=time.time() - 1) as deadline:
+        assert deadline.expired
@@ -0,0 +1,150 @@
+import asyncio
+import sqlite3
+import time
+from types import SimpleNamespace
+
+from llm_scheduler import (PRIORITY_BACKGROUND, AdaptiveLimiter, LLMScheduler, ScheduledAsyncOpenAI,
+                           SharedLimiterState)
+from token_accounting import start_ledger
+from tracing import span, start_trace
+
+
+def shared_limiter(path, initial_limit=4):
+    # 每個 SharedLimiterState 以不同的 owner 登記，相當於不同的請求程序
+    return AdaptiveLimiter(initial_limit=initial_limit, shared=SharedLimiterState(str(path), initial_limit))
+
+
+def test_success_below_capacity_does_not_raise_limit():
+    async def run():
+        limiter = AdaptiveLimiter(initial_limit=8)
+        for _ in range(20):
+            await limiter.acquire()
+            limiter.on_success()
+            limiter.release()
+        return limiter.limit
+
+    assert asyncio.run(run()) == 8
+
+
+def test_success_at_capacity_raises_limit():
+    async def run():
+        limiter = AdaptiveLimiter(initial_limit=2)
+        await limiter.acquire()
+        await limiter.acquire()
+        limiter.on_success()
+        return limiter.limit
+
+    assert asyncio.run(run()) == 2.5
+
+
+def test_limit_and_retry_after_are_shared(tmp_path):
+    async def run():
+        first = shared_limiter(tmp_path / "state.sqlite3")
+        second = shared_limiter(tmp_path / "state.sqlite3")
+        first.on_overload(retry_after=0.2)
+        waited = await second.acquire()
+        return second.limit, waited
+
+    limit, waited = asyncio.run(run())
+    assert limit == 2
+    assert waited >= 0.15
+
+
+def test_in_flight_is_limited_across_processes(tmp_path):
+    async def run():
+        first = shared_limiter(tmp_path / "state.sqlite3", initial_limit=2)
+        second = shared_limiter(tmp_path / "state.sqlite3", initial_limit=2)
+        await first.acquire()
+        await first.acquire()
+        waiting = asyncio.create_task(second.acquire())
+        await asyncio.sleep(0.1)
+        blocked = not waiting.done()
+        first.release()
+        await asyncio.wait_for(waiting, 1)
+        return blocked, second.in_flight
+
+    assert asyncio.run(run()) == (True, 1)
+
+
+def test_background_yields_to_interactive_in_other_process(tmp_path):
+    async def run():
+        interactive = shared_limiter(tmp_path / "state.sqlite3", initial_limit=1)
+        background = shared_limiter(tmp_path / "state.sqlite3", initial_limit=1)
+        await background.acquire(PRIORITY_BACKGROUND)
+        interactive_task = asyncio.create_task(interactive.acquire())
+        await asyncio.sleep(0.1)
+        background_task = asyncio.create_task(background.acquire(PRIORITY_BACKGROUND))
+        await asyncio.sleep(0.1)
+        background.release()
+        await asyncio.wait_for(interactive_task, 1)
+        await asyncio.sleep(0.1)
+        background_first = background_task.done()
+        interactive.release()
+        await asyncio.wait_for(background_task, 1)
+        return background_first
+
+    assert asyncio.run(run()) is False
+
+
+def test_unusable_state_path_falls_back_to_process_limit(tmp_path):
+    blocker = tmp_path / "not-a-directory"
+    blocker.write_text("")
+
+    async def run():
+        limiter = shared_limiter(blocker / "state.sqlite3")
+        await limiter.acquire()
+        limiter.release()
+        return limiter.shared
+
+    assert asyncio.run(run()) is None
+
+
+def test_lock_timeout_keeps_shared_state(tmp_path):
+    path = tmp_path / "state.sqlite3"
+
+    async def run():
+        limiter = shared_limiter(path, initial_limit=4)
+        await limiter.acquire()
+        limiter.release()
+
+        holder = sqlite3.connect(str(path), isolation_level=None)
+        holder.execute("BEGIN EXCLUSIVE")
+        start = time.monotonic()
+        await limiter.acquire()
+        limiter.on_overload()
+        limiter.release()
+        elapsed = time.monotonic() - start
+        holder.execute("ROLLBACK")
+
+        await limiter.acquire()
+        limiter.release()
+        other = shared_limiter(path, initial_limit=4)
+        await other.acquire()
+        return limiter, other, elapsed
+
+    limiter, other, elapsed = asyncio.run(run())
+    assert limiter.shared is not None
+    assert limiter.shared_busy >= 3
+    assert elapsed < 1
+    # 鎖定期間的減半在下一次交易合併回共用狀態
+    assert other.limit == 2
+
+
+def test_embeddings_go_through_scheduler():
+    class FakeEmbeddings:
+        async def create(self, **kwargs):
+            return SimpleNamespace(data=[SimpleNamespace(embedding=[1.0])],
+                                   usage={"prompt_tokens": 5, "total_tokens": 5})
+
+    scheduler = LLMScheduler()
+    client = ScheduledAsyncOpenAI(SimpleNamespace(embeddings=FakeEmbeddings()), scheduler)
+
+    async def run():
+        with start_trace(), start_ledger() as ledger:
+            with span("answer_cache"):
+                await client.embeddings.create(model="embed", input="B-50 規格")
+        return ledger
+
+    ledger = asyncio.run(run())
+    assert scheduler.metrics()["total_calls"] == 1
+    assert ledger.by_stage()["answer_cache"]["prompt_tokens"] == 5
@@ -0,0 +1,64 @@
+import pytest
+
+from model_resolver import ModelCatalogMatcher, normalize_model, ocr_alignment, ocr_distance
+
+CATALOG = ["GFM22", "GF-22M", "GLM40", "GL-40M", "WFM50", "WF-50M", "BFM30", "BF-30M",
+           "HTFM60", "HT-60F", "WE70", "WE-70", "QWFM45", "QW-45F"]
+
+
+@pytest.fixture(scope="module")
+def matcher():
+    return ModelCatalogMatcher(CATALOG)
+
+
+def test_normalize_model():
+    assert normalize_model(" gl-40 m ") == "GL40M"
+
+
+def test_confusion_substitution_costs_less_than_edit():
+    assert ocr_distance("GLM4O", "GLM40") == pytest.approx(0.3)
+    assert ocr_distance("GLM41", "GLM40") == 1.0
+    assert ocr_alignment("6LM4O", "GLM40") == (pytest.approx(0.6), 0)
+    assert ocr_alignment("W70", "WE70") == (1.0, 1)
+
+
+def test_exact_match_ignores_separators(matcher):
+    match = matcher.best_match("gl 40m")
+    assert (match.model, match.confidence) == ("GL-40M", 1.0)
+
+
+@pytest.mark.parametrize("text, model", [
+    ("GLM4O", "GLM40"),
+    ("6LM40", "GLM40"),
+    ("GFM-2Z", "GFM22"),
+    ("8FM3O", "BFM30"),
+    ("HTFM6O", "HTFM60"),
+])
+def test_ocr_confusions_resolve(matcher, text, model):
+    match = matcher.best_match(text)
+    assert match.model == model
+    assert 0.6 <= match.confidence < 1.0
+    assert match.edits == 0
+
+
+@pytest.mark.parametrize("text", ["GLM41", "W-70", "WE-7", "GLM50", "QWFM46"])
+def test_other_models_are_not_rewritten(matcher, text):
+    assert matcher.best_match(text) is None
+
+
+def test_long_models_allow_one_edit():
+    matcher = ModelCatalogMatcher(["HTFM60-1200"])
+    assert matcher.best_match("HTFM60-120").model == "HTFM60-1200"
+    assert matcher.best_match("HTFM61-120") is None
+
+
+def test_search_is_sorted_by_confidence(matcher):
+    matches = matcher.search("GLM4O", 1.5)
+    assert matches[0].model == "GLM40"
+    assert [m.confidence for m in matches] == sorted((m.confidence for m in matches), reverse=True)
+
+
+def test_unknown_or_empty_input(matcher):
+    assert matcher.best_match("") is None
+    assert matcher.best_match("XYZ999") is None
+    assert ModelCatalogMatcher().best_match("GLM40") is None
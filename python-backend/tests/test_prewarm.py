@@ -0,0 +1,39 @@
+import asyncio
+from types import SimpleNamespace
+
+from prewarm import detect_language_cached
+from tool_cache import ToolCache
+
+
+def fake_agent_test(language: dict):
+    cache = ToolCache(None)
+    calls = []
+
+    async def detect_language(text):
+        calls.append(text)
+        return language
+
+    return SimpleNamespace(_get_cached=cache.get, _set_cache=cache.set, detect_language=detect_language), calls
+
+
+def test_detected_language_is_reused_across_cycles():
+    agent_test, calls = fake_agent_test({"language_code": "en", "is_chinese": False})
+
+    async def run():
+        return [await detect_language_cached(agent_test, "Show me W-70") for _ in range(3)]
+
+    results = asyncio.run(run())
+    assert calls == ["Show me W-70"]
+    assert all(r["language_code"] == "en" for r in results)
+
+
+def test_failed_detection_is_not_cached():
+    # detect_language 失敗時回傳預設的中文
+    agent_test, calls = fake_agent_test({"language_code": "zh-TW", "is_chinese": True})
+
+    async def run():
+        for _ in range(2):
+            await detect_language_cached(agent_test, "Show me W-70")
+
+    asyncio.run(run())
+    assert len(calls) == 2
@@ -0,0 +1,42 @@
+import time
+
+from tool_cache import ToolCache
+
+
+def test_entries_are_shared_between_instances(tmp_path):
+    path = str(tmp_path / "tools.sqlite3")
+    ToolCache(path).set("retrieve:GLM-40", "結果")
+    assert ToolCache(path).get("retrieve:GLM-40") == "結果"
+
+
+def test_expired_entries_are_not_returned(tmp_path):
+    cache = ToolCache(str(tmp_path / "tools.sqlite3"))
+    cache.set("keywords:減速機", "{}", ttl=0.05)
+    time.sleep(0.1)
+    assert cache.get("keywords:減速機") is None
+
+
+def test_memory_only_without_path():
+    cache = ToolCache(None)
+    cache.set("retrieve:GLM-40", "結果")
+    assert cache.get("retrieve:GLM-40") == "結果"
+    assert ToolCache(None).get("retrieve:GLM-40") is None
+
+
+def test_unusable_directory_falls_back_to_memory(tmp_path):
+    blocker = tmp_path / "not-a-directory"
+    blocker.write_text("")
+    cache = ToolCache(str(blocker / "tools.sqlite3"))
+    assert cache.get("retrieve:GLM-40") is None
+    cache.set("retrieve:GLM-40", "結果")
+    assert cache.get("retrieve:GLM-40") == "結果"
+    cache.clear()
+    assert cache.get("retrieve:GLM-40") is None
+
+
+def test_corrupt_database_falls_back_to_memory(tmp_path):
+    path = tmp_path / "tools.sqlite3"
+    path.write_bytes(b"not a sqlite database" * 100)
+    cache = ToolCache(str(path))
+    cache.set("retrieve:GLM-40", "結果")
+    assert cache.get("retrieve:GLM-40") == "結果"
@@ -0,0 +1,24 @@
+from datetime import datetime, timezone
+
+import vision_warmup
+
+
+def test_business_hours_use_configured_timezone(monkeypatch):
+    monkeypatch.setattr(vision_warmup, "OLLAMA_KEEP_WARM_TZ", "Asia/Taipei")
+    # 週一 UTC 00:30 為台北 08:30；UTC 10:30 為台北 18:30
+    assert vision_warmup.within_business_hours(datetime(2024, 6, 3, 0, 30, tzinfo=timezone.utc))
+    assert not vision_warmup.within_business_hours(datetime(2024, 6, 3, 10, 30, tzinfo=timezone.utc))
+    # 週五 UTC 17:00 已是台北週六 01:00
+    assert not vision_warmup.within_business_hours(datetime(2024, 6, 7, 17, 0, tzinfo=timezone.utc))
+
+
+def test_naive_time_is_taken_as_business_time():
+    assert vision_warmup.within_business_hours(datetime(2024, 6, 3, 9, 0))
+    assert not vision_warmup.within_business_hours(datetime(2024, 6, 8, 9, 0))
+
+
+def test_unknown_or_empty_timezone_falls_back_to_system_time(monkeypatch):
+    monkeypatch.setattr(vision_warmup, "OLLAMA_KEEP_WARM_TZ", "Not/AZone")
+    assert vision_warmup.within_business_hours(datetime(2024, 6, 3, 10, 30, tzinfo=timezone.utc))
+    monkeypatch.setattr(vision_warmup, "OLLAMA_KEEP_WARM_TZ", "")
+    assert vision_warmup.within_business_hours(datetime(2024, 6, 3, 10, 30, tzinfo=timezone.utc))
@@ -0,0 +1,191 @@
+"""
+LLM token 用量與費用統計
+
+每次 chat completion 回傳的 usage（串流時為最後一個片段）都記到目前請求的
+TokenLedger，依階段分類：階段名稱取自呼叫當下的追蹤 span，例如
+language_detection、translate_input、agent_run（Agent 各輪）、
+tool.extract_query_keywords。
+
+- 每次請求的統計隨 final_result 送出
+- 設定 TOKEN_USAGE_LOG 時，每次請求附加一行 JSON，跨執行彙總：
+      python token_accounting.py summary [路徑]
+- 設定 AGENT_TOKEN_BUDGET（或 --token-budget）時，超過預算後 Agent 不再開始
+  下一輪，以目前的結果結束
+
+單價（LLM_PRICE_*_PER_MTOK，每百萬 token）未設定時不計算費用。
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TOKEN_USAGE_LOG = os.getenv("TOKEN_USAGE_LOG")
+AGENT_TOKEN_BUDGET = int(os.getenv("AGENT_TOKEN_BUDGET") or 0)  # 0 表示不限制
+
+PRICE_INPUT_PER_MTOK = float(os.getenv("LLM_PRICE_INPUT_PER_MTOK") or 0)
+PRICE_CACHED_INPUT_PER_MTOK = float(os.getenv("LLM_PRICE_CACHED_INPUT_PER_MTOK") or PRICE_INPUT_PER_MTOK)
+PRICE_OUTPUT_PER_MTOK = float(os.getenv("LLM_PRICE_OUTPUT_PER_MTOK") or 0)
+
+_current_ledger: ContextVar["TokenLedger | None"] = ContextVar("token_ledger", default=None)
+
+_COUNTERS = ("calls", "prompt_tokens", "completion_tokens", "cached_tokens", "total_tokens")
+
+
+def usage_counts(usage: Any) -> dict | None:
+    """從 OpenAI 的 CompletionUsage（或同格式的 dict）取出 token 數"""
+    if usage is None:
+        return None
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, "model_dump") else vars(usage)
+    prompt = usage.get("prompt_tokens") or 0
+    completion = usage.get("completion_tokens") or 0
+    details = usage.get("prompt_tokens_details") or {}
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "cached_tokens": details.get("cached_tokens") or 0,
+        "total_tokens": usage.get("total_tokens") or prompt + completion,
+    }
+
+
+def estimate_cost(counts: dict) -> float | None:
+    """依單價估算費用；未設定單價時回傳 None"""
+    if not (PRICE_INPUT_PER_MTOK or PRICE_OUTPUT_PER_MTOK):
+        return None
+    uncached = counts["prompt_tokens"] - counts["cached_tokens"]
+    return round((uncached * PRICE_INPUT_PER_MTOK
+                  + counts["cached_tokens"] * PRICE_CACHED_INPUT_PER_MTOK
+                  + counts["completion_tokens"] * PRICE_OUTPUT_PER_MTOK) / 1e6, 6)
+
+
+class TokenLedger:
+    """一次請求的 token 用量"""
+
+    def __init__(self, request_id: str | None = None, budget: int | None = None,
+                 on_record: Callable[[dict], None] | None = None):
+        self.request_id = request_id
+        self.budget = budget or None
+        self.on_record = on_record
+        self.calls: list = []
+        self.totals = dict.fromkeys(_COUNTERS, 0)
+
+    @property
+    def exceeded(self) -> bool:
+        return self.budget is not None and self.totals["total_tokens"] >= self.budget
+
+    def record(self, stage: str, model: str | None, usage: Any) -> dict | None:
+        counts = usage_counts(usage)
+        if counts is None:
+            return None
+        call = {"stage": stage, "model": model, **counts}
+        self.calls.append(call)
+        self.totals["calls"] += 1
+        for key, value in counts.items():
+            self.totals[key] += value
+        if self.on_record:
+            self.on_record(call)
+        return call
+
+    def by_stage(self) -> dict:
+        stages: dict = {}
+        for call in self.calls:
+            stage = stages.setdefault(call["stage"], dict.fromkeys(_COUNTERS, 0))
+            stage["calls"] += 1
+            for key in _COUNTERS[1:]:
+                stage[key] += call[key]
+        return stages
+
+    def summary(self) -> dict:
+        return {
+            **self.totals,
+            "cost": estimate_cost(self.totals),
+            "budget": self.budget,
+            "budget_exceeded": self.exceeded,
+            "by_stage": self.by_stage(),
+        }
+
+    def append_log(self, path: str, **extra):
+        """附加一行到跨執行的用量紀錄"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        entry = {"timestamp": time.time(), "request_id": self.request_id, **extra, **self.summary()}
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+@contextmanager
+def start_ledger(request_id: str | None = None, budget: int | None = None,
+                 on_record: Callable[[dict], None] | None = None):
+    ledger = TokenLedger(request_id, budget, on_record)
+    token = _current_ledger.set(ledger)
+    try:
+        yield ledger
+    finally:
+        _current_ledger.reset(token)
+
+
+def current_ledger() -> TokenLedger | None:
+    return _current_ledger.get()
+
+
+def summarize_log(path: str) -> dict:
+    """彙總 TOKEN_USAGE_LOG：全部、各階段與每日用量"""
+    totals = dict.fromkeys(_COUNTERS, 0)
+    stages: dict = {}
+    days: dict = {}
+    requests = budget_stops = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            requests += 1
+            budget_stops += bool(entry.get("budget_exceeded"))
+            day = days.setdefault(time.strftime("%Y-%m-%d", time.localtime(entry["timestamp"])),
+                                  dict.fromkeys(_COUNTERS, 0))
+            for key in _COUNTERS:
+                totals[key] += entry.get(key, 0)
+                day[key] += entry.get(key, 0)
+            for name, counts in entry.get("by_stage", {}).items():
+                stage = stages.setdefault(name, dict.fromkeys(_COUNTERS, 0))
+                for key in _COUNTERS:
+                    stage[key] += counts.get(key, 0)
+
+    return {
+        "requests": requests,
+        "budget_stops": budget_stops,
+        **totals,
+        "tokens_per_request": round(totals["total_tokens"] / requests, 1) if requests else 0.0,
+        "cached_ratio": round(totals["cached_tokens"] / totals["prompt_tokens"], 4)
+        if totals["prompt_tokens"] else 0.0,
+        "cost": estimate_cost(totals),
+        "by_stage": stages,
+        "by_day": {name: {**counts, "cost": estimate_cost(counts)} for name, counts in sorted(days.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM token 用量統計")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="彙總 TOKEN_USAGE_LOG")
+    summary_parser.add_argument("path", nargs="?", default=TOKEN_USAGE_LOG)
+    args = parser.parse_args()
+
+    if not args.path:
+        parser.error("請指定紀錄檔路徑或設定 TOKEN_USAGE_LOG")
+    print(json.dumps(summarize_log(args.path), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
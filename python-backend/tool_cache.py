@@ -0,0 +1,119 @@
+"""
+檢索、關鍵字與翻譯快取
+
+原本的快取只是程序內的 dict，而 Node 端每個請求都啟動新的 Python 程序，
+快取在請求之間完全用不到，預熱也無從生效。這裡在 dict 之前的程序內快取
+之外，加上以 sqlite 儲存、跨程序共用的一層：
+
+- 讀取時先查程序內的 dict，沒有再查 sqlite，命中後放回 dict
+- 寫入時兩層都寫，並順便刪除 sqlite 中已過期的項目
+- 每個項目各自有到期時間：檢索結果隨知識庫變動，TTL 較短；關鍵字與翻譯
+  只取決於輸入文字，可以保留較久
+
+AGENT_CACHE_PATH 為空字串時只使用程序內快取（批次模式與基準測試）。
+sqlite 出錯（多個請求程序同時寫入而鎖定逾時、目錄唯讀等）時該次操作只用
+程序內快取，不影響工具本身的結果。
+"""
+from __future__ import annotations
+
+import os
+import sqlite3
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+AGENT_CACHE_PATH = os.getenv("AGENT_CACHE_PATH", "cache/tools.sqlite3")
+AGENT_CACHE_TTL = float(os.getenv("AGENT_CACHE_TTL") or 300)  # 檢索結果，秒
+AGENT_LLM_CACHE_TTL = float(os.getenv("AGENT_LLM_CACHE_TTL") or 86400)  # 關鍵字與翻譯，秒
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_by_expiry ON entries (expires_at);
+"""
+
+
+class ToolCache:
+    """程序內 dict 加上（選填）sqlite 的兩層快取；值為字串"""
+
+    def __init__(self, path: str | None = AGENT_CACHE_PATH, ttl: float = AGENT_CACHE_TTL):
+        self.path = path or None
+        self.ttl = ttl
+        self._memory: dict = {}  # key -> (到期時間, 值)
+        self._db: sqlite3.Connection | None = None
+        self._warned = False
+
+    def _connect(self) -> sqlite3.Connection | None:
+        if self.path and self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+            self._db = db
+        return self._db
+
+    def _fallback(self, error: Exception):
+        """sqlite 無法使用，本次操作只用程序內快取；同一程序只提示一次"""
+        if not self._warned:
+            self._warned = True
+            print(f"工具快取 sqlite 無法使用，改用程序內快取: {error}", file=sys.stderr)
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry:
+            expires_at, value = entry
+            if expires_at > now:
+                return value
+            del self._memory[key]
+
+        try:
+            db = self._connect()
+            if db is None:
+                return None
+            row = db.execute("SELECT value, expires_at FROM entries WHERE key = ? AND expires_at > ?",
+                             (key, now)).fetchone()
+        except (sqlite3.Error, OSError) as e:
+            self._fallback(e)
+            return None
+        if row is None:
+            return None
+        self._memory[key] = (row[1], row[0])
+        return row[0]
+
+    def set(self, key: str, value: str, ttl: float | None = None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        self._memory[key] = (expires_at, value)
+        try:
+            db = self._connect()
+            if db is None:
+                return
+            with db:
+                db.execute("INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+                           (key, value, expires_at))
+                db.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+        except (sqlite3.Error, OSError) as e:
+            self._fallback(e)
+
+    def clear(self):
+        """清除兩層快取"""
+        self._memory.clear()
+        try:
+            db = self._connect()
+            if db is not None:
+                with db:
+                    db.execute("DELETE FROM entries")
+        except (sqlite3.Error, OSError) as e:
+            self._fallback(e)
+
+    def __len__(self) -> int:
+        return len(self._memory)
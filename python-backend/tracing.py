@@ -0,0 +1,267 @@
+"""
+輕量延遲追蹤
+
+把一次請求的時間拆成巢狀 span（語言偵測、輸入翻譯、Agent 各輪的模型與工具
+時間、檢索、OCR、輸出翻譯），每個 span 結束時以 trace_span 事件送出，
+並可選擇以 OTLP JSON 格式寫入本機檔案（TRACE_EXPORT_PATH）。
+
+沒有進行中的 Tracer 時，span() 不做任何事，負擔可忽略。
+"""
+from __future__ import annotations
+
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Callable
+
+_current_tracer: ContextVar["Tracer | None"] = ContextVar("current_tracer", default=None)
+_current_span: ContextVar["Span | None"] = ContextVar("current_span", default=None)
+
+SERVICE_NAME = "agent-test-python-backend"
+
+
+class Span:
+    """一段計時區間；時間以單調時鐘量測"""
+
+    __slots__ = ("tracer", "name", "span_id", "parent_id", "attributes",
+                 "start_ns", "end_ns", "status", "error")
+
+    def __init__(self, tracer: "Tracer", name: str, parent_id: str | None, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = time.perf_counter_ns()
+        self.end_ns: int | None = None
+        self.status = "ok"
+        self.error: str | None = None
+        if parent_id is None and tracer.root is None:
+            tracer.root = self
+        tracer.active[self.span_id] = self
+
+    @property
+    def duration(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.perf_counter_ns()
+        return (end_ns - self.start_ns) / 1e9
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def end(self, error: BaseException | None = None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.perf_counter_ns()
+        self.tracer.active.pop(self.span_id, None)
+        if error is not None:
+            self.status = "error"
+            self.error = f"{type(error).__name__}: {error}"
+        self.tracer._on_span_end(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.tracer.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round((self.start_ns - self.tracer.origin_ns) / 1e9, 6),
+            "duration": round(self.duration, 6),
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class Tracer:
+    """一次請求的追蹤紀錄"""
+
+    def __init__(self, trace_id: str | None = None,
+                 on_span_end: Callable[[dict], None] | None = None,
+                 export_path: str | None = None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.on_span_end = on_span_end
+        self.export_path = export_path
+        self.spans: list[Span] = []
+        self.root: Span | None = None
+        # 已開始、尚未結束的 span（例如進行中的 LLM 呼叫）
+        self.active: dict[str, Span] = {}
+        # 單調時鐘與牆上時鐘的對應，用於輸出 OTLP 的絕對時間
+        self.origin_ns = time.perf_counter_ns()
+        self.origin_unix_ns = time.time_ns()
+
+    def _on_span_end(self, span: Span):
+        self.spans.append(span)
+        if self.on_span_end:
+            self.on_span_end(span.to_dict())
+
+    def breakdown(self) -> dict:
+        """
+        依 span 名稱彙總耗時，並拆出 Agent 執行中的模型與工具時間
+
+        工具 span 名稱以 tool. 開頭，LLM 呼叫為 llm.chat。
+        """
+        root = self.root
+        # 進行中的 span 也要納入，才能找到尚未結束的祖先（例如取消時的 agent_run）
+        by_id = {**self.active, **{s.span_id: s for s in self.spans}}
+        if root is not None:
+            by_id[root.span_id] = root
+
+        def under(span: Span, ancestor_name: str) -> bool:
+            parent = by_id.get(span.parent_id)
+            while parent is not None:
+                if parent.name == ancestor_name:
+                    return True
+                parent = by_id.get(parent.parent_id)
+            return False
+
+        stages: dict[str, float] = {}
+        agent = {"turns": 0, "model_seconds": 0.0, "tool_seconds": 0.0, "queue_wait_seconds": 0.0}
+        for span in self.spans:
+            stages[span.name] = stages.get(span.name, 0.0) + span.duration
+            if not under(span, "agent_run"):
+                continue
+            # 只計入 Agent 本身的模型呼叫，工具內部的 LLM 呼叫算在工具時間
+            if span.name == "llm.chat" and by_id.get(span.parent_id) is not None \
+                    and by_id[span.parent_id].name == "agent_run":
+                agent["turns"] += 1
+                agent["model_seconds"] += span.duration
+                agent["queue_wait_seconds"] += span.attributes.get("queue_wait", 0.0)
+            elif span.name.startswith("tool."):
+                agent["tool_seconds"] += span.duration
+
+        return {
+            "trace_id": self.trace_id,
+            "total_seconds": round(root.duration, 4) if root else None,
+            "stages": {name: round(seconds, 4) for name, seconds in stages.items()},
+            "agent": {k: round(v, 4) if isinstance(v, float) else v for k, v in agent.items()},
+        }
+
+    def to_otlp(self) -> dict:
+        """轉成 OTLP/JSON (ExportTraceServiceRequest) 格式"""
+        def unix_nano(perf_ns: int) -> str:
+            return str(self.origin_unix_ns + (perf_ns - self.origin_ns))
+
+        spans = []
+        for span in self.spans:
+            otlp_span = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": unix_nano(span.start_ns),
+                "endTimeUnixNano": unix_nano(span.end_ns),
+                "attributes": [_otlp_attribute(k, v) for k, v in span.attributes.items()],
+                "status": {"code": 2, "message": span.error} if span.status == "error" else {"code": 1},
+            }
+            if span.parent_id:
+                otlp_span["parentSpanId"] = span.parent_id
+            spans.append(otlp_span)
+
+        return {"resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "agent_test"}, "spans": spans}],
+        }]}
+
+    def export(self):
+        """附加一行 OTLP JSON 到 export_path"""
+        if not self.export_path or not self.spans:
+            return
+        directory = os.path.dirname(self.export_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.export_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(self.to_otlp(), ensure_ascii=False) + "\n")
+
+
+def _otlp_attribute(key: str, value: Any) -> dict:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+@contextmanager
+def start_trace(trace_id: str | None = None,
+                on_span_end: Callable[[dict], None] | None = None,
+                export_path: str | None = None):
+    """開始一次請求的追蹤；結束時輸出 OTLP 檔案（若有設定）"""
+    tracer = Tracer(trace_id, on_span_end, export_path)
+    token = _current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _current_tracer.reset(token)
+        tracer.export()
+
+
+def current_tracer() -> Tracer | None:
+    return _current_tracer.get()
+
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+
+def start_span(name: str, **attributes) -> Span | None:
+    """
+    手動開始一個 span，需自行呼叫 end()
+
+    不會成為目前 span，適合結束點不在同一個區塊內的情況（例如串流回應）。
+    """
+    tracer = _current_tracer.get()
+    if tracer is None:
+        return None
+    parent = _current_span.get()
+    return Span(tracer, name, parent.span_id if parent else None, attributes)
+
+
+@contextmanager
+def use_span(current: Span | None):
+    """讓手動開始的 span 成為目前 span（不會結束它），區塊內建立的子 span 與 task 以它為父節點"""
+    if current is None:
+        yield None
+        return
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        _current_span.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """在區塊內計時；區塊內開始的 span 會以此為父節點"""
+    current = start_span(name, **attributes)
+    if current is None:
+        yield None
+        return
+
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.end(error=e)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end()
+
+
+def traced(name: str, **attributes):
+    """以 span 包住整個協程函數（用於 Agent 工具）"""
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(name, **attributes):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
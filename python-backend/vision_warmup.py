@@ -0,0 +1,173 @@
+"""
+Ollama 視覺模型預熱與保溫
+
+閒置一段時間後第一次 OCR 要先把 qwen2.5vl 載入記憶體，常常比推論本身還久。
+這個模組負責：
+- 預先載入視覺模型（伺服器啟動時，或圖片上傳時由 upload-product-image 觸發）
+- 送出 keep_alive 設定，讓模型在記憶體中停留
+- 營業時間內定期保溫
+- 回報冷啟動載入時間，讓呼叫端與推論時間分開統計
+
+只依賴 requests，可以獨立以子程序執行而不必載入整個 agent。
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, tzinfo
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+OLLAMA_HOST = os.getenv("OLLAMA_HOST")
+OLLAMA_VISION_MODEL = os.getenv("OLLAMA_VISION_MODEL", "qwen2.5vl:7b")
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# 營業時間（24 小時制，含頭不含尾）與星期（1=週一 ... 7=週日）
+OLLAMA_KEEP_WARM_HOURS = os.getenv("OLLAMA_KEEP_WARM_HOURS", "8-18")
+OLLAMA_KEEP_WARM_DAYS = os.getenv("OLLAMA_KEEP_WARM_DAYS", "1-5")
+# 營業時間的時區；容器預設為 UTC，留空則使用系統時區
+OLLAMA_KEEP_WARM_TZ = os.getenv("OLLAMA_KEEP_WARM_TZ", "Asia/Taipei")
+OLLAMA_KEEP_WARM_INTERVAL = int(os.getenv("OLLAMA_KEEP_WARM_INTERVAL", "240"))  # seconds
+
+_NS_PER_SECOND = 1_000_000_000
+
+
+def _ollama_url(path: str) -> str:
+    return f"http://{OLLAMA_HOST}{path}"
+
+
+def _parse_range(spec: str) -> tuple[int, int]:
+    start, _, end = spec.partition("-")
+    return int(start), int(end or start)
+
+
+def is_model_loaded(model: str = OLLAMA_VISION_MODEL, timeout: float = 2) -> bool:
+    """查詢 /api/ps，確認模型是否已在記憶體中"""
+    try:
+        response = requests.get(_ollama_url("/api/ps"), timeout=timeout)
+        response.raise_for_status()
+        loaded = response.json().get("models", [])
+    except (requests.RequestException, ValueError):
+        return False
+    return any(m.get("name") == model or m.get("model") == model for m in loaded)
+
+
+def preload_vision_model(model: str = OLLAMA_VISION_MODEL,
+                         keep_alive: str = OLLAMA_KEEP_ALIVE,
+                         timeout: float = 300) -> dict:
+    """
+    載入視覺模型並設定 keep_alive
+
+    Ollama 收到不含 prompt 的 generate 請求時只會載入模型，不做推論。
+
+    Returns:
+        包含 loaded、load_seconds（Ollama 回報的載入時間）與 total_seconds 的字典
+    """
+    start_ts = time.time()
+    try:
+        response = requests.post(
+            _ollama_url("/api/generate"),
+            json={"model": model, "keep_alive": keep_alive},
+            timeout=timeout,
+        )
+        response.raise_for_status()
+        data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        return {
+            "loaded": False,
+            "error": str(e),
+            "load_seconds": 0.0,
+            "total_seconds": time.time() - start_ts,
+        }
+
+    return {
+        "loaded": True,
+        "load_seconds": data.get("load_duration", 0) / _NS_PER_SECOND,
+        "total_seconds": time.time() - start_ts,
+    }
+
+
+def ensure_vision_model_loaded(model: str = OLLAMA_VISION_MODEL) -> dict:
+    """
+    推論前確認模型已載入；未載入時先預熱
+
+    Returns:
+        包含 cold_load（是否經歷冷啟動）與 load_seconds 的字典
+    """
+    if is_model_loaded(model):
+        return {"cold_load": False, "load_seconds": 0.0}
+
+    result = preload_vision_model(model)
+    return {
+        "cold_load": result["loaded"],
+        "load_seconds": result["total_seconds"] if result["loaded"] else 0.0,
+    }
+
+
+@lru_cache(maxsize=None)
+def _business_timezone(name: str) -> tzinfo | None:
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        _log("warning", message=f"未知的時區 {name}，營業時間改用系統時區")
+        return None
+
+
+def within_business_hours(now: datetime | None = None) -> bool:
+    """依 OLLAMA_KEEP_WARM_HOURS / OLLAMA_KEEP_WARM_DAYS（OLLAMA_KEEP_WARM_TZ 時區）判斷是否需要保溫"""
+    tz = _business_timezone(OLLAMA_KEEP_WARM_TZ)
+    if now is None:
+        now = datetime.now(tz)
+    elif tz is not None and now.tzinfo is not None:
+        now = now.astimezone(tz)
+    first_day, last_day = _parse_range(OLLAMA_KEEP_WARM_DAYS)
+    start_hour, end_hour = _parse_range(OLLAMA_KEEP_WARM_HOURS)
+    return first_day <= now.isoweekday() <= last_day and start_hour <= now.hour < end_hour
+
+
+def keep_warm_loop(interval: int = OLLAMA_KEEP_WARM_INTERVAL, iterations: int | None = None):
+    """營業時間內定期送出預熱請求，讓模型不會因閒置被卸載"""
+    count = 0
+    while iterations is None or count < iterations:
+        if within_business_hours():
+            result = preload_vision_model()
+            _log("keep_warm", **result)
+        count += 1
+        if iterations is None or count < iterations:
+            time.sleep(interval)
+
+
+def _log(event_type: str, **kwargs):
+    print(json.dumps({"type": event_type, "timestamp": time.time(), **kwargs},
+                     ensure_ascii=False), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ollama 視覺模型預熱")
+    parser.add_argument("--keep-warm", action="store_true",
+                        help="持續在營業時間內定期保溫（預設只預熱一次）")
+    parser.add_argument("--interval", type=int, default=OLLAMA_KEEP_WARM_INTERVAL,
+                        help="保溫間隔秒數")
+    args = parser.parse_args()
+
+    if not OLLAMA_HOST:
+        _log("error", message="請在 .env.local 中設置 OLLAMA_HOST")
+        sys.exit(1)
+
+    if args.keep_warm:
+        keep_warm_loop(args.interval)
+    else:
+        _log("warmup", **preload_vision_model())
+
+
+if __name__ == "__main__":
+    main()